@@ -3,6 +3,7 @@ import bcrypt
 import streamlit as st
 
 from chronomodeler.models import User, UserAuthLevel, Simulation, Experiment
+from chronomodeler.migrations import run_migrations
 
 st.set_page_config(
     layout="wide"
@@ -12,9 +13,7 @@ st.set_page_config(
 @st.cache_data
 def runInitialSetup():
     print('Initializing database schema if not created already')
-    User.create_table()
-    Simulation.create_table()
-    Experiment.create_table()
+    run_migrations()
     return True
 
 
@@ -0,0 +1,91 @@
+# ============================================
+#   Storage size and read latency of full copy vs delta encoded experiment partitions
+#   usage: python benchmarks/bench_delta_partitions.py [--rows 5000] [--cols 40] [--exps 100] [--pred 500]
+# ============================================
+
+import os, sys, tempfile, argparse
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+# the database path and the delta flag are read at import time, so set them first.
+# Delta encoding is off by default, the "full" rows pass no base partitions so they stay full copies
+SCRATCH_DIR = tempfile.mkdtemp()
+os.environ["CHRONOMODELER_DB"] = os.path.join(SCRATCH_DIR, "bench.sqlite")
+os.environ["CHRONOMODELER_DELTA_PARTITIONS"] = "1"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chronomodeler.dbutils import db_query_fetch, db_write
+from chronomodeler.storage import SQLiteDataStore, ColumnarDataStore, create_partition_delta_table, \
+    write_experiment_partition, read_experiment_partitions
+
+
+def make_initial(nrows: int, ncols: int):
+    rng = np.random.default_rng(42)
+    df = pd.DataFrame({ f"Measure {i}": rng.normal(1000, 100, nrows) for i in range(ncols) })
+    df['Time'] = pd.date_range('1990-01-01', periods=nrows, freq='D')
+    df['TimeIndex'] = np.arange(nrows)
+    return df
+
+
+def make_experiment(initial: pd.DataFrame, npred: int, nvars: int, seed: int):
+    # like a saved prediction frame: the last rows, a few variables copied from the
+    # initial data and one predicted target column
+    rng = np.random.default_rng(seed)
+    variables = [f"Measure {i}" for i in range(nvars)]
+    df = initial.tail(npred)[variables + ['Time', 'TimeIndex']].reset_index(drop = True)
+    df[variables[0]] = rng.normal(1000, 100, npred)
+    return df
+
+
+def sqlite_size(table_name: str):
+    rows = db_query_fetch("SELECT SUM(pgsize) AS size FROM dbstat WHERE name = ? OR name LIKE ?;", (table_name, f"idx_{table_name}%"))
+    return rows[0]['size'] or 0
+
+def dir_size(path: str):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def timeit(fn, repeat: int = 5):
+    fn()
+    start = perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--cols", type=int, default=40)
+    parser.add_argument("--exps", type=int, default=100)
+    parser.add_argument("--pred", type=int, default=500)
+    parser.add_argument("--vars", type=int, default=10)
+    args = parser.parse_args()
+
+    db_write(create_partition_delta_table)
+    initial = make_initial(args.rows, args.cols)
+    experiments = [make_experiment(initial, args.pred, args.vars, seed) for seed in range(args.exps)]
+    expids = list(range(2, args.exps + 2))
+
+    print(f"\n{args.exps} experiments of {args.pred} rows x {args.vars + 2} columns, initial data {args.rows} x {args.cols + 2}")
+    print(f"{'backend':<10}{'encoding':<8}{'size (KB)':>12}{'cells (%)':>12}{'write (ms)':>12}{'read one (ms)':>15}{'read all (ms)':>15}")
+    for store, size in [
+            (SQLiteDataStore(), lambda table_name: sqlite_size(table_name)),
+            (ColumnarDataStore(os.path.join(SCRATCH_DIR, "data")), lambda table_name: dir_size(os.path.join(SCRATCH_DIR, "data", table_name)))
+        ]:
+        for encoding in ["full", "delta"]:
+            table_name = f"bench_{store.name}_{encoding}"
+            write_experiment_partition(store, table_name, 1, initial, initial=True)
+            base_size = size(table_name)
+            start = perf_counter()
+            stats = [
+                write_experiment_partition(store, table_name, expid, df, base_expids=[1] if encoding == "delta" else [])
+                for expid, df in zip(expids, experiments)
+            ]
+            write_ms = (perf_counter() - start) / args.exps * 1000
+            read_one = timeit(lambda: read_experiment_partitions(store, table_name, [expids[-1]]))
+            read_all = timeit(lambda: read_experiment_partitions(store, table_name, expids), repeat=2)
+            # share of the cells actually stored, 100% for full copies
+            cells = sum([stat['stored_cells'] for stat in stats]) / sum([stat['total_cells'] for stat in stats]) * 100
+            print(f"{store.name:<10}{encoding:<8}{(size(table_name) - base_size) / 1024:>12.0f}{cells:>12.0f}{write_ms:>12.1f}{read_one:>15.1f}{read_all:>15.1f}")
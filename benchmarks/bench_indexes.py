@@ -0,0 +1,86 @@
+# ============================================
+#   Lookup latency before / after the index migrations
+#   usage: python benchmarks/bench_indexes.py [--sims 10000] [--rows 1000000]
+# ============================================
+
+import os, sys, tempfile, argparse, random
+from time import perf_counter
+
+# the database path is read at import time, so point it to a scratch file first
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+os.environ["CHRONOMODELER_DB"] = DB_PATH
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chronomodeler.models import Simulation
+from chronomodeler.dbutils import db_query_fetch, db_transaction
+from chronomodeler.migrations import run_migrations
+from chronomodeler.apimethods import simulation_data_table_name
+
+
+def populate(nsims: int, nrows: int, nusers: int = 100, exps_per_sim: int = 5, data_exps: int = 100):
+    with db_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO users(username, password_hash, created_at, updated_at) VALUES (?, '', 0, 0);",
+            [(f"user{i}@example.com", ) for i in range(nusers)]
+        )
+        conn.executemany(
+            "INSERT INTO simulations(sim_name, userid, table_name, created_at, updated_at) VALUES (?, ?, '', 0, 0);",
+            [(f"sim{i}", 1 + i % nusers) for i in range(nsims)]
+        )
+        conn.executemany(
+            "INSERT INTO experiments(simid, exp_name, config, results, initial, created_at, updated_at) \
+                VALUES (?, ?, '{}', '{}', ?, 0, 0);",
+            [(1 + i // exps_per_sim, f"exp{i}", 1 if i % exps_per_sim == 0 else 0) for i in range(nsims * exps_per_sim)]
+        )
+
+    # one large data table holding all the rows, belonging to the first simulation
+    sim = Simulation.get(1)
+    table_name = simulation_data_table_name(sim, sim.userid)
+    rows_per_exp = nrows // data_exps
+    with db_transaction() as conn:
+        conn.execute(f"CREATE TABLE {table_name} (Revenue REAL, Time TIMESTAMP, TimeIndex INTEGER, experiment_id INTEGER);")
+        conn.executemany(
+            f"INSERT INTO {table_name} VALUES (?, ?, ?, ?);",
+            ((random.random(), f"20{10 + (i % rows_per_exp) // 365000:02d}-01-01 00:00:00", i % rows_per_exp, 1 + i // rows_per_exp) for i in range(nrows))
+        )
+    return sim, table_name, data_exps
+
+
+def timeit(fn, repeat: int = 50):
+    start = perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (perf_counter() - start) / repeat * 1000
+
+
+def run_lookups(sim: Simulation, table_name: str, data_exps: int, nusers: int = 100):
+    rng = random.Random(42)
+    sims = [Simulation.get(rng.randint(1, 1000)) for _ in range(20)]
+    return {
+        "Simulation.count": timeit(lambda: Simulation.count(rng.randint(1, nusers))),
+        "get_initial_experiment": timeit(lambda: rng.choice(sims).get_initial_experiment()),
+        "get_nth_experiment(3)": timeit(lambda: rng.choice(sims).get_nth_experiment(3)),
+        "get_experiment_count": timeit(lambda: rng.choice(sims).get_experiment_count()),
+        "data rows of one experiment": timeit(
+            lambda: db_query_fetch(f"SELECT * FROM {table_name} WHERE experiment_id = ?;", (rng.randint(1, data_exps), )),
+            repeat=10
+        ),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sims", type=int, default=10000)
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args()
+
+    run_migrations(target=1)   # base tables only, no secondary indexes
+    sim, table_name, data_exps = populate(args.sims, args.rows)
+    before = run_lookups(sim, table_name, data_exps)
+    run_migrations()
+    after = run_lookups(sim, table_name, data_exps)
+
+    print(f"\n{args.sims} simulations, {args.rows} data rows (database at {DB_PATH})")
+    print(f"{'lookup':<32}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    for key in before:
+        print(f"{key:<32}{before[key]:>14.3f}{after[key]:>14.3f}{before[key] / after[key]:>9.1f}x")
@@ -0,0 +1,106 @@
+# ============================================
+#   End to end QBO ingest throughput (fetch, parse, pivot) against the local stand-in server
+#   usage: python benchmarks/bench_qbo_ingest.py [--years 5] [--freq Monthly] [--items 10] [--depth 2]
+#          [--latency 0.05] [--rate-limit 8] [--max-concurrent 10] [--failure-rate 0.0]
+# ============================================
+
+import os, sys, tempfile, argparse, logging
+import datetime as dt
+from time import perf_counter
+import pandas as pd
+
+# the report cache directory is read at import time, so point it to a scratch directory first
+os.environ["CHRONOMODELER_QBO_CACHE_DIR"] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+logging.getLogger("streamlit").setLevel(logging.ERROR)     # stqdm outside of a streamlit app
+
+from chronomodeler.qboutils import fetch_all_qbo_data, get_qbo_report, extract_rows, create_calendar_seq, \
+    create_qbo_session, qualify_colliding_lineitems
+from qbo_server import QBOStandInServer, make_report
+
+REALM_ID = "1234567890"
+ACCESS_TOKEN = "local-stand-in-token"
+
+
+def bench_serial_per_period(server: QBOStandInServer, start_year: int, end_year: int, data_freq: str):
+    # the original ingest: one request per report and period, one after the other
+    datelist = create_calendar_seq(start_year, end_year, data_freq) + [dt.datetime(end_year + 1, 1, 1)]
+    session = create_qbo_session()
+    start = perf_counter()
+    dflist = []
+    for report_name in ["ProfitAndLoss", "BalanceSheet"]:
+        for i in range(len(datelist) - 1):
+            end = datelist[i + 1] - dt.timedelta(days = 1)
+            df = get_qbo_report(REALM_ID, ACCESS_TOKEN, report_name, datelist[i], end, session, base_url=server.base_url)
+            df['Time'] = end
+            df['ReportType'] = report_name
+            dflist.append(df)
+    df = qualify_colliding_lineitems(pd.concat(dflist, ignore_index=True))
+    df = pd.pivot_table(df, values = 'Amount', columns = 'LineItem', index = 'Time', fill_value = 0.0).reset_index()
+    session.close()
+    return df, perf_counter() - start
+
+
+def bench_fetch_all(server: QBOStandInServer, start_year: int, end_year: int, data_freq: str, use_cache: bool):
+    start = perf_counter()
+    df = fetch_all_qbo_data(REALM_ID, ACCESS_TOKEN, start_year, end_year, data_freq, use_cache=use_cache, base_url=server.base_url)
+    return df, perf_counter() - start
+
+
+def bench_parse(nperiods: int, items: int, depth: int, repeat: int = 5):
+    # parse and pivot only, on an in memory report
+    start_date = dt.date(2000, 1, 1)
+    end_date = dt.date(2000 + (nperiods - 1) // 12, (nperiods - 1) % 12 + 1, 28)
+    report = make_report(REALM_ID, "BalanceSheet", start_date, end_date, "Month", items, depth)
+    columns = {i: None for i in range(1, nperiods + 1)}
+    best_parse, best_pivot = float("inf"), float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        df = pd.DataFrame(extract_rows(report, columns))
+        best_parse = min(best_parse, perf_counter() - start)
+        df['Time'] = df.groupby('LineItem').cumcount()
+        start = perf_counter()
+        pd.pivot_table(df, values = 'Amount', columns = 'LineItem', index = 'Time', fill_value = 0.0)
+        best_pivot = min(best_pivot, perf_counter() - start)
+    return df.shape[0], best_parse, best_pivot
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--freq", default="Monthly", choices=["Yearly", "Monthly"])
+    parser.add_argument("--items", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--rate-limit", type=float, default=8)
+    parser.add_argument("--max-concurrent", type=int, default=10)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    end_year = dt.date.today().year
+    start_year = end_year - args.years + 1
+    server = QBOStandInServer(
+        items=args.items, depth=args.depth, latency=args.latency, rate_limit=args.rate_limit,
+        max_concurrent=args.max_concurrent, failure_rate=args.failure_rate
+    )
+    print(f"{args.years} years {args.freq}, {args.items} items per section, depth {args.depth}, "
+          f"latency {args.latency * 1000:.0f} ms, rate limit {args.rate_limit}/s, failure rate {args.failure_rate}")
+    print(f"{'case':<28}{'requests':>10}{'throttled':>10}{'failed':>8}{'MB':>8}{'seconds':>10}{'shape':>14}")
+    with server:
+        cases = [
+            ("serial, one per period", lambda: bench_serial_per_period(server, start_year, end_year, args.freq)),
+            ("fetch_all, cold cache", lambda: bench_fetch_all(server, start_year, end_year, args.freq, True)),
+            ("fetch_all, warm cache", lambda: bench_fetch_all(server, start_year, end_year, args.freq, True)),
+            ("fetch_all, no cache", lambda: bench_fetch_all(server, start_year, end_year, args.freq, False)),
+        ]
+        for name, run in cases:
+            before = dict(server.stats)
+            df, elapsed = run()
+            stats = { key: server.stats[key] - before[key] for key in before }
+            print(f"{name:<28}{stats['requests']:>10}{stats['throttled']:>10}{stats['failed']:>8}"
+                  f"{stats['bytes'] / 1e6:>8.2f}{elapsed:>10.3f}{str(df.shape):>14}")
+
+    nperiods = args.years * (12 if args.freq == "Monthly" else 1)
+    nrows, parse_s, pivot_s = bench_parse(nperiods, args.items, args.depth)
+    print(f"\nparse {nrows} records in {parse_s * 1000:.1f} ms ({nrows / parse_s / 1e6:.2f} M records/s), "
+          f"pivot in {pivot_s * 1000:.1f} ms")
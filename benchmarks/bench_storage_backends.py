@@ -0,0 +1,54 @@
+# ============================================
+#   Read latency of the SQLite and columnar storage backends
+#   usage: python benchmarks/bench_storage_backends.py [--rows 100000] [--cols 20] [--exps 10]
+# ============================================
+
+import os, sys, tempfile, argparse
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+# the database path is read at import time, so point it to a scratch file first
+SCRATCH_DIR = tempfile.mkdtemp()
+os.environ["CHRONOMODELER_DB"] = os.path.join(SCRATCH_DIR, "bench.sqlite")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chronomodeler.storage import SQLiteDataStore, ColumnarDataStore
+
+
+def make_frame(nrows: int, ncols: int):
+    rng = np.random.default_rng(42)
+    df = pd.DataFrame({ f"Measure {i}": rng.normal(1000, 100, nrows) for i in range(ncols) })
+    df['Time'] = pd.date_range('1900-01-01', periods=nrows, freq='D')
+    df['TimeIndex'] = np.arange(nrows)
+    return df
+
+
+def timeit(fn, repeat: int = 10):
+    fn()   # warm up caches
+    start = perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--cols", type=int, default=20)
+    parser.add_argument("--exps", type=int, default=10)
+    args = parser.parse_args()
+
+    df = make_frame(args.rows, args.cols)
+    table_name = "bench_user_bench_sim"
+    stores = [SQLiteDataStore(), ColumnarDataStore(os.path.join(SCRATCH_DIR, "data"))]
+    print(f"\n{args.exps} partitions of {args.rows} rows x {args.cols + 2} columns")
+    print(f"{'backend':<12}{'write (ms)':>14}{'read one (ms)':>16}{'read all (ms)':>16}")
+    for store in stores:
+        start = perf_counter()
+        for expid in range(1, args.exps + 1):
+            store.write_partition(table_name, expid, df, initial=(expid == 1))
+        write_ms = (perf_counter() - start) / args.exps * 1000
+        read_one = timeit(lambda: store.read_partitions(table_name, [1]))
+        read_all = timeit(lambda: store.read_partitions(table_name, list(range(1, args.exps + 1))), repeat=3)
+        print(f"{store.name:<12}{write_ms:>14.1f}{read_one:>16.1f}{read_all:>16.1f}")
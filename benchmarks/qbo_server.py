@@ -0,0 +1,258 @@
+# ============================================
+#   Local stand-in for the QuickBooks Online reports API
+#   serves ProfitAndLoss and BalanceSheet payloads of configurable size and depth, with
+#   injectable latency, throttling (429) and failures (5xx), so that qboutils can be
+#   exercised and benchmarked without Intuit credentials
+#   usage: python benchmarks/qbo_server.py [--port 8765] [--items 10] [--depth 2] [--latency 0.05]
+#          [--rate-limit 8] [--max-concurrent 10] [--failure-rate 0.01]
+#   then point the app to it with CHRONOMODELER_QBO_BASE_URL=http://127.0.0.1:8765
+# ============================================
+
+import json, random, threading, time, argparse, zlib
+import datetime as dt
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+# top level sections of each report, every one holding `depth` levels of subsections
+REPORT_SECTIONS = {
+    "ProfitAndLoss": ["Income", "Cost of Goods Sold", "Expenses", "Other Income", "Other Expenses"],
+    "BalanceSheet": ["Current Assets", "Fixed Assets", "Current Liabilities", "Long-Term Liabilities", "Equity"],
+}
+
+
+def period_ranges(start: dt.date, end: dt.date, summarize_column_by: str = None):
+    """
+        Splits [start, end] into the periods of one report column each, like the API does
+    """
+    if summarize_column_by not in ("Month", "Quarter", "Year"):
+        return [(start, end)]
+    months = {"Month": 1, "Quarter": 3, "Year": 12}[summarize_column_by]
+    periods = []
+    cur = start
+    while cur <= end:
+        index = (cur.year * 12 + cur.month - 1) // months * months + months     # first month of the next period
+        nxt = dt.date(index // 12, index % 12 + 1, 1)
+        periods.append((cur, min(nxt - dt.timedelta(days=1), end)))
+        cur = nxt
+    return periods
+
+
+def amount(realm_id: str, lineitem: str, period: tuple):
+    # deterministic, so that repeated and overlapping requests agree
+    seed = zlib.crc32(f"{realm_id}|{lineitem}|{period[1]}".encode("utf-8"))
+    return round(random.Random(seed).uniform(-1000, 10000), 2)
+
+
+def money_coldata(values: list, total: bool):
+    # a multi period Profit and Loss has a last total column, the sum of the period columns
+    return [{"value": f"{v:.2f}"} for v in values + ([sum(values)] if total else [])]
+
+
+def make_section(realm_id: str, name: str, periods: list, items: int, depth: int, total: bool = False):
+    rows = []
+    if depth > 0:
+        for i in range(2):
+            rows.append(make_section(realm_id, f"{name} {i + 1}", periods, items, depth - 1, total))
+    for i in range(items):
+        lineitem = f"{name} Account {i + 1}"
+        rows.append({
+            "ColData": [{"value": lineitem, "id": str(zlib.crc32(lineitem.encode("utf-8")))}] +
+                money_coldata([amount(realm_id, lineitem, p) for p in periods], total),
+            "type": "Data"
+        })
+    ncols = len(periods) + (1 if total else 0)
+    return {
+        "Header": {"ColData": [{"value": name}] + [{"value": ""} for _ in range(ncols)]},
+        "Rows": {"Row": rows},
+        "Summary": {"ColData": [{"value": f"Total {name}"}] + [{"value": "0.00"} for _ in range(ncols)]},
+        "type": "Section",
+        "group": name.replace(" ", "")
+    }
+
+
+def make_report(realm_id: str, report_name: str, start: dt.date, end: dt.date,
+                summarize_column_by: str = None, items: int = 10, depth: int = 2):
+    """
+        Report payload shaped like the QBO reports API: Header, Columns (with StartDate / EndDate
+        metadata per period column) and nested Rows of Section / Data rows
+    """
+    periods = period_ranges(start, end, summarize_column_by)
+    columns = [{"ColTitle": "", "ColType": "Account", "MetaData": [{"Name": "ColKey", "Value": "account"}]}]
+    for p in periods:
+        columns.append({
+            "ColTitle": p[0].strftime("%b %Y"), "ColType": "Money",
+            "MetaData": [
+                {"Name": "StartDate", "Value": p[0].isoformat()},
+                {"Name": "EndDate", "Value": p[1].isoformat()},
+                {"Name": "ColKey", "Value": p[0].strftime("%b %Y")}
+            ]
+        })
+    total = report_name == "ProfitAndLoss" and len(periods) > 1
+    if total:
+        columns.append({"ColTitle": "Total", "ColType": "Money", "MetaData": [{"Name": "ColKey", "Value": "total"}]})
+    sections = [make_section(realm_id, name, periods, items, depth, total) for name in REPORT_SECTIONS[report_name]]
+    # Net Income shows up in both reports, as in the real API
+    net_income = {
+        "ColData": [{"value": "Net Income"}] + money_coldata([amount(realm_id, "Net Income", p) for p in periods], total),
+        "type": "Data"
+    }
+    if report_name == "ProfitAndLoss":
+        rows = sections + [{"Summary": net_income, "type": "Section", "group": "NetIncome"}]
+    else:
+        sections[-1]["Rows"]["Row"].append(net_income)
+        rows = sections
+    return {
+        "Header": {
+            "Time": dt.datetime.now().isoformat(),
+            "ReportName": report_name,
+            "StartPeriod": start.isoformat(),
+            "EndPeriod": end.isoformat(),
+            "SummarizeColumnsBy": summarize_column_by or "Total",
+            "Currency": "USD",
+            "Option": [{"Name": "NoReportData", "Value": "false"}]
+        },
+        "Columns": {"Column": columns},
+        "Rows": {"Row": rows}
+    }
+
+
+class QBOStandInServer:
+    """
+        Threaded HTTP server answering GET /v3/company/<realm_id>/reports/<report_name>.
+        `latency` seconds are added to every request, requests beyond `rate_limit` per second or
+        `max_concurrent` in flight (per realm) get a 429 with Retry-After, and a `failure_rate`
+        fraction of the requests fails with a 500 / 503. Usable as a context manager
+    """
+
+    def __init__(self, port: int = 0, items: int = 10, depth: int = 2, latency: float = 0.0,
+                 rate_limit: float = None, max_concurrent: int = None, failure_rate: float = 0.0, seed: int = 0):
+        self.items = items
+        self.depth = depth
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.max_concurrent = max_concurrent
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = {}        # realm_id -> start times of the requests of the last second
+        self.inflight = {}      # realm_id -> requests being served
+        self.stats = {"requests": 0, "ok": 0, "throttled": 0, "failed": 0, "bytes": 0}
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _admit(self, realm_id: str):
+        """
+            Returns the status code to answer with before any work is done (None to serve the report)
+        """
+        with self.lock:
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            recent = [t for t in self.recent.get(realm_id, []) if now - t < 1.0]
+            throttled = (self.rate_limit is not None and len(recent) >= self.rate_limit) or \
+                (self.max_concurrent is not None and self.inflight.get(realm_id, 0) >= self.max_concurrent)
+            if throttled:
+                self.recent[realm_id] = recent
+                self.stats["throttled"] += 1
+                return 429
+            self.recent[realm_id] = recent + [now]
+            if self.random.random() < self.failure_rate:
+                self.stats["failed"] += 1
+                return self.random.choice([500, 503])
+            self.inflight[realm_id] = self.inflight.get(realm_id, 0) + 1
+            return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, headers: dict = {}):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                parts = url.path.strip("/").split("/")
+                if len(parts) != 5 or parts[:2] != ["v3", "company"] or parts[3] != "reports" or parts[4] not in REPORT_SECTIONS:
+                    self._send(404, b'{"Fault": {"Error": [{"Message": "Not found"}]}}')
+                    return
+                if not self.headers.get("Authorization", "").startswith("Bearer "):
+                    self._send(401, b'{"Fault": {"Error": [{"Message": "AuthenticationFailed"}]}}')
+                    return
+                realm_id, report_name = parts[2], parts[4]
+                status = server._admit(realm_id)
+                if status == 429:
+                    self._send(429, b'{"Fault": {"Error": [{"Message": "ThrottleExceeded"}]}}', {"Retry-After": "1"})
+                    return
+                if status is not None:
+                    self._send(status, b'{"Fault": {"Error": [{"Message": "Internal error"}]}}')
+                    return
+                try:
+                    time.sleep(server.latency)
+                    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    report = make_report(
+                        realm_id, report_name,
+                        dt.date.fromisoformat(query["start_date"]), dt.date.fromisoformat(query["end_date"]),
+                        query.get("summarize_column_by"), server.items, server.depth
+                    )
+                    body = json.dumps(report).encode("utf-8")
+                    with server.lock:
+                        server.stats["ok"] += 1
+                        server.stats["bytes"] += len(body)
+                    self._send(200, body)
+                finally:
+                    with server.lock:
+                        server.inflight[realm_id] -= 1
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the QBO reports API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--items", type=int, default=10, help="line items per section")
+    parser.add_argument("--depth", type=int, default=2, help="levels of subsections")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every request")
+    parser.add_argument("--rate-limit", type=float, default=None, help="requests per second per realm before 429s")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="requests in flight per realm before 429s")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests failing with 500 / 503")
+    args = parser.parse_args()
+
+    server = QBOStandInServer(
+        args.port, args.items, args.depth, args.latency, args.rate_limit, args.max_concurrent, args.failure_rate
+    )
+    print(f"Serving QBO reports on {server.base_url}, set CHRONOMODELER_QBO_BASE_URL={server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
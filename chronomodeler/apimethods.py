@@ -6,52 +6,129 @@ import streamlit as st
 import pandas as pd
 import re
 import numpy as np
+from typing import Dict, List
+from time import perf_counter
 
+from chronomodeler.constants import DATA_INSERT_CHUNK_SIZE
 from chronomodeler.models import Simulation, Experiment, User
-from chronomodeler.dbutils import get_db_conn, db_query_execute
+from chronomodeler.dbutils import db_query_fetch
+from chronomodeler.sharding import user_scope
+from chronomodeler.datacache import data_cache
+from chronomodeler.storage import get_data_store, ensure_data_table_indexes, write_experiment_partition, \
+    read_experiment_partitions, delete_experiment_partition, drop_experiment_partitions
+
+# with sharding, the data tables (and their delta metadata) live in the shard of the simulation's user
+
+def _data_table_name(username: str, sim_name: str):
+    return re.sub(re.compile(r'[^a-z0-9]'), '_', f"{username}_{sim_name}".lower())
 
 def simulation_data_table_name(sim: Simulation, userid: int):
     user = User.get(userid)
-    return  re.sub(re.compile(r'[^a-z0-9]'), '_', f"{user.username}_{sim.sim_name}".lower())
+    return _data_table_name(user.username, sim.sim_name)
+
+def list_simulation_data_tables():
+    """
+        Returns the names of all the per simulation data tables that exist in the database
+    """
+    rows = db_query_fetch(f"SELECT u.username, s.sim_name FROM {Simulation._table} s \
+        INNER JOIN {User._table} u ON u.userid = s.userid;", ())
+    existing = set([ row['name'] for row in db_query_fetch("SELECT name FROM sqlite_master WHERE type = 'table';", ()) ])
+    return [ table_name for table_name in set([ _data_table_name(row['username'], row['sim_name']) for row in rows ]) if table_name in existing ]
 
-def insert_data_to_experiment(df: pd.DataFrame, expp: Experiment, sim: Simulation, userid: int):
+def list_simulation_data_partitions() -> Dict[str, List[int]]:
+    """
+        Returns every simulation data table with the ids of its experiments, initial experiment first
+    """
+    rows = db_query_fetch(f"SELECT u.username, s.sim_name, e.expid FROM {Experiment._table} e \
+        INNER JOIN {Simulation._table} s ON s.simid = e.simid \
+        INNER JOIN {User._table} u ON u.userid = s.userid \
+        ORDER BY s.simid, e.initial DESC, e.expid;", ())
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(_data_table_name(row['username'], row['sim_name']), []).append(row['expid'])
+    return partitions
+
+def insert_data_to_experiment(
+        df: pd.DataFrame, 
+        expp: Experiment, 
+        sim: Simulation, 
+        userid: int,
+        chunksize: int = DATA_INSERT_CHUNK_SIZE,
+        bases: List[Experiment] = None
+    ):
+    """
+        Replaces the data of the experiment with the rows of `df` in the configured storage backend.
+        The data table is (re)created for the initial experiment if it does not exist yet
+        or if its columns differ from the dataframe. The input dataframe is not modified.
+        Other experiments are stored as a delta against the initial experiment or one of `bases`
+        (e.g. the upstream experiments), whichever leaves the least to store.
+        Returns the number of rows written, the stored / total cells, elapsed seconds and rows written per second.
+    """
     table_name = simulation_data_table_name(sim, userid)
-    df['experiment_id'] = expp.expid
-    if expp.initial:
-        df.to_sql(table_name, get_db_conn(), if_exists="replace", index=False)
-    else:
-        # not initial experiment, should append
-        sql = f"DELETE FROM {table_name} WHERE experiment_id = {expp.expid}"
-        db_query_execute(sql, ())
-
-        # now append the data
-        df.to_sql(table_name, get_db_conn(), if_exists="append", index=False)
-    return True
+    base_expids = []
+    if not expp.initial:
+        base_expids = [sim.get_initial_experiment(columns=["expid"]).expid] + [base.expid for base in (bases or [])]
+    start_time = perf_counter()
+    try:
+        with user_scope(sim.userid):
+            stats = write_experiment_partition(
+                get_data_store(), table_name, expp.expid, df,
+                initial=expp.initial, base_expids=base_expids, chunksize=chunksize
+            )
+    finally:
+        data_cache.bump_version(sim.simid)
+    elapsed = perf_counter() - start_time
+    stats['seconds'] = elapsed
+    stats['rows_per_sec'] = stats['rows'] / elapsed if elapsed > 0 else float('inf')
+    return stats
 
 def delete_data_from_experiment(expp: Experiment, sim: Simulation, userid: int):
     table_name = simulation_data_table_name(sim, userid)
-    sql = f"DELETE FROM {table_name} WHERE experiment_id = ?;"
-    db_query_execute(sql, (expp.expid, ))
+    try:
+        with user_scope(sim.userid):
+            delete_experiment_partition(get_data_store(), table_name, expp.expid)
+    finally:
+        data_cache.bump_version(sim.simid)
 
 
 def delete_simulation_data_table(sim: Simulation, userid: int):
     table_name = simulation_data_table_name(sim, userid)
-    sql = f"DROP TABLE IF EXISTS {table_name};"
-    db_query_execute(sql, ())
+    try:
+        with user_scope(sim.userid):
+            drop_experiment_partitions(get_data_store(), table_name)
+    finally:
+        data_cache.bump_version(sim.simid)
 
 
 def get_simulation_data_initial(sim: Simulation, userid: int) -> pd.DataFrame:
+    """
+        Initial data of the simulation, cached across reruns until the data of the simulation is written
+    """
     table_name = simulation_data_table_name(sim, userid)
     expp = sim.get_initial_experiment()
-    sql = f"SELECT * FROM {table_name} WHERE experiment_id = {expp.expid};"
-    df = pd.read_sql(sql, get_db_conn(), index_col=None, parse_dates=['Time'])
-    return df
+    return data_cache.get_or_load(
+        sim.simid, (table_name, expp.expid),
+        lambda: _read_partition(sim, table_name, expp.expid)
+    )
+
+def _read_partition(sim: Simulation, table_name: str, expid: int) -> pd.DataFrame:
+    with user_scope(sim.userid):
+        return read_experiment_partitions(get_data_store(), table_name, [expid])[expid]
 
 def get_simulation_experiment_data(sim: Simulation, userid: int, parameter: int):
     table_name = simulation_data_table_name(sim, userid)
     expp = sim.get_nth_experiment(n = parameter)
-    sql = f"SELECT * FROM {table_name} WHERE experiment_id = {expp.expid};"
-    df = pd.read_sql(sql, get_db_conn(), index_col=None, parse_dates=['Time'])
-    return df
-    
+    return _read_partition(sim, table_name, expp.expid)
 
+def get_simulation_experiments_data(sim: Simulation, userid: int, ordinals: List[int]) -> Dict[int, pd.DataFrame]:
+    """
+        Loads the data of several experiments (referred to by their ordinals) with one
+        experiment lookup and one data read, returns a dict from ordinal to dataframe
+    """
+    exps = sim.get_experiments_by_ordinals(ordinals)
+    if len(exps) == 0:
+        return {}
+    table_name = simulation_data_table_name(sim, userid)
+    with user_scope(sim.userid):
+        partitions = read_experiment_partitions(get_data_store(), table_name, [expp.expid for expp in exps.values()])
+    return { ordinal: partitions[expp.expid] for ordinal, expp in exps.items() }
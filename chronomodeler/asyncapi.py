@@ -0,0 +1,98 @@
+# ============================================
+#       Asyncio counterparts of the data access functions, so that
+#       the independent loads of a page run concurrently
+# ============================================
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+from typing import Dict, List
+import pandas as pd
+
+from chronomodeler.constants import ASYNC_DB_WORKERS
+from chronomodeler.dbutils import db_query_fetch, db_submit, db_scope, current_db
+from chronomodeler.models import Simulation, Experiment
+from chronomodeler.apimethods import get_simulation_data_initial, get_simulation_experiments_data
+
+
+# bounded pool of loader threads, every worker keeps its own persistent thread local
+# connection, so this is also the connection pool of the async API
+_executor = ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS, thread_name_prefix="chronomodeler-db")
+
+
+def _in_scope(database: str, fn, *args, **kwargs):
+    with db_scope(database):
+        return fn(*args, **kwargs)
+
+
+def submit(fn, *args, **kwargs) -> Future:
+    """
+        Starts `fn(*args, **kwargs)` on the loader pool and returns its future,
+        for synchronous code that wants to overlap a load with other work.
+        The load runs against the database of the caller's scope
+    """
+    return _executor.submit(_in_scope, current_db(), fn, *args, **kwargs)
+
+
+async def run_db(fn, *args, **kwargs):
+    """
+        Awaits `fn(*args, **kwargs)` run on the loader pool, so the event loop stays free
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(_in_scope, current_db(), fn, *args, **kwargs))
+
+
+async def db_query_fetch_async(query, params):
+    return await run_db(db_query_fetch, query, params)
+
+async def db_query_execute_async(query, params):
+    # writes go through the database writer, whose future is awaited directly
+    def execute(conn):
+        conn.execute(query, params)
+    await asyncio.wrap_future(db_submit(execute))
+
+async def get_experiment_count_async(sim: Simulation) -> int:
+    return await run_db(sim.get_experiment_count)
+
+async def get_simulation_data_initial_async(sim: Simulation, userid: int) -> pd.DataFrame:
+    return await run_db(get_simulation_data_initial, sim, userid)
+
+async def get_simulation_experiments_data_async(sim: Simulation, userid: int, ordinals: List[int]) -> Dict[int, pd.DataFrame]:
+    return await run_db(get_simulation_experiments_data, sim, userid, ordinals)
+
+async def get_experiment_async(expid: int, columns: List[str] = None) -> Experiment:
+    return await run_db(Experiment.get, expid, columns)
+
+
+async def gather_dict(**coros) -> Dict:
+    """
+        Awaits all the named coroutines concurrently and returns their results by name,
+        the first exception is raised once all of them have finished
+    """
+    names = list(coros.keys())
+    results = await asyncio.gather(*coros.values(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return dict(zip(names, results))
+
+
+def run_async(coro):
+    """
+        Runs a coroutine to completion from synchronous code (e.g. a Streamlit script thread)
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # already inside an event loop, run it on a loop of its own in a pool thread
+    return submit(asyncio.run, coro).result()
+
+
+def load_concurrently(**loads) -> Dict:
+    """
+        Runs the named zero argument callables concurrently on the loader pool and
+        returns their results by name; the elapsed time is the slowest load, not their sum.
+        e.g. load_concurrently(count = sim.get_experiment_count, df = lambda: get_simulation_data_initial(sim, userid))
+    """
+    return run_async(gather_dict(**{ name: run_db(fn) for name, fn in loads.items() }))
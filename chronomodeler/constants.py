@@ -1,5 +1,114 @@
+import os
+
 TIME_FORMAT_LIST = [
-    "%d-%m-%Y"
+    "%d-%m-%Y",
+    "%Y-%m-%d",
+    "%d/%m/%Y",
+    "%m/%d/%Y",
+    "%Y/%m/%d",
+    "%d-%b-%Y",
+    "%d %b %Y",
+    "%b %Y",
+    "%Y-%m",
+    "%Y"
 ]
+TIME_FORMAT_SAMPLE_SIZE = 500   # values of the time column used to infer its format
+
+# rows per executemany call when loading experiment data
+DATA_INSERT_CHUNK_SIZE = 10000
+
+# identity map of User / Simulation / Experiment objects
+MODEL_CACHE_SIZE = 2048
+MODEL_CACHE_TTL = 300    # seconds
+
+# simulation data frames kept across streamlit reruns, until the data of the simulation changes
+DATA_CACHE_SIZE = 32
+DATA_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# uploaded data files: parsed tables kept by content hash, csv rows parsed at a time
+# and rows sampled to pick the csv column dtypes
+INGEST_CACHE_SIZE = 8
+INGEST_CSV_CHUNK_SIZE = 100000
+INGEST_DTYPE_SAMPLE_ROWS = 1000
+
+# maximum number of results returned by model search (searchboxes)
+SEARCH_RESULT_LIMIT = 20
+SEARCH_CANDIDATE_LIMIT = 500    # most recent full text matches that get ranked
+
+# rows fetched per round trip when streaming query results
+ITER_BATCH_SIZE = 500
+
+# storage backend of the simulation time series, "sqlite" or "columnar" (.npy column files)
+DATA_BACKEND = os.environ.get("CHRONOMODELER_DATA_BACKEND", "sqlite")
+COLUMNAR_DATA_DIR = os.environ.get("CHRONOMODELER_DATA_DIR", "./data")
+
+# experiment partitions only store the columns / rows that differ from their base experiment.
+# Off by default: it saves space but reads are several times slower (the base is read and merged),
+# and rewriting a base turns its dependents back into full copies. Existing delta partitions stay readable
+DELTA_PARTITIONS_ENABLED = os.environ.get("CHRONOMODELER_DELTA_PARTITIONS", "0") == "1"
+
+SQLITE_DB = os.environ.get("CHRONOMODELER_DB", "./app.sqlite")
+
+# single writer thread that group commits the writes of all sessions
+DB_WRITER_ENABLED = os.environ.get("CHRONOMODELER_DB_WRITER", "1") == "1"
+DB_WRITE_QUEUE_SIZE = 1000      # pending writes before callers block (backpressure)
+DB_WRITE_BATCH_SIZE = 100       # writes committed together in one transaction
+DB_WRITE_BATCH_WAIT_MS = 2      # how long the writer waits for more writes to join a batch
+DB_WRITE_PUT_TIMEOUT = 30       # seconds a caller waits for room in a full queue
+
+# query runner page
+QUERY_RUNNER_ROW_CAP = 10000    # rows kept and rendered before the result is truncated
+QUERY_RUNNER_CHUNK_SIZE = 1000  # rows fetched and rendered at a time
+QUERY_RUNNER_TIMEOUT = 30       # seconds before a running query is interrupted
+PROGRESS_HANDLER_OPS = 10000    # sqlite virtual machine steps between timeout / cancel checks
+
+# worker threads (each holding its own connection) behind the async data access API
+ASYNC_DB_WORKERS = 8
+
+# background jobs (experiment runs), results are pickled under JOB_RESULT_DIR so reruns reattach to them
+JOB_WORKERS = int(os.environ.get("CHRONOMODELER_JOB_WORKERS", "2"))
+JOB_RESULT_DIR = os.environ.get("CHRONOMODELER_JOB_DIR", "./jobs")
+JOB_RESULT_CACHE_SIZE = 8       # unpickled results kept in memory
+JOB_RESULT_MAX_FILES = 200      # least recently used result files are deleted beyond this count
+JOB_RESULT_MAX_BYTES = 1024 * 1024 * 1024   # or beyond this total size
+JOB_POLL_INTERVAL = 1.0         # seconds between reruns of a page waiting on a job
+JOB_PROGRESS_INTERVAL = 0.5     # minimum seconds between two progress writes of a job
+RERUN_WORKERS = 4               # experiments of one dependency layer re-run at the same time
+
+# QuickBooks Online report fetching (QBO allows 500 requests per minute and 10 concurrent requests per realm)
+QBO_BASE_URL = os.environ.get("CHRONOMODELER_QBO_BASE_URL", "https://quickbooks.api.intuit.com")
+QBO_MAX_WORKERS = 8
+QBO_RATE_PER_SEC = 8        # sustained requests per second, 480 per minute
+QBO_RATE_BURST = 10         # requests that may be sent at once after an idle period
+QBO_MAX_RETRIES = 5         # retries of a request answered with 429 / 5xx or failing to connect
+QBO_BACKOFF_BASE = 0.5      # seconds, doubled on every retry (with jitter) unless Retry-After says otherwise
+QBO_BACKOFF_MAX = 30
+QBO_REQUEST_TIMEOUT = 60    # seconds
+# one report request covers many periods, one column per period (summarize_column_by)
+QBO_SUMMARIZE_COLUMN_BY = {"Yearly": "Year", "Monthly": "Month"}
+QBO_MAX_PERIODS_PER_REQUEST = 60
+
+# on disk cache of raw QBO report JSON. Reports of periods that ended more than QBO_CACHE_OPEN_DAYS ago
+# are considered closed and served from disk, recent (still open) periods are always fetched again
+QBO_CACHE_DIR = os.environ.get("CHRONOMODELER_QBO_CACHE_DIR", "./qbo_cache")
+QBO_CACHE_MAX_BYTES = 256 * 1024 * 1024     # least recently used reports are evicted above this size
+QBO_CACHE_OPEN_DAYS = 45
+QBO_CACHE_ONLY = os.environ.get("CHRONOMODELER_QBO_CACHE_ONLY", "0") == "1"    # never call the API (offline)
+
+# optional per user sharding: experiments and simulation data tables live in one SQLite file per user,
+# users and simulations stay in SQLITE_DB. Experiment ids of a shard start at userid << SHARD_ID_BITS
+SHARDING_ENABLED = os.environ.get("CHRONOMODELER_SHARDING", "0") == "1"
+SHARD_DIR = os.environ.get("CHRONOMODELER_SHARD_DIR", "./shards")
+SHARD_ID_BITS = 32
 
-SQLITE_DB = "./app.sqlite"
+# pragmas applied once on every new connection
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",      # readers do not block the writer and vice versa
+    "synchronous": "NORMAL",    # safe with WAL, avoids an fsync on every commit
+    "mmap_size": 256 * 1024 * 1024,     # 256 MB of memory mapped I/O
+    "cache_size": -64 * 1024,   # negative means KiB, so 64 MB of page cache
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+    "busy_timeout": SQLITE_BUSY_TIMEOUT_MS
+}
@@ -0,0 +1,98 @@
+# ============================================
+#       Cross rerun cache of simulation data frames
+# ============================================
+
+from typing import Any, Callable, Dict, Hashable
+from collections import OrderedDict
+from threading import Lock
+import pandas as pd
+
+from chronomodeler.constants import DATA_CACHE_SIZE, DATA_CACHE_MAX_BYTES
+
+
+class DataFrameCache:
+    """
+        Process wide LRU of loaded data frames keyed by (simid, data version, ...).
+        Every write to the data of a simulation bumps its data version, so frames loaded
+        before the write are never served again (even when the load raced with the write)
+        and are dropped right away. Frames are handed out as shallow copies, callers may
+        add or drop columns but must not modify the values in place.
+        The least recently used frames are evicted beyond `maxsize` frames or `max_bytes`
+    """
+
+    def __init__(self, maxsize: int = DATA_CACHE_SIZE, max_bytes: int = DATA_CACHE_MAX_BYTES):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._versions: Dict[int, int] = {}
+        self._lock = Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, simid: int) -> int:
+        with self._lock:
+            return self._versions.get(simid, 0)
+
+    def bump_version(self, simid: int):
+        """
+            Marks the data of the simulation as changed
+        """
+        with self._lock:
+            self._versions[simid] = self._versions.get(simid, 0) + 1
+            for key in [key for key in self._entries.keys() if key[0] == simid]:
+                self.nbytes -= self._entries.pop(key)[1]
+
+    def get_or_load(self, simid: int, key: Hashable, loader: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+            Returns the cached frame of `key` for the current data version of the simulation,
+            calling `loader` on a miss
+        """
+        with self._lock:
+            version = self._versions.get(simid, 0)
+            fullkey = (simid, version, key)
+            entry = self._entries.get(fullkey)
+            if entry is not None:
+                self._entries.move_to_end(fullkey)
+                self.hits += 1
+                return entry[0].copy(deep = False)
+            self.misses += 1
+        df = loader()
+        self._put(fullkey, df)
+        return df.copy(deep = False)
+
+    def _put(self, fullkey: Hashable, df: pd.DataFrame):
+        nbytes = int(df.memory_usage(index = True, deep = False).sum())
+        with self._lock:
+            if fullkey[1] != self._versions.get(fullkey[0], 0) or nbytes > self.max_bytes:
+                return  # written meanwhile, or too large to keep
+            if fullkey in self._entries:
+                self.nbytes -= self._entries.pop(fullkey)[1]
+            self._entries[fullkey] = (df, nbytes)
+            self.nbytes += nbytes
+            while len(self._entries) > self.maxsize or self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last = False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': (self.hits / total) if total > 0 else 0.0
+            }
+
+
+data_cache = DataFrameCache()
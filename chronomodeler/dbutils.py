@@ -1,18 +1,129 @@
 import sqlite3
+import threading
+import queue
+from concurrent.futures import Future
+from contextlib import contextmanager
+from time import perf_counter
 import streamlit as st
 
-from .constants import SQLITE_DB
+from .constants import SQLITE_DB, SQLITE_PRAGMAS, SQLITE_BUSY_TIMEOUT_MS, PROGRESS_HANDLER_OPS, \
+    DB_WRITER_ENABLED, DB_WRITE_QUEUE_SIZE, DB_WRITE_BATCH_SIZE, DB_WRITE_BATCH_WAIT_MS, DB_WRITE_PUT_TIMEOUT
+
+
+# one persistent connection per thread and database file, streamlit runs every session in its own thread
+_local = threading.local()
+
+
+def current_db() -> str:
+    """
+    The database file the db_* calls of the current thread go to, `SQLITE_DB` unless inside `db_scope`
+    """
+    return getattr(_local, "db", None) or SQLITE_DB
+
+
+@contextmanager
+def db_scope(database: str):
+    """
+    Routes the db_* calls of the current thread to another database file (e.g. a user shard)
+    for the duration of the block, scopes nest
+    """
+    previous = getattr(_local, "db", None)
+    _local.db = database
+    try:
+        yield
+    finally:
+        _local.db = previous
+
+
+def _open_db_conn(database: str = None):
+    conn = sqlite3.connect(
+        database=database or current_db(),
+        isolation_level=None,   # auto-commit is enabled, transactions are explicit
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000
+    )
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value};")
+    return conn
+
+
+def _depths() -> dict:
+    # transaction nesting depth per database file of the current thread
+    if getattr(_local, "depths", None) is None:
+        _local.depths = {}
+    return _local.depths
 
 
 def get_db_conn():
     """
     This function returns a connection object to a SQLite database.
-    @returns The function `get_db_conn()` is returning a connection object to a SQLite database
-    specified by the constant `SQLITE_DB`.
+    The connection is opened once per thread and database file (with WAL journaling and the
+    other pragmas listed in `SQLITE_PRAGMAS`) and reused by all subsequent calls from the same thread.
+    @returns The function `get_db_conn()` is returning a connection object to the SQLite database
+    of the current scope (`SQLITE_DB` by default). The caller must not close it.
     """
-    conn = sqlite3.connect(database=SQLITE_DB, isolation_level=None)  # auto-commit is enabled
+    if getattr(_local, "conns", None) is None:
+        _local.conns = {}
+    database = current_db()
+    conn = _local.conns.get(database)
+    if conn is None:
+        conn = _open_db_conn(database)
+        _local.conns[database] = conn
+        _depths()[database] = 0
     return conn
 
+
+def close_db_conn():
+    """
+    Closes the connections held by the current thread, if any.
+    The next call to `get_db_conn` opens a fresh one.
+    """
+    for conn in (getattr(_local, "conns", None) or {}).values():
+        conn.close()
+    _local.conns = {}
+    _local.depths = {}
+
+
+@contextmanager
+def db_transaction():
+    """
+    Context manager that wraps the enclosed statements in a single transaction
+    on the connection of the current thread, and yields that connection.
+    The outermost block issues BEGIN IMMEDIATE (taking the write lock upfront,
+    so it never fails midway upgrading from a read lock) and commits on exit,
+    nested blocks become savepoints. Any exception rolls back the enclosing block.
+    """
+    conn = get_db_conn()
+    depths = _depths()
+    database = current_db()
+    depth = depths[database]
+    savepoint = f"sp_{depth}"
+    conn.execute("BEGIN IMMEDIATE;" if depth == 0 else f"SAVEPOINT {savepoint};")
+    depths[database] = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        depths[database] = depth
+        if depth == 0:
+            conn.rollback()
+        else:
+            conn.execute(f"ROLLBACK TO {savepoint};")
+            conn.execute(f"RELEASE {savepoint};")
+        raise
+    else:
+        depths[database] = depth
+        if depth == 0:
+            conn.commit()
+        else:
+            conn.execute(f"RELEASE {savepoint};")
+
+
+def quote_identifier(name: str) -> str:
+    """
+    Quotes a table or column name (which may contain spaces, newlines or quotes) for use in SQL.
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
 def db_query_fetch(query, params):
     """
     The function `db_query_fetch` executes an SQL query with parameters and returns the results as a
@@ -25,35 +136,330 @@ def db_query_fetch(query, params):
     database query.
     """
     conn = get_db_conn()
+    cur = conn.cursor()
     try:
-        cur = conn.cursor()
         res = cur.execute(query, params)
         colname = [ d[0] for d in res.description ]
         data = [ dict(zip(colname, r)) for r in res.fetchall() ]
-        cur.close()
         return data
-    except Exception as e:
-        raise e
+    finally:
+        cur.close()
+
+def db_query_iter(query, params, batch_size: int = 500, timeout: float = None, cancel: threading.Event = None, read_only: bool = False):
+    """
+    Generator version of `db_query_fetch`, yields the results in lists of at most `batch_size`
+    dictionaries while the statement is still stepping, so the full result is never held in memory.
+    It runs on a dedicated connection (a WAL snapshot) that is closed when the generator finishes
+    or is closed, so the caller's thread connection stays free for writes in between batches.
+    With a `timeout` (seconds) or a `cancel` event, the sqlite3 progress handler interrupts the
+    statement once the deadline passes (raising TimeoutError) or the event is set (raising InterruptedError).
+    With `read_only`, the connection refuses any write (PRAGMA query_only), a statement that would
+    change the database raises sqlite3.OperationalError instead. The database is the one of the caller's scope. The connection belongs to the thread that first
+    advances the generator, which must also be the one to finish or close it (see `db_query_stream`).
+    """
+    return _query_iter(current_db(), query, params, batch_size, timeout, cancel, read_only)
+
+def _query_iter(database: str, query, params, batch_size: int, timeout: float, cancel: threading.Event, read_only: bool = False):
+    conn = _open_db_conn(database)
+    if read_only:
+        conn.execute("PRAGMA query_only = ON;")
+    deadline = perf_counter() + timeout if timeout is not None else None
+    if deadline is not None or cancel is not None:
+        def should_interrupt():
+            return (cancel is not None and cancel.is_set()) or (deadline is not None and perf_counter() > deadline)
+        conn.set_progress_handler(should_interrupt, PROGRESS_HANDLER_OPS)
+    try:
+        cur = conn.execute(query, params)
+        colname = [ d[0] for d in cur.description ] if cur.description is not None else []
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield [ dict(zip(colname, r)) for r in rows ]
+        cur.close()
+    except sqlite3.OperationalError as e:
+        if cancel is not None and cancel.is_set():
+            raise InterruptedError("Query was cancelled") from e
+        if deadline is not None and perf_counter() > deadline:
+            raise TimeoutError(f"Query was interrupted after exceeding {timeout} seconds") from e
+        raise
     finally:
         conn.close()
 
+def db_query_stream(query, params, batch_size: int = 500, timeout: float = None, cancel: threading.Event = None, prefetch: int = 2) -> queue.Queue:
+    """
+    Runs `db_query_iter` on a dedicated thread and returns a queue receiving its batches, then None
+    once the result is exhausted (or the exception that stopped the query). The sqlite connection is
+    opened, stepped and closed on that one thread, so the caller can poll the queue from any thread.
+    At most `prefetch` batches wait in the queue. Setting `cancel` interrupts a running statement,
+    or stops the thread at its next batch, e.g. once the caller has read enough rows
+    """
+    cancel = cancel if cancel is not None else threading.Event()
+    batches = queue.Queue(maxsize=prefetch)
+    database = current_db()
+
+    def put(item):
+        # waits for room in the queue, unless the reader has gone away
+        while not cancel.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        chunks = _query_iter(database, query, params, batch_size, timeout, cancel)
+        try:
+            for batch in chunks:
+                if not put(batch):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            chunks.close()
+
+    threading.Thread(target=produce, name="chronomodeler-query-stream", daemon=True).start()
+    return batches
+
+def db_query_plan(query, params):
+    """
+    Returns the rows of EXPLAIN QUERY PLAN for the query (id, parent, detail), without running it
+    """
+    return db_query_fetch(f"EXPLAIN QUERY PLAN {query}", params)
+
+class _WriteRequest:
+    """
+    One queued write: either a function of the writer's connection, or a single statement
+    (sql, params) which may be coalesced with identical statements into one executemany
+    """
+
+    def __init__(self, fn = None, sql: str = None, params = ()):
+        self.fn = fn
+        self.sql = sql
+        self.params = params
+        self.future = Future()
+        self.enqueued_at = perf_counter()
+
+    def run(self, conn):
+        if self.fn is not None:
+            return self.fn(conn)
+        conn.execute(self.sql, self.params)
+
+
+class DBWriter:
+    """
+    The single writer of a database file. Sessions put their writes on a bounded queue and get
+    a future back; a dedicated thread takes them in batches of up to `DB_WRITE_BATCH_SIZE`
+    and commits each batch as one transaction (group commit), so the sessions never contend
+    for the write lock. Every write of a batch runs in its own savepoint, so a failing write
+    only fails its own future. Consecutive identical statements are coalesced into a single
+    executemany. A full queue blocks the callers (backpressure), which shows in `stats()`.
+    Reads are not queued, they keep running concurrently on WAL snapshots.
+    """
+
+    def __init__(
+            self,
+            database: str,
+            maxsize: int = DB_WRITE_QUEUE_SIZE,
+            batch_size: int = DB_WRITE_BATCH_SIZE,
+            batch_wait_ms: float = DB_WRITE_BATCH_WAIT_MS
+        ):
+        self.database = database
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.lock = threading.Lock()
+        self.thread = None
+        self.metrics = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'batches': 0,
+            'coalesced': 0,
+            'blocked_puts': 0,
+            'blocked_seconds': 0.0,
+            'max_queue_depth': 0,
+            'queue_wait_seconds': 0.0,
+            'commit_seconds': 0.0
+        }
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name=f"chronomodeler-db-writer-{len(_db_writers)}", daemon=True)
+                self.thread.start()
+
+    def submit(self, request: _WriteRequest) -> Future:
+        self.start()
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            start = perf_counter()
+            try:
+                self.queue.put(request, timeout=DB_WRITE_PUT_TIMEOUT)
+            except queue.Full:
+                raise TimeoutError(f"Database write queue is full ({self.queue.maxsize} pending writes)")
+            finally:
+                with self.lock:
+                    self.metrics['blocked_puts'] += 1
+                    self.metrics['blocked_seconds'] += perf_counter() - start
+        with self.lock:
+            self.metrics['submitted'] += 1
+            self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], self.queue.qsize())
+        return request.future
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = perf_counter() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get(timeout=max(deadline - perf_counter(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _groups(batch):
+        # runs of identical statements become one group, everything else is a group of one
+        groups = []
+        for request in batch:
+            if request.sql is not None and len(groups) > 0 and groups[-1][0].sql == request.sql:
+                groups[-1].append(request)
+            else:
+                groups.append([request])
+        return groups
+
+    def _run_group(self, conn, group):
+        """
+        Runs a group in savepoints and returns the (request, result, exception) outcomes,
+        the futures are only resolved once the whole batch has committed
+        """
+        if len(group) > 1:
+            try:
+                with db_transaction():
+                    conn.executemany(group[0].sql, [request.params for request in group])
+                with self.lock:
+                    self.metrics['coalesced'] += len(group) - 1
+                return [(request, None, None) for request in group]
+            except Exception:
+                pass    # fall back to one statement at a time, to fail only the offending ones
+        outcomes = []
+        for request in group:
+            try:
+                with db_transaction():
+                    outcomes.append((request, request.run(conn), None))
+            except Exception as e:
+                outcomes.append((request, None, e))
+        return outcomes
+
+    def _run(self):
+        _local.is_writer = True
+        with db_scope(self.database):
+            self._run_batches()
+
+    def _run_batches(self):
+        while True:
+            batch = self._next_batch()
+            started = perf_counter()
+            outcomes = []
+            try:
+                with db_transaction() as conn:
+                    for group in self._groups(batch):
+                        outcomes.extend(self._run_group(conn, group))
+            except Exception as e:
+                # the commit itself failed, none of the writes of the batch are durable
+                outcomes = [(request, None, e) for request in batch]
+            finished = perf_counter()
+            with self.lock:
+                self.metrics['batches'] += 1
+                self.metrics['commit_seconds'] += finished - started
+                for request, _, error in outcomes:
+                    self.metrics['queue_wait_seconds'] += started - request.enqueued_at
+                    self.metrics['failed' if error is not None else 'completed'] += 1
+            for request, result, error in outcomes:
+                if error is not None:
+                    request.future.set_exception(error)
+                else:
+                    request.future.set_result(result)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.metrics)
+        done = stats['completed'] + stats['failed']
+        stats['queue_depth'] = self.queue.qsize()
+        stats['queue_capacity'] = self.queue.maxsize
+        stats['avg_batch_size'] = done / stats['batches'] if stats['batches'] > 0 else 0
+        stats['avg_queue_wait_ms'] = stats['queue_wait_seconds'] / done * 1000 if done > 0 else 0
+        stats['avg_commit_ms'] = stats['commit_seconds'] / stats['batches'] * 1000 if stats['batches'] > 0 else 0
+        return stats
+
+
+# one writer per database file, so the writes to different files (user shards) run in parallel
+_db_writers = {}
+_db_writers_lock = threading.Lock()
+
+def get_db_writer(database: str = None) -> DBWriter:
+    database = database or current_db()
+    with _db_writers_lock:
+        if database not in _db_writers:
+            _db_writers[database] = DBWriter(database)
+        return _db_writers[database]
+
+
+def _write_directly():
+    # inside a transaction (or on a writer itself) queueing would wait on our own lock
+    return not DB_WRITER_ENABLED or _depths().get(current_db(), 0) > 0 or getattr(_local, "is_writer", False)
+
+
+def db_submit(fn) -> Future:
+    """
+    Queues `fn(conn)` on the database writer and returns a future of its result,
+    resolved once the batch holding it has committed
+    """
+    if _write_directly():
+        future = Future()
+        try:
+            with db_transaction() as conn:
+                future.set_result(fn(conn))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return get_db_writer().submit(_WriteRequest(fn=fn))
+
+
+def db_write(fn):
+    """
+    Runs `fn(conn)` as one atomic write through the database writer, waits for
+    the commit and returns the result of `fn` (or raises its exception)
+    """
+    return db_submit(fn).result()
+
+
+def db_writer_stats() -> dict:
+    """
+    The statistics of every database writer, by database file
+    """
+    with _db_writers_lock:
+        writers = list(_db_writers.values())
+    return { writer.database: writer.stats() for writer in writers }
+
+
 def db_query_execute(query, params):
     """
     This function executes a database query with parameters and handles exceptions and transactions.
+    The statement is committed by the database writer, waiting for it to be durable.
     @param query - a string containing the SQL query to be executed
     @param params - params is a tuple or dictionary containing the values to be substituted in the
     query. These values are used to prevent SQL injection attacks and to ensure that the query is
     executed correctly. The values are substituted in the query using placeholders, such as "?" or
     ":param_name".
     """
-    conn = get_db_conn()
-    try:
-        res = conn.execute(query, params)
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        conn.close()
+    if _write_directly():
+        with db_transaction() as conn:
+            conn.execute(query, params)
+        return
+    get_db_writer().submit(_WriteRequest(sql=query, params=params)).result()
 
 
@@ -1,4 +1,4 @@
-from typing import Dict, List
+from typing import Callable, Dict, List
 from barfi import Block
 import pandas as pd
 import pickle
@@ -12,7 +12,9 @@ from chronomodeler.preprocessor import (
 )
 from chronomodeler.chronomodel import ChronoModel
 from chronomodeler.models import User, UserAuthLevel, Experiment, Simulation
-from chronomodeler.apimethods import get_simulation_experiment_data
+from chronomodeler.apimethods import get_simulation_experiment_data, get_simulation_experiments_data
+from chronomodeler.asyncapi import submit
+from chronomodeler.jobs import job_key, dataframe_fingerprint
 
 class ExperimentConfig:
     """
@@ -327,12 +329,66 @@ def perform_transformations(expconf: ExperimentConfig, df, root = None):
         raise NotImplementedError(f"Invalid node type {nodeconfig['type']}")
     
 
+def experiment_output_ordinal(parameter):
+    """
+        The ordinal of the upstream experiment referred by an "Experiment Output" method,
+        the modelling block stores its parameters as a list of numbers
+    """
+    if isinstance(parameter, (list, tuple)):
+        parameter = parameter[0]
+    return int(parameter)
+
+
+def get_upstream_ordinals(variables: Dict):
+    return [
+        experiment_output_ordinal(variables[col].get("parameter"))
+        for col in variables if variables[col].get("method") == "Experiment Output"
+    ]
+
+
+def experiment_run_params(train_dates: List[dt.datetime], test_dates: List[dt.datetime], pred_dates: List[dt.datetime]) -> Dict[str, List[str]]:
+    """
+        The date ranges of a run, as stored with the experiment so that it can be run again
+    """
+    return {
+        name: [convert_to_datetime(d).strftime('%Y-%m-%d') for d in dates]
+        for name, dates in [('train_dates', train_dates), ('test_dates', test_dates), ('pred_dates', pred_dates)]
+    }
+
+
+def run_params_dates(run_params: Dict[str, List[str]]):
+    """
+        The (train, test, prediction) date ranges of stored run parameters
+    """
+    return tuple(
+        [convert_to_datetime(d) for d in run_params[name]] for name in ['train_dates', 'test_dates', 'pred_dates']
+    )
+
+
+def experiment_input_hash(
+        expconf: ExperimentConfig,
+        run_params: Dict[str, List[str]],
+        df: pd.DataFrame,
+        upstream_data: Dict[int, pd.DataFrame]
+    ) -> str:
+    """
+        Content hash of everything a run depends on: the config, the run parameters, the columns of
+        the simulation data used by the experiment and the outputs of its upstream experiments.
+        An experiment whose hash did not change would produce the same result when run again
+    """
+    var_details = expconf.get_variables_list()
+    collist = [col for col in list(var_details) + ['Time', 'TimeIndex'] if col in df.columns]
+    upstream = { str(ordinal): dataframe_fingerprint(upstream_data[ordinal]) for ordinal in sorted(upstream_data) }
+    return job_key("experiment-inputs", expconf.config, run_params, dataframe_fingerprint(df[collist]), upstream)
+
+
 def create_pred_df(
         pred_date: dt.datetime, 
         data_freq: str, 
         variables: List[str], 
         total_df: pd.DataFrame,
-        selected_sim: Simulation
+        selected_sim: Simulation,
+        upstream_data: Dict[int, pd.DataFrame] = None
     ):
     BACK_WINDOW = 5
     prev_dates = prev_date_list(pred_date, data_freq, n = BACK_WINDOW)        
@@ -368,7 +424,11 @@ def create_pred_df(
                     prev_d = prev_date_list(d, data_freq, n = 1 + int(offset) )[0]
                     row[col] = get_data_cell_value(new_data, new_data['Time'] == prev_d, col) * (1 + convert_annual_growth_rate(growth_rate, data_freq) )**offset
                 elif method == "Experiment Output":
-                    prev_exp_df = get_simulation_experiment_data(selected_sim, selected_sim.userid, int(parameter))
+                    ordinal = experiment_output_ordinal(parameter)
+                    if upstream_data is not None and ordinal in upstream_data:
+                        prev_exp_df = upstream_data[ordinal]
+                    else:
+                        prev_exp_df = get_simulation_experiment_data(selected_sim, selected_sim.userid, ordinal)
                     row[col] = get_data_cell_value(prev_exp_df, prev_exp_df['Time'] == d, col)
                 else:
                     raise NotImplementedError("Invalid prediction model method")  
@@ -389,10 +449,25 @@ def run_experiment(
         train_dates: List[dt.datetime], 
         test_dates: List[dt.datetime],
         pred_dates: List[dt.datetime],
-        selected_sim: Simulation
+        selected_sim: Simulation,
+        progress: Callable[[float, str], None] = None,
+        upstream_data: Dict[int, pd.DataFrame] = None
     ):
+    """
+        Fits the model of the experiment and predicts the prediction dates. `progress(fraction, message)`,
+        if given, is called after every step (e.g. by a background job, which may raise from it to stop the run).
+        The outputs of the upstream experiments are loaded unless the caller already has them in `upstream_data`
+    """
+    if progress is None:
+        progress = lambda fraction, message: None
+    # the upstream experiment outputs are loaded while the model is being fit
+    var_details = expconf.get_variables_list()
+    if upstream_data is None:
+        upstream_load = submit(get_simulation_experiments_data, selected_sim, selected_sim.userid, get_upstream_ordinals(var_details))
+
     # Step 1: Apply the transformations
     output = perform_transformations(expconf, df)
+    progress(0.1, "Transformed the data")
 
     # Step 2: Split into training, testing data
     train_df = train_test_split(output['data'], train_dates).dropna().reset_index(drop = True)
@@ -410,19 +485,24 @@ def run_experiment(
     mod.fit_model(X_train, y_train)
     error_df = mod.predict_model(X_test, y_test)
     fit_results = mod.metrics
+    progress(0.4, "Fitted and tested the model")
 
     # Step 4: Fit Model on train + test data
     new_train_df = train_test_split(output['data'], [train_dates[0], test_dates[1]]).dropna().reset_index(drop = True)
     mod.fit_model(new_train_df[features], new_train_df[target], update_metrics=False)
+    progress(0.55, "Refitted the model on the training and testing data")
     
     # Step 5: Perform prediction
     data_freq = guess_data_frequency(df['Time'])
     pred_date_list = get_date_list(pred_dates, data_freq)
-    var_details = expconf.get_variables_list()
+    if upstream_data is None:
+        upstream_data = upstream_load.result()
+    progress(0.6, "Predicting")
 
     total_df = df[[var for var in var_details] + ['Time', 'TimeIndex']].copy(deep = True)  # includes existing projection as well if present    
-    for pred_date in pred_date_list:
-        pred_df = create_pred_df(pred_date, data_freq, var_details, total_df, selected_sim)  # last row is to be predicted, previous rows may come from existing predicted data / known data
+    for i, pred_date in enumerate(pred_date_list):
+        progress(0.6 + 0.4 * i / len(pred_date_list), f"Predicting {i + 1} of {len(pred_date_list)}")
+        pred_df = create_pred_df(pred_date, data_freq, var_details, total_df, selected_sim, upstream_data)  # last row is to be predicted, previous rows may come from existing predicted data / known data
         pred_transform = perform_transformations(expconf, pred_df)
         predictions = mod.predict_model(pred_transform['data'][pred_transform['features']].dropna().reset_index(drop = True))            
         predval = predictions.iloc[predictions.shape[0] - 1]['Prediction']
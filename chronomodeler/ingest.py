@@ -0,0 +1,144 @@
+# ============================================
+#       Parsing of uploaded data files (CSV, Parquet, Excel)
+# ============================================
+
+import io, os, hashlib, importlib.util
+from typing import Dict, List, Tuple, Union
+from collections import OrderedDict
+from threading import Lock
+import pandas as pd
+
+from chronomodeler.constants import INGEST_CACHE_SIZE, INGEST_CSV_CHUNK_SIZE, INGEST_DTYPE_SAMPLE_ROWS
+
+INGEST_FORMATS = ["csv", "parquet", "xlsx", "xls"]
+
+# parsed sheets by (content hash, sheet name), the same upload is parsed only once across reruns
+_parsed: "OrderedDict[tuple, pd.DataFrame]" = OrderedDict()
+_sheet_names: "OrderedDict[str, List[str]]" = OrderedDict()
+_lock = Lock()
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()    # hardware accelerated on most CPUs, faster than blake2b / md5
+
+
+def detect_format(data: bytes, filename: str = "") -> str:
+    """
+        Format of the upload from the file extension, falling back to its magic bytes
+        when the name has no known extension
+    """
+    ext = os.path.splitext(filename)[1].lower().lstrip(".")
+    if ext in INGEST_FORMATS:
+        return ext
+    if data[:4] == b"PAR1":
+        return "parquet"
+    if data[:4] == b"PK\x03\x04":   # zip container
+        return "xlsx"
+    if data[:8] == b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1":     # OLE2 container
+        return "xls"
+    return "csv"
+
+
+def list_sheets(data: bytes, filename: str = "") -> List[str]:
+    """
+        Sheet names of an Excel upload, an empty list for the single table formats
+    """
+    if detect_format(data, filename) not in ("xlsx", "xls"):
+        return []
+    key = content_hash(data)
+    with _lock:
+        if key in _sheet_names:
+            return _sheet_names[key]
+    names = pd.ExcelFile(io.BytesIO(data)).sheet_names
+    with _lock:
+        _sheet_names[key] = names
+        while len(_sheet_names) > INGEST_CACHE_SIZE:
+            _sheet_names.popitem(last = False)
+    return names
+
+
+# integer formats of dates (years, year months, full dates), columns of such values are kept as text
+INTEGER_DATE_FORMATS = ["%Y", "%Y%m", "%Y%m%d"]
+
+
+def _integer_dates(values: pd.Series) -> bool:
+    if not values.str.fullmatch(r"\d+").all():
+        return False
+    return any([
+        bool(pd.to_datetime(values, format = fmt, errors = "coerce").notna().all())
+        for fmt in INTEGER_DATE_FORMATS
+    ])
+
+
+def infer_csv_dtypes(data: bytes, sample_rows: int = INGEST_DTYPE_SAMPLE_ROWS, time_col: Union[str, None] = None) -> Tuple[Dict[str, str], bool]:
+    """
+        Column dtypes from the first rows: float64 for the measure columns that are numeric
+        (thousands separators allowed), object for the rest. The time column (`time_col`, and any
+        column of integers that read as dates, e.g. years) stays object so its values are parsed as
+        dates later on, not as numbers. Also returns whether the numbers use thousands separators
+    """
+    sample = pd.read_csv(io.BytesIO(data), nrows=sample_rows, dtype=str, keep_default_na=False)
+    dtypes = {}
+    thousands = False
+    for col in sample.columns:
+        values = sample[col].str.strip()
+        values = values[values != ""]
+        plain = values.str.replace(",", "", regex=False)
+        numeric = pd.to_numeric(plain, errors="coerce")
+        measure = col != time_col and not _integer_dates(values)
+        dtypes[col] = "float64" if measure and len(values) > 0 and not numeric.isna().any() else "object"
+        thousands = thousands or (dtypes[col] == "float64" and bool((plain != values).any()))
+    return dtypes, thousands
+
+
+def read_csv(data: bytes, chunksize: int = INGEST_CSV_CHUNK_SIZE, time_col: Union[str, None] = None) -> pd.DataFrame:
+    """
+        Reads the CSV with the dtypes inferred from its first rows, so the parser neither
+        guesses per chunk nor keeps mixed type columns. Uses the multithreaded pyarrow parser
+        when it is installed and the numbers have no thousands separators, otherwise the C parser
+        in chunks of `chunksize` rows. Falls back to a plain read if a later row does not fit the inferred dtypes
+    """
+    dtypes, thousands = infer_csv_dtypes(data, time_col=time_col)
+    try:
+        if not thousands and importlib.util.find_spec("pyarrow") is not None:
+            return pd.read_csv(io.BytesIO(data), dtype=dtypes, engine="pyarrow")
+        chunks = pd.read_csv(io.BytesIO(data), dtype=dtypes, thousands=",", chunksize=chunksize)
+        return pd.concat(chunks, ignore_index=True)
+    except ValueError:
+        return pd.read_csv(io.BytesIO(data), thousands=",", low_memory=False, dtype={ col: dtype for col, dtype in dtypes.items() if dtype == "object" })
+
+
+def _parse(data: bytes, fmt: str, sheet_name: Union[str, None], time_col: Union[str, None] = None) -> pd.DataFrame:
+    if fmt == "csv":
+        return read_csv(data, time_col=time_col)
+    elif fmt == "parquet":
+        try:
+            return pd.read_parquet(io.BytesIO(data))
+        except ImportError as e:
+            raise ValueError("Reading Parquet files needs pyarrow or fastparquet to be installed") from e
+    else:
+        return pd.read_excel(io.BytesIO(data), sheet_name=sheet_name if sheet_name is not None else 0)
+
+
+def read_upload(data: bytes, filename: str = "", sheet_name: Union[str, None] = None, time_col: Union[str, None] = None) -> pd.DataFrame:
+    """
+        Parses an uploaded CSV, Parquet or Excel file (the given sheet, else the first one),
+        a CSV `time_col` is kept as text.
+        Parsed tables are cached by the hash of the bytes, so reruns and re-uploads of the same
+        file do not parse it again. The frame is a shallow copy of the cached one, callers
+        may add or replace columns but must not modify the values in place
+    """
+    fmt = detect_format(data, filename)
+    key = (content_hash(data), sheet_name if fmt in ("xlsx", "xls") else None, time_col if fmt == "csv" else None)
+    with _lock:
+        df = _parsed.get(key)
+        if df is not None:
+            _parsed.move_to_end(key)
+            return df.copy(deep = False)
+    df = _parse(data, fmt, sheet_name, time_col)
+    with _lock:
+        _parsed[key] = df
+        _parsed.move_to_end(key)
+        while len(_parsed) > INGEST_CACHE_SIZE:
+            _parsed.popitem(last = False)
+    return df.copy(deep = False)
@@ -0,0 +1,207 @@
+# ============================================
+#       Background jobs: long running work (e.g. experiment runs) on a local
+#       worker pool, tracked in the jobs table, with results persisted to disk
+# ============================================
+
+import os, json, pickle, hashlib, traceback, threading
+from typing import Any, Callable, Set, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+import pandas as pd
+
+from chronomodeler.constants import JOB_WORKERS, JOB_RESULT_DIR, JOB_RESULT_CACHE_SIZE, JOB_PROGRESS_INTERVAL, \
+    JOB_RESULT_MAX_FILES, JOB_RESULT_MAX_BYTES
+from chronomodeler.dbutils import db_scope, current_db
+from chronomodeler.models import Job, JobStatus
+
+
+_executor: Union[ThreadPoolExecutor, None] = None
+_executor_lock = Lock()
+_cancelled: Set[int] = set()    # jobids asked to stop, checked by the workers
+_results: "OrderedDict[str, Any]" = OrderedDict()   # unpickled results by job key
+_results_lock = Lock()
+_files_lock = Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """
+        The worker pool, created on first use. Jobs still queued or running at that point
+        were left behind by a previous process (nothing can run here yet), they are marked as failed
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            Job.interrupt_active()
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="chronomodeler-job")
+        return _executor
+
+
+def job_key(kind: str, *parts) -> str:
+    """
+        Identifies a job by what it computes: the same kind and parts give the same key,
+        so a rerun finds the job (and its result) instead of computing it again
+    """
+    payload = json.dumps([kind, *parts], default=str, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def dataframe_fingerprint(df: pd.DataFrame) -> str:
+    """
+        Hash of the columns and values of a data frame, for use in job keys
+    """
+    values = pd.util.hash_pandas_object(df, index=True).values
+    return hashlib.sha256(values.tobytes() + json.dumps([str(col) for col in df.columns]).encode("utf-8")).hexdigest()
+
+
+class JobProgress:
+    """
+        Callable handed to a job function, `progress(fraction, message)` records how far
+        the job got (at most every JOB_PROGRESS_INTERVAL seconds) and raises InterruptedError
+        once the job has been cancelled
+    """
+
+    def __init__(self, jobid: int):
+        self.jobid = jobid
+        self._last_write = 0.0
+
+    def __call__(self, fraction: float, message: str = ""):
+        if self.jobid in _cancelled:
+            raise InterruptedError(f"Job {self.jobid} was cancelled")
+        now = time()
+        if now - self._last_write >= JOB_PROGRESS_INTERVAL:
+            self._last_write = now
+            Job.set_progress(self.jobid, min(max(float(fraction), 0.0), 1.0), message)
+
+
+def _result_path(key: str) -> str:
+    return os.path.join(JOB_RESULT_DIR, key + ".pkl")
+
+
+def _write_result(key: str, result) -> str:
+    os.makedirs(JOB_RESULT_DIR, exist_ok=True)
+    path = _result_path(key)
+    tmp_path = path + f".{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with _files_lock:
+        os.replace(tmp_path, path)     # readers never see a partial file
+        _evict_results()
+    return path
+
+
+def _evict_results(max_files: int = JOB_RESULT_MAX_FILES, max_bytes: int = JOB_RESULT_MAX_BYTES):
+    """
+        Deletes the least recently used result files (by modification time, refreshed on every load)
+        beyond `max_files` files or `max_bytes`. Their jobs run again when the result is next asked for
+    """
+    entries = []
+    for name in os.listdir(JOB_RESULT_DIR):
+        if not name.endswith(".pkl"):
+            continue
+        try:
+            stat = os.stat(os.path.join(JOB_RESULT_DIR, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total_bytes = sum([size for _, size, _ in entries])
+    nfiles = len(entries)
+    for _, size, name in entries:
+        if nfiles <= max_files and total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(JOB_RESULT_DIR, name))
+        except FileNotFoundError:
+            pass
+        nfiles -= 1
+        total_bytes -= size
+
+
+def _run(jobid: int, key: str, fn: Callable[[JobProgress], Any], database: str):
+    if jobid in _cancelled:
+        _cancelled.discard(jobid)
+        return
+    start = time()
+    try:
+        # inside the try, a failed status write (e.g. a locked database) fails the job instead of leaving it queued
+        Job.set_status(jobid, JobStatus.RUNNING, started_at=start, message="Started")
+        with db_scope(database):
+            result = fn(JobProgress(jobid))
+        path = _write_result(key, result)
+    except InterruptedError:
+        Job.set_status(jobid, JobStatus.CANCELLED, message="Cancelled", finished_at=time(), elapsed=time() - start)
+        return
+    except Exception:
+        Job.set_status(jobid, JobStatus.FAILED, error=traceback.format_exc(), finished_at=time(), elapsed=time() - start)
+        return
+    finally:
+        _cancelled.discard(jobid)
+    with _results_lock:
+        _results.pop(key, None)     # a rerun of a failed key replaces any older result
+    Job.set_status(
+        jobid, JobStatus.SUCCEEDED, progress=1.0, message="Done", result_path=path,
+        finished_at=time(), elapsed=time() - start
+    )
+
+
+def submit_job(kind: str, key: str, fn: Callable[[JobProgress], Any], userid: int = None, simid: int = None) -> Job:
+    """
+        Runs `fn(progress)` on the worker pool as the job of `key`, unless that job is already
+        queued, running or done, in which case it is returned as is (the caller reattaches to it).
+        Failed or cancelled jobs are run again. `fn` runs against the database of the caller's scope
+        and its result must be picklable
+    """
+    executor = _get_executor()
+    job, created = Job.claim(key, kind, userid, simid)
+    if created:
+        executor.submit(_run, job.jobid, key, fn, current_db())
+    return job
+
+
+def get_job(jobid: int) -> Union[Job, None]:
+    return Job.get(jobid)
+
+
+def find_job(key: str) -> Union[Job, None]:
+    _get_executor()     # recovers the jobs of a previous process before they are looked at
+    return Job.get_by_key(key)
+
+
+def cancel_job(jobid: int):
+    """
+        Stops a queued job before it starts, or a running one at its next progress report
+    """
+    job = Job.get(jobid, columns=["status"])
+    if job is None or job.status not in Job.ACTIVE_STATUSES:
+        return
+    _cancelled.add(jobid)
+    if job.status == JobStatus.QUEUED.value:
+        Job.set_status(jobid, JobStatus.CANCELLED, message="Cancelled")
+
+
+def load_job_result(job: Job):
+    """
+        The result of a succeeded job, read from disk once and then kept in a small LRU.
+        Returns None (and marks the job failed so that it runs again) when the result file is gone,
+        e.g. evicted by `_evict_results`
+    """
+    with _results_lock:
+        if job.job_key in _results:
+            _results.move_to_end(job.job_key)
+            return _results[job.job_key]
+    path = job.result_path or _result_path(job.job_key)
+    try:
+        with open(path, "rb") as f:
+            result = pickle.load(f)
+        os.utime(path)  # mark as recently used
+    except FileNotFoundError:
+        Job.set_status(job.jobid, JobStatus.FAILED, error=f"The result file {path} is missing")
+        return None
+    with _results_lock:
+        _results[job.job_key] = result
+        while len(_results) > JOB_RESULT_CACHE_SIZE:
+            _results.popitem(last = False)
+    return result
+
@@ -0,0 +1,179 @@
+# ============================================
+#       Versioned schema migrations
+# ============================================
+
+from typing import Callable, List, Tuple
+from time import time
+
+from chronomodeler.models import User, Simulation, Experiment, Job
+from chronomodeler.dbutils import db_query_fetch, db_query_execute, db_transaction, db_scope, db_write
+from chronomodeler.constants import SQLITE_DB, SHARD_ID_BITS
+from chronomodeler.apimethods import list_simulation_data_tables, ensure_data_table_indexes
+from chronomodeler.storage import create_partition_delta_table
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+
+def create_base_tables(conn):
+    User.create_table()
+    Simulation.create_table()
+    Experiment.create_table()
+
+
+def create_model_indexes(conn):
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_experiments_simid_initial ON {Experiment._table}(simid, initial);")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_simulations_userid ON {Simulation._table}(userid);")
+
+
+def create_data_table_indexes(conn):
+    for table_name in list_simulation_data_tables():
+        ensure_data_table_indexes(table_name)
+
+
+def add_experiment_ordinals(conn):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({Experiment._table});").fetchall()]
+    if "ordinal" not in columns:
+        conn.execute(f"ALTER TABLE {Experiment._table} ADD COLUMN ordinal integer;")
+    conn.execute(f"UPDATE {Experiment._table} SET ordinal = ( \
+        SELECT r.rn FROM ( \
+            SELECT expid, ROW_NUMBER() OVER (PARTITION BY simid ORDER BY expid) AS rn FROM {Experiment._table} \
+        ) r WHERE r.expid = {Experiment._table}.expid \
+    ) WHERE ordinal IS NULL;")
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_experiments_simid_ordinal ON {Experiment._table}(simid, ordinal);")
+
+
+def add_experiment_rerun_columns(conn):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({Experiment._table});").fetchall()]
+    if "run_params" not in columns:
+        conn.execute(f"ALTER TABLE {Experiment._table} ADD COLUMN run_params text;")
+    if "input_hash" not in columns:
+        conn.execute(f"ALTER TABLE {Experiment._table} ADD COLUMN input_hash varchar(64);")
+
+
+def create_fts_index(conn, model):
+    """
+        FTS5 index over the searchable columns of the model, stored as an external content
+        table (no copy of the text) and kept in sync with the base table by triggers
+    """
+    cols = ', '.join(model._searchcols)
+    newcols = ', '.join(['new.' + col for col in model._searchcols])
+    oldcols = ', '.join(['old.' + col for col in model._searchcols])
+    fts, table, identity = model._fts_table, model._table, model._identity
+    conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5( \
+        {cols}, content='{table}', content_rowid='{identity}', prefix='1 2 3', tokenize='unicode61' \
+    );")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN \
+        INSERT INTO {fts}(rowid, {cols}) VALUES (new.{identity}, {newcols}); \
+    END;")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN \
+        INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{identity}, {oldcols}); \
+    END;")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN \
+        INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{identity}, {oldcols}); \
+        INSERT INTO {fts}(rowid, {cols}) VALUES (new.{identity}, {newcols}); \
+    END;")
+    conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild');")   # index the existing rows
+
+
+def create_search_indexes(conn):
+    create_fts_index(conn, Simulation)
+    create_fts_index(conn, Experiment)
+
+
+def create_jobs_table(conn):
+    Job.create_table()
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_jobs_userid_created_at ON {Job._table}(userid, created_at);")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_jobs_status ON {Job._table}(status);")
+
+
+# ordered list of (version, description, step), a step receives the connection
+# and runs inside the same transaction that records its version
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "Create users, simulations and experiments tables", create_base_tables),
+    (2, "Index experiments(simid, initial) and simulations(userid)", create_model_indexes),
+    (3, "Index experiment_id, Time on every simulation data table", create_data_table_indexes),
+    (4, "Add a stable per simulation ordinal to experiments", add_experiment_ordinals),
+    (5, "Full text search indexes for simulations and experiments", create_search_indexes),
+    (6, "Metadata of delta encoded experiment partitions", create_partition_delta_table),
+    (7, "Background jobs table", create_jobs_table),
+    (8, "Run parameters and input hash of experiments", add_experiment_rerun_columns),
+    (9, "Per simulation counter of experiment ordinals", Experiment.create_ordinals_table),
+]
+
+
+# ============================================
+#       Schema of a user shard (experiments and simulation data tables)
+# ============================================
+
+def create_shard_experiments_table(conn):
+    Experiment.create_table(foreign_keys=False)
+
+
+def create_shard_experiment_indexes(conn):
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_experiments_simid_initial ON {Experiment._table}(simid, initial);")
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_experiments_simid_ordinal ON {Experiment._table}(simid, ordinal);")
+
+
+SHARD_MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "Create the experiments table", create_shard_experiments_table),
+    (2, "Index experiments(simid, initial) and experiments(simid, ordinal)", create_shard_experiment_indexes),
+    (3, "Full text search index for experiments", lambda conn: create_fts_index(conn, Experiment)),
+    (4, "Metadata of delta encoded experiment partitions", create_partition_delta_table),
+    (5, "Run parameters and input hash of experiments", add_experiment_rerun_columns),
+    (6, "Per simulation counter of experiment ordinals", Experiment.create_ordinals_table),
+]
+
+
+def get_schema_version() -> int:
+    db_query_execute(f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} ( \
+        version integer primary key, \
+        description varchar not null, \
+        applied_at integer not null \
+    );", ())
+    rows = db_query_fetch(f"SELECT MAX(version) AS version FROM {SCHEMA_VERSION_TABLE};", ())
+    return rows[0]['version'] if len(rows) > 0 and rows[0]['version'] is not None else 0
+
+
+def _apply_migrations(migrations: List[Tuple[int, str, Callable]], target: int = None, label: str = "schema") -> int:
+    current = get_schema_version()
+    applied = False
+    for version, description, step in migrations:
+        if version <= current or (target is not None and version > target):
+            continue
+        print(f"Applying {label} migration {version}: {description}")
+        with db_transaction() as conn:
+            step(conn)
+            conn.execute(
+                f"INSERT INTO {SCHEMA_VERSION_TABLE}(version, description, applied_at) VALUES (?, ?, ?);",
+                (version, description, int(time()))
+            )
+        current = version
+        applied = True
+    if applied:
+        # the writer's connection may predate the new tables, with foreign keys on a stale schema breaks
+        # the FTS triggers ("no such table: experiments" on delete), so it reloads the schema right away
+        db_write(lambda conn: conn.execute("SELECT COUNT(1) FROM sqlite_master;").fetchone())
+    return current
+
+
+def run_migrations(target: int = None) -> int:
+    """
+        Applies every migration newer than the recorded schema version of the main database
+        (up to `target` if given), each one in its own transaction.
+        Returns the resulting schema version
+    """
+    with db_scope(SQLITE_DB):
+        return _apply_migrations(MIGRATIONS, target)
+
+
+def run_shard_migrations(userid: int, target: int = None) -> int:
+    """
+        Same as `run_migrations` for the shard of the current scope, which belongs to `userid`.
+        The experiment ids of the shard are then made to start at userid << SHARD_ID_BITS
+    """
+    current = _apply_migrations(SHARD_MIGRATIONS, target, label=f"user {userid} shard")
+    with db_transaction() as conn:
+        conn.execute(f"INSERT INTO sqlite_sequence(name, seq) SELECT ?, ? \
+            WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?);",
+            (Experiment._table, int(userid) << SHARD_ID_BITS, Experiment._table))
+    return current
@@ -1,11 +1,14 @@
 from .user import User
-from .enums import UserAuthLevel
+from .enums import UserAuthLevel, JobStatus
 from .experiment import Experiment
 from .simulation import Simulation
+from .job import Job
 
 __all__ = [
     "User",
     "UserAuthLevel",
     "Experiment",
-    "Simulation"
+    "Simulation",
+    "JobStatus",
+    "Job"
 ]
\ No newline at end of file
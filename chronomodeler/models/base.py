@@ -1,8 +1,15 @@
 from typing import List, Union, Dict
 from abc import ABC, abstractmethod
 from time import time
+import re, json
 
-from ..dbutils import get_db_conn, db_query_execute, db_query_fetch
+from ..dbutils import get_db_conn, db_query_execute, db_query_fetch, db_query_iter, db_write, db_scope
+from .cache import identity_map
+from ..constants import SEARCH_RESULT_LIMIT, SEARCH_CANDIDATE_LIMIT, ITER_BATCH_SIZE, SQLITE_DB
+
+
+# prepared SQL strings for the bulk methods, keyed by (model class, statement kind)
+_bulk_sql_cache: Dict[tuple, tuple] = {}
 
 class BaseModel:
     """
@@ -13,8 +20,11 @@ class BaseModel:
     _table: str = ""  # the name of the table
     _columns: List[str] = []  # the list of columns
     _searchcols: List[str] = []   # the list of searchable columns
+    _fts_table: str = ""    # the FTS5 index over the searchable columns, if any
     _identity: str = "id"   # the identity column
     _identity_insert: bool = False   # the column to insert
+    _cacheable: bool = False   # whether fetched objects are kept in the identity map
+    _cache_dependents: List[str] = []   # tables whose rows get deleted along with ours (ON DELETE CASCADE)
     created_at = None   # two default properties, always going to be added to track changes
     updated_at = None
 
@@ -23,13 +33,75 @@ class BaseModel:
         return {
             col: getattr(self, col) for col in self._columns
         }
+
+    @classmethod
+    def _projection(cls, columns: Union[List[str], None] = None) -> List[str]:
+        """
+            The columns to select, all of them by default. The identity is always included
+        """
+        if columns is None:
+            return [col for col in cls._columns]
+        invalid = [col for col in columns if col not in cls._columns]
+        if len(invalid) > 0:
+            raise ValueError(f"Invalid columns {', '.join(invalid)} for {cls._table}")
+        return [col for col in cls._columns if col == cls._identity or col in columns]
+
+    @classmethod
+    def _from_row(cls, row: dict):
+        """
+            Creates an object from a fetched row. A row holding only a projection of the columns
+            gives a partial object, whose other attributes are None (and so skipped by `update`)
+        """
+        if all(col in row for col in cls._columns):
+            return cls(**row)
+        obj = cls.__new__(cls)
+        for col in cls._columns:
+            setattr(obj, col, row.get(col))
+        return obj
     
     
     @classmethod
     def create_table(cls):
         pass
 
+    @classmethod
+    def _database(cls, id = None, obj = None, userid = None, simid = None) -> str:
+        """
+            The database file holding the rows, given whatever routing keys the caller has.
+            The main database by default, sharded models override this
+        """
+        return SQLITE_DB
+
+    @classmethod
+    def _objs_database(cls, objs: List["BaseModel"]) -> str:
+        databases = set([cls._database(obj=obj) for obj in objs])
+        if len(databases) > 1:
+            raise ValueError(f"The objects of a bulk operation on {cls._table} must belong to the same database")
+        return databases.pop()
+
+    @classmethod
+    def _invalidate_cache(cls, id = None, cascade: bool = False):
+        """
+            Removes the object with the given identity (all objects of the table if None)
+            from the identity map, and with cascade the objects of the dependent tables too
+        """
+        if cls._cacheable:
+            identity_map.invalidate(cls._table, cls._identity if id is not None else None, id)
+        if cascade:
+            for table in cls._cache_dependents:
+                identity_map.invalidate(table)
+
     def insert(self):
+        with db_scope(self._database(obj=self)):
+            id = db_write(self._insert_row)
+        setattr(self, self._identity, id)
+        self._invalidate_cache(id)
+
+    def _insert_row(self, conn):
+        """
+            Inserts the object on the given connection (of the database writer)
+            and returns the generated identity
+        """
         collist = [col for col in self._columns if self._identity_insert or col != self._identity]
         modeldict = self.to_dict()
         current_time = int(time())
@@ -43,8 +115,7 @@ class BaseModel:
         sql = f"INSERT INTO {self._table}({ ','.join(collist) }) \
             VALUES ({ ','.join(['?' for col in collist]) }) \
             RETURNING {self._identity};"
-        rows = db_query_fetch(sql, tuple(params))
-        setattr(self, self._identity, rows[0][self._identity])
+        return conn.execute(sql, tuple(params)).fetchone()[0]
 
     def update(self):
         modeldict = self.to_dict()
@@ -61,21 +132,164 @@ class BaseModel:
                 update_query_parts.append(str(col) + " = ?")
         params.append(modeldict[self._identity])
         sql = f"UPDATE {self._table} SET {','.join(update_query_parts)} WHERE {self._identity} = ?;"
-        db_query_execute(sql, tuple(params))
+        with db_scope(self._database(obj=self)):
+            db_query_execute(sql, tuple(params))
+        self._invalidate_cache(modeldict[self._identity])
+
+    @classmethod
+    def _bulk_sql(cls, kind: str) -> tuple:
+        """
+            Builds (once per model class) the SQL used by the bulk methods
+            - insert: all columns except an auto generated identity
+            - update: all columns except identity and created_at, matched by identity,
+              a None value leaves the column unchanged (like `update`)
+            - upsert: all columns including the identity, for the rows inserted under a given identity
+        """
+        key = (cls, kind)
+        if key not in _bulk_sql_cache:
+            if kind == "insert":
+                collist = [col for col in cls._columns if cls._identity_insert or col != cls._identity]
+                sql = f"INSERT INTO {cls._table}({','.join(collist)}) VALUES ({','.join(['?'] * len(collist))});"
+            elif kind == "update":
+                collist = [col for col in cls._columns if col not in (cls._identity, "created_at")]
+                sql = f"UPDATE {cls._table} SET {','.join([f'{col} = COALESCE(?, {col})' for col in collist])} WHERE {cls._identity} = ?;"
+                collist = collist + [cls._identity]
+            elif kind == "upsert":
+                collist = [col for col in cls._columns]
+                sql = f"INSERT INTO {cls._table}({','.join(collist)}) VALUES ({','.join(['?'] * len(collist))});"
+            else:
+                raise ValueError(f"Invalid bulk statement kind {kind}")
+            _bulk_sql_cache[key] = (sql, collist)
+        return _bulk_sql_cache[key]
+
+    @classmethod
+    def _bulk_params(cls, objs: List["BaseModel"], collist: List[str], created: bool):
+        current_time = int(time())
+        params = []
+        for obj in objs:
+            if created and "created_at" in cls._columns:
+                obj.created_at = current_time
+            if "updated_at" in cls._columns:
+                obj.updated_at = current_time
+            modeldict = obj.to_dict()
+            params.append(tuple(modeldict.get(col) for col in collist))
+        return params
+
+    @classmethod
+    def _bulk_insert_rows(cls, conn, objs: List["BaseModel"]) -> List:
+        sql, collist = cls._bulk_sql("insert")
+        conn.executemany(sql, cls._bulk_params(objs, collist, created=True))
+        if cls._identity_insert:
+            ids = [getattr(obj, cls._identity) for obj in objs]
+        else:
+            # the write lock is held for the whole transaction, so the generated rowids are consecutive
+            last_id = conn.execute("SELECT last_insert_rowid();").fetchone()[0]
+            ids = list(range(last_id - len(objs) + 1, last_id + 1))
+        for obj, id in zip(objs, ids):
+            setattr(obj, cls._identity, id)
+        return ids
+
+    @classmethod
+    def bulk_insert(cls, objs: List["BaseModel"]) -> List:
+        """
+            Inserts all the objects using a single executemany in one transaction,
+            sets the generated identity on every object and returns the identities
+        """
+        if len(objs) == 0:
+            return []
+        with db_scope(cls._objs_database(objs)):
+            ids = db_write(lambda conn: cls._bulk_insert_rows(conn, objs))
+        cls._invalidate_cache()
+        return ids
 
     @classmethod
-    def get(cls, id):
-        sql = f"SELECT {','.join(cls._columns)} FROM {cls._table} WHERE {cls._identity} = ?;"
-        rows = db_query_fetch(sql, (id, ))
+    def bulk_update(cls, objs: List["BaseModel"]) -> List:
+        """
+            Updates all the objects (every column except the identity, created_at and the
+            attributes that are None) using a single executemany in one transaction, returns the identities
+        """
+        if len(objs) == 0:
+            return []
+        sql, collist = cls._bulk_sql("update")
+        params = cls._bulk_params(objs, collist, created=False)
+        with db_scope(cls._objs_database(objs)):
+            db_write(lambda conn: conn.executemany(sql, params))
+        cls._invalidate_cache()
+        return [getattr(obj, cls._identity) for obj in objs]
+
+    @classmethod
+    def bulk_upsert(cls, objs: List["BaseModel"]) -> List:
+        """
+            Objects having an identity are updated in place (skipping None attributes, like `bulk_update`)
+            or inserted under that identity when the row does not exist, objects without one are inserted;
+            all within one transaction. Returns the identities in input order
+        """
+        if len(objs) == 0:
+            return []
+        existing = [obj for obj in objs if getattr(obj, cls._identity, None) is not None]
+        new = [obj for obj in objs if getattr(obj, cls._identity, None) is None]
+
+        def write(conn):
+            if len(existing) > 0:
+                # the rows are looked up inside the transaction, so no other write can come in between
+                ids = json.dumps([getattr(obj, cls._identity) for obj in existing])
+                found = set([row[0] for row in conn.execute(
+                    f"SELECT {cls._identity} FROM {cls._table} WHERE {cls._identity} IN (SELECT value FROM json_each(?));", (ids, )
+                )])
+                for kind, objs_kind, created in [
+                        ("update", [obj for obj in existing if getattr(obj, cls._identity) in found], False),
+                        ("upsert", [obj for obj in existing if getattr(obj, cls._identity) not in found], True)
+                    ]:
+                    if len(objs_kind) > 0:
+                        sql, collist = cls._bulk_sql(kind)
+                        conn.executemany(sql, cls._bulk_params(objs_kind, collist, created=created))
+            if len(new) > 0:
+                cls._bulk_insert_rows(conn, new)
+        with db_scope(cls._objs_database(objs)):
+            db_write(write)
+        cls._invalidate_cache()
+        return [getattr(obj, cls._identity) for obj in objs]
+
+    @classmethod
+    def _cached_lookup(cls, column: str, value, loader):
+        """
+            Serves the object found by `column = value` from the identity map,
+            calling `loader()` and remembering its result on a miss
+        """
+        if not cls._cacheable:
+            return loader()
+        key = (cls._table, column, value)
+        obj = identity_map.get(key)
+        if obj is None:
+            obj = loader()
+            if obj is not None:
+                identity_map.put(key, obj)
+        return obj
+
+    @classmethod
+    def get(cls, id, columns: Union[List[str], None] = None):
+        if columns is not None:
+            # a cached full object satisfies any projection, partial objects are never cached
+            obj = identity_map.get((cls._table, cls._identity, id)) if cls._cacheable else None
+            return obj if obj is not None else cls._fetch_one(cls._identity, id, columns)
+        return cls._cached_lookup(cls._identity, id, lambda: cls._fetch_one(cls._identity, id))
+
+    @classmethod
+    def _fetch_one(cls, column: str, value, columns: Union[List[str], None] = None):
+        sql = f"SELECT {','.join(cls._projection(columns))} FROM {cls._table} WHERE {column} = ?;"
+        with db_scope(cls._database(id=value if column == cls._identity else None)):
+            rows = db_query_fetch(sql, (value, ))
         if rows is None or len(rows) == 0:
             return None
         else:
-            return cls(**rows[0])  # create a object of this class
+            return cls._from_row(rows[0])  # create a object of this class
 
     @classmethod
     def delete(cls, id):
         sql = f"DELETE FROM {cls._table} WHERE {cls._identity} = ?;"
-        db_query_execute(sql, (id, ))
+        with db_scope(cls._database(id=id)):
+            db_query_execute(sql, (id, ))
+        cls._invalidate_cache(id, cascade=True)
 
     
     @classmethod
@@ -87,30 +301,130 @@ class BaseModel:
         sql = f"SELECT {','.join(collist)} \
             FROM {cls._table} \
             ORDER BY {','.join(orderByCol)} \
-            {('LIMIT ' + str(limit) if limit > 0 else '')} \
-            {('OFFSET ' + str(offset) if offset >= 0 else '' )};"
-        rows = db_query_fetch(sql)
+            LIMIT ? OFFSET ?;"
+        with db_scope(cls._database()):
+            rows = db_query_fetch(sql, (limit if limit > 0 else -1, max(offset, 0)))
         if rows is None or len(rows) == 0:
             return []
         else:
-            return [cls(**row) for row in rows]
+            return [cls._from_row(row) for row in rows]
+
+    @classmethod
+    def _keyset_order(cls, order_by: Union[str, None], descending: bool):
+        if order_by is not None and order_by not in cls._columns:
+            raise ValueError(f"Invalid ordering column {order_by}")
+        keycols = [cls._identity] if order_by is None or order_by == cls._identity else [order_by, cls._identity]
+        direction = "DESC" if descending else "ASC"
+        return keycols, ', '.join([col + ' ' + direction for col in keycols])
+
+    @classmethod
+    def seek(
+        cls, 
+        after: Union[tuple, None] = None, 
+        limit: int = 100, 
+        order_by: Union[str, None] = None, 
+        descending: bool = False,
+        columns: Union[List[str], None] = None
+    ):
+        """
+            Keyset (seek) pagination: returns the page of at most `limit` objects that come after
+            the cursor `after` in the given ordering, and the cursor for the next page (None at the end).
+            The ordering column (identity by default, ties broken by identity) should be indexed and non null.
+            A cursor is the tuple of ordering values of the last object of a page, pass None for the first page
+        """
+        keycols, orderclause = cls._keyset_order(order_by, descending)
+        where = ""
+        params = []
+        if after is not None:
+            where = f"WHERE ({','.join(keycols)}) {'<' if descending else '>'} ({','.join(['?'] * len(keycols))})"
+            params = list(after)
+        collist = cls._projection(columns)
+        collist += [col for col in keycols if col not in collist]
+        sql = f"SELECT {','.join(collist)} FROM {cls._table} {where} ORDER BY {orderclause} LIMIT ?;"
+        with db_scope(cls._database()):
+            rows = db_query_fetch(sql, tuple(params + [limit]))
+        objs = [cls._from_row(row) for row in rows]
+        next_cursor = tuple([rows[-1][col] for col in keycols]) if len(rows) == limit else None
+        return objs, next_cursor
+
+    @classmethod
+    def iter_all(
+        cls, 
+        batch_size: int = ITER_BATCH_SIZE, 
+        order_by: Union[str, None] = None, 
+        descending: bool = False,
+        columns: Union[List[str], None] = None
+    ):
+        """
+            Generator over every object of the table, streamed from a single cursor
+            in batches of `batch_size` rows, so memory use does not grow with the table
+        """
+        _, orderclause = cls._keyset_order(order_by, descending)
+        sql = f"SELECT {','.join(cls._projection(columns))} FROM {cls._table} ORDER BY {orderclause};"
+        with db_scope(cls._database()):
+            batches = db_query_iter(sql, (), batch_size)
+        for rows in batches:
+            for row in rows:
+                yield cls._from_row(row)
         
     @classmethod
-    def search(cls, query: str, userid):
-        collist = [col for col in cls._columns]
-        if 'userid' in collist:
-            sql = f"SELECT {','.join(collist)} FROM {cls._table} \
-            WHERE userid = ? AND ({'OR'.join([ ('UPPER(' + col + ') LIKE ? ') for col in cls._searchcols ])});"
-            params = [userid] + (['%' + query.upper() + '%'] * len(cls._searchcols))
+    def _fts_match_expr(cls, query: str) -> str:
+        """
+            Turns free text into an FTS5 expression where every word is a prefix query,
+            e.g. 'rev fore' -> '"rev"* "fore"*' (all words must match)
+        """
+        tokens = re.findall(r'\w+', query or '', re.UNICODE)
+        return ' '.join(['"' + token + '"*' for token in tokens])
+
+    @classmethod
+    def search(
+        cls, 
+        query: str, 
+        userid = None, 
+        simid = None, 
+        limit: int = SEARCH_RESULT_LIMIT,
+        columns: Union[List[str], None] = None
+    ):
+        """
+            Returns at most `limit` objects whose searchable columns match the query,
+            best matches first, optionally restricted to a user and / or a simulation.
+            Uses the FTS5 index when the model has one, otherwise LIKE scans.
+            Pass `columns` to fetch only the fields needed, e.g. for searchbox labels
+        """
+        projection = cls._projection(columns)
+        collist = ['t.' + col for col in projection]
+        filters = []
+        params = []
+        for col, val in [('userid', userid), ('simid', simid)]:
+            if val is not None and col in cls._columns:
+                filters.append(f"t.{col} = ?")
+                params.append(val)
+
+        match_expr = cls._fts_match_expr(query)
+        if cls._fts_table != "" and match_expr != "":
+            # bm25 ranking is only computed over the most recent matching candidates,
+            # ranking every match of a one letter prefix would cost more than the search itself
+            sql = f"SELECT {','.join(projection)} FROM ( \
+                SELECT {','.join(collist)}, f.rank AS search_rank FROM {cls._fts_table} f \
+                INNER JOIN {cls._table} t ON t.{cls._identity} = f.rowid \
+                WHERE {' AND '.join([cls._fts_table + ' MATCH ?'] + filters)} \
+                ORDER BY f.rowid DESC LIMIT ? \
+            ) ORDER BY search_rank LIMIT ?;"
+            params = [match_expr] + params + [SEARCH_CANDIDATE_LIMIT]
         else:
-            sql = f"SELECT {','.join(collist)} FROM {cls._table} \
-            WHERE ({'OR'.join([ ('UPPER(' + col + ') LIKE ? ') for col in cls._searchcols ])});"
-            params =  ['%' + query.upper() + '%'] * len(cls._searchcols)
-                    
-        rows = db_query_fetch(sql, tuple( params ) )
+            if len(cls._searchcols) > 0 and match_expr != "":
+                filters.append('(' + ' OR '.join([ ('UPPER(t.' + col + ') LIKE ?') for col in cls._searchcols ]) + ')')
+                params += ['%' + query.upper() + '%'] * len(cls._searchcols)
+            sql = f"SELECT {','.join(collist)} FROM {cls._table} t \
+                {('WHERE ' + ' AND '.join(filters)) if len(filters) > 0 else ''} \
+                ORDER BY t.{cls._identity} DESC LIMIT ?;"
+        params.append(limit)
+
+        with db_scope(cls._database(userid=userid, simid=simid)):
+            rows = db_query_fetch(sql, tuple( params ) )
         if rows is None or len(rows) == 0:
             return []
         else:
-            return [cls(**row) for row in rows]
+            return [cls._from_row(row) for row in rows]
 
 
@@ -0,0 +1,79 @@
+from typing import Any, Dict, Hashable, Tuple
+from copy import deepcopy
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from ..constants import MODEL_CACHE_SIZE, MODEL_CACHE_TTL
+
+
+class IdentityMap:
+    """
+        Process wide read-through cache of model objects, keyed by
+        (table, column, value) where column is the identity column or
+        a unique lookup column like the username. Entries expire after
+        `ttl` seconds and the least recently used ones are evicted beyond `maxsize`.
+        Objects are copied in and out, every caller gets its own instance to modify
+        (sessions must not see each other's unsaved changes).
+    """
+
+    def __init__(self, maxsize: int = MODEL_CACHE_SIZE, ttl: float = MODEL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, str, Hashable], Tuple[float, Any]]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple[str, str, Hashable]):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return deepcopy(entry[1])
+
+    def put(self, key: Tuple[str, str, Hashable], obj: Any):
+        obj = deepcopy(obj)
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, obj)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, table: str, identity: str = None, id: Hashable = None):
+        """
+            Drops the cached object with the given identity along with every
+            secondary lookup cached for the table (the written row may be any of them).
+            Without an identity, all entries of the table are dropped
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if key[0] == table and (identity is None or key[1] != identity or key[2] == id):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': (self.hits / total) if total > 0 else 0.0
+            }
+
+
+identity_map = IdentityMap()
@@ -5,4 +5,11 @@ class UserAuthLevel(int, Enum):
     PRIVATE = 1
     DEVELOPER = 2
     ADMIN = 3
-    SUPERADMIN = 4
\ No newline at end of file
+    SUPERADMIN = 4
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
@@ -4,39 +4,118 @@ import time, json
 
 from .base import BaseModel
 from ..dbutils import db_query_execute
+from ..constants import SQLITE_DB, SHARDING_ENABLED
+
+
+class _NotDecoded:
+    # copies of an experiment (e.g. from the identity map) must keep referring to the same marker
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+_NOT_DECODED = _NotDecoded()   # marks a JSON column whose raw text has not been parsed yet
 
 class Experiment(BaseModel):
 
     _table = "experiments"
     _columns = [
-        "expid", "exp_name", "simid", "config", "results", "initial", "created_at", "updated_at"
+        "expid", "exp_name", "simid", "config", "results", "initial", "ordinal", "run_params", "input_hash",
+        "created_at", "updated_at"
     ]
     _identity = "expid"
     _searchcols = ["exp_name"]
+    _fts_table = "experiments_fts"
+    _cacheable = True
+    _ordinals_table = "experiment_ordinals"   # last ordinal given out per simulation, never decreases
+
+    # enough for labels and lookups, without the (possibly large) JSON columns
+    SUMMARY_COLUMNS = ["expid", "simid", "exp_name", "initial", "ordinal"]
 
 
     def __init__(
         self,
         simid: int,
         exp_name: str,
-        config,
-        results,
+        config = None,
+        results = None,
         initial: bool = False,
         created_at: int = None,
         updated_at: int = None,
-        expid: int = None
+        expid: int = None,
+        ordinal: int = None,
+        run_params = None,
+        input_hash: str = None
     ):
         self.simid = simid
         self.exp_name = exp_name
-        self.config = json.loads(config) if isinstance(config, str) else config
-        self.results = json.loads(results) if isinstance(results, str) else results
+        self.config = config    # JSON text is decoded lazily on first access
+        self.results = results
         self.initial = initial if isinstance(initial, bool) else bool(initial)
         self.created_at = created_at if created_at is not None else int(time.time())
         self.updated_at = updated_at if updated_at is not None else self.created_at
         self.expid = expid
+        self.ordinal = ordinal    # stable 1-based position of the experiment within its simulation
+        self.run_params = run_params    # train / test / prediction dates of the last run, to run it again
+        self.input_hash = input_hash    # hash of the config, run params and input data of the last run
+
+    def _get_json(self, name: str):
+        value = self.__dict__.get('_' + name)
+        if value is _NOT_DECODED:
+            value = json.loads(self.__dict__['_' + name + '_raw'])
+            self.__dict__['_' + name] = value
+        return value
+
+    def _set_json(self, name: str, value):
+        if isinstance(value, str):
+            self.__dict__['_' + name + '_raw'] = value
+            self.__dict__['_' + name] = _NOT_DECODED
+        else:
+            self.__dict__['_' + name + '_raw'] = None
+            self.__dict__['_' + name] = value
+
+    def _dump_json(self, name: str):
+        if self.__dict__.get('_' + name) is _NOT_DECODED:
+            return self.__dict__['_' + name + '_raw']   # untouched, no need to re-encode
+        value = self.__dict__.get('_' + name)
+        return json.dumps(value) if value is not None else None
+
+    @property
+    def config(self):
+        return self._get_json('config')
+
+    @config.setter
+    def config(self, value):
+        self._set_json('config', value)
+
+    @property
+    def results(self):
+        return self._get_json('results')
+
+    @results.setter
+    def results(self, value):
+        self._set_json('results', value)
+
+    @property
+    def run_params(self):
+        return self._get_json('run_params')
+
+    @run_params.setter
+    def run_params(self, value):
+        self._set_json('run_params', value)
+
+    @classmethod
+    def _from_row(cls, row: dict):
+        obj = super()._from_row(row)
+        if obj.initial is not None and not isinstance(obj.initial, bool):
+            obj.initial = bool(obj.initial)
+        return obj
 
     @classmethod
-    def create_table(cls):
+    def create_table(cls, foreign_keys: bool = True):
+        # a user shard has no simulations table to reference
+        fk = ", FOREIGN KEY(simid) REFERENCES simulations(simid) ON DELETE CASCADE" if foreign_keys else ""
         sql = f"CREATE TABLE IF NOT EXISTS {cls._table} ( \
             expid integer primary key autoincrement,    \
             simid integer not null,     \
@@ -44,17 +123,83 @@ class Experiment(BaseModel):
             config text not null,   \
             results text not null,  \
             initial boolean not null default false, \
+            ordinal integer, \
+            run_params text, \
+            input_hash varchar(64), \
             created_at integer not null, \
-            updated_at integer not null, \
-            FOREIGN KEY(simid) REFERENCES simulations(simid) ON DELETE CASCADE   \
+            updated_at integer not null \
+            {fk} \
         );"
         db_query_execute(sql, ())
 
+    @classmethod
+    def create_ordinals_table(cls, conn):
+        """
+            The ordinal counter of every simulation, seeded from the experiments already stored
+        """
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {cls._ordinals_table} ( \
+            simid integer primary key, \
+            last_ordinal integer not null \
+        );")
+        conn.execute(f"INSERT OR IGNORE INTO {cls._ordinals_table}(simid, last_ordinal) \
+            SELECT simid, MAX(ordinal) FROM {cls._table} WHERE ordinal IS NOT NULL GROUP BY simid;")
+
+    @classmethod
+    def _database(cls, id = None, obj = None, userid = None, simid = None) -> str:
+        """
+            With sharding, experiments live in the shard of the simulation's user,
+            found from the expid (which carries the userid), the simid or the userid
+        """
+        if not SHARDING_ENABLED:
+            return SQLITE_DB
+        from ..sharding import shard_database, userid_for_expid, userid_for_simid
+        if obj is not None:
+            id = obj.expid
+            simid = obj.simid
+        if id is not None:
+            return shard_database(userid_for_expid(id))
+        if userid is None and simid is not None:
+            userid = userid_for_simid(simid)
+        if userid is None:
+            raise ValueError("Experiments are sharded per user, pass an expid, a simid or a userid")
+        return shard_database(userid)
+
+    @classmethod
+    def _assign_ordinals(cls, conn, objs: List["Experiment"]):
+        """
+            Gives every object without an ordinal the next ordinal of its simulation from the counter
+            of `_ordinals_table`, so the ordinal of a deleted experiment is never given out again.
+            Must run inside the inserting transaction so that concurrent writers cannot interleave
+        """
+        pending = {}
+        for obj in objs:
+            if obj.ordinal is None:
+                pending.setdefault(obj.simid, []).append(obj)
+        for simid, simobjs in pending.items():
+            # also past any ordinal stored without going through the counter
+            last_ordinal = conn.execute(f"INSERT INTO {cls._ordinals_table}(simid, last_ordinal) \
+                SELECT ?, COALESCE(MAX(ordinal), 0) + ? FROM {cls._table} WHERE simid = ? \
+                ON CONFLICT(simid) DO UPDATE SET last_ordinal = MAX(last_ordinal + ?, excluded.last_ordinal) \
+                RETURNING last_ordinal;", (simid, len(simobjs), simid, len(simobjs))).fetchone()[0]
+            for i, obj in enumerate(simobjs):
+                obj.ordinal = last_ordinal - len(simobjs) + i + 1
+
+    def _insert_row(self, conn):
+        # the ordinal is assigned within the transaction that inserts the row
+        self._assign_ordinals(conn, [self])
+        return super()._insert_row(conn)
+
+    @classmethod
+    def _bulk_insert_rows(cls, conn, objs: List["Experiment"]) -> List:
+        cls._assign_ordinals(conn, objs)
+        return super()._bulk_insert_rows(conn, objs)
+
     def to_dict(self) -> dict:
         tmp = super().to_dict()        
-        tmp['config'] = json.dumps(self.config)
-        tmp['results'] = json.dumps(self.results)
-        tmp['initial'] = 1 if self.initial else 0
+        tmp['config'] = self._dump_json('config')
+        tmp['results'] = self._dump_json('results')
+        tmp['run_params'] = self._dump_json('run_params')
+        tmp['initial'] = (1 if self.initial else 0) if self.initial is not None else None
         return tmp
 
 
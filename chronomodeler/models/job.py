@@ -0,0 +1,141 @@
+from typing import List, Union
+import time
+
+from .base import BaseModel
+from .enums import JobStatus
+from ..dbutils import db_query_execute, db_write, db_scope
+
+
+class Job(BaseModel):
+    """
+        A background job (e.g. an experiment run), found again by its `job_key`
+        (a hash of what it computes) so that reruns reattach to it
+    """
+
+    _table = "jobs"
+    _columns = [
+        "jobid", "job_key", "kind", "userid", "simid", "status", "progress", "message", "error",
+        "result_path", "started_at", "finished_at", "elapsed", "created_at", "updated_at"
+    ]
+    _identity = "jobid"
+
+    ACTIVE_STATUSES = [JobStatus.QUEUED.value, JobStatus.RUNNING.value]
+
+
+    def __init__(
+        self,
+        job_key: str,
+        kind: str,
+        userid: int = None,
+        simid: int = None,
+        status: str = JobStatus.QUEUED.value,
+        progress: float = 0.0,
+        message: str = "",
+        error: str = None,
+        result_path: str = None,
+        started_at: float = None,
+        finished_at: float = None,
+        elapsed: float = None,
+        created_at: int = None,
+        updated_at: int = None,
+        jobid: int = None
+    ):
+        self.job_key = job_key
+        self.kind = kind
+        self.userid = userid
+        self.simid = simid
+        self.status = status.value if isinstance(status, JobStatus) else status
+        self.progress = progress
+        self.message = message
+        self.error = error
+        self.result_path = result_path
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.elapsed = elapsed
+        self.created_at = created_at if created_at is not None else int(time.time())
+        self.updated_at = updated_at if updated_at is not None else self.created_at
+        self.jobid = jobid
+
+    @property
+    def active(self) -> bool:
+        return self.status in self.ACTIVE_STATUSES
+
+    @classmethod
+    def create_table(cls):
+        sql = f"CREATE TABLE IF NOT EXISTS {cls._table} ( \
+            jobid integer primary key autoincrement, \
+            job_key varchar(64) not null unique, \
+            kind varchar(64) not null, \
+            userid integer, \
+            simid integer, \
+            status varchar(16) not null, \
+            progress real not null default 0, \
+            message varchar, \
+            error text, \
+            result_path varchar, \
+            started_at real, \
+            finished_at real, \
+            elapsed real, \
+            created_at integer not null, \
+            updated_at integer not null \
+        );"
+        db_query_execute(sql, ())
+
+    @classmethod
+    def get_by_key(cls, job_key: str, columns: Union[List[str], None] = None):
+        return cls._fetch_one("job_key", job_key, columns)
+
+    @classmethod
+    def claim(cls, job_key: str, kind: str, userid: int = None, simid: int = None):
+        """
+            Returns (job, created): the job of the key if it is queued, running or has succeeded,
+            otherwise a queued job (a new row, or the failed / cancelled one reset) that the caller must run.
+            Runs as one write, so two sessions submitting the same key get the same job
+        """
+        def write(conn):
+            row = conn.execute(f"SELECT {','.join(cls._columns)} FROM {cls._table} WHERE job_key = ?;", (job_key, )).fetchone()
+            if row is not None:
+                job = cls._from_row(dict(zip(cls._columns, row)))
+                if job.status not in (JobStatus.FAILED.value, JobStatus.CANCELLED.value):
+                    return job, False
+                job.status, job.progress, job.message, job.error = JobStatus.QUEUED.value, 0.0, "", None
+                job.started_at, job.finished_at, job.elapsed = None, None, None
+                job.updated_at = int(time.time())
+                conn.execute(f"UPDATE {cls._table} SET status = ?, progress = 0, message = '', error = NULL, \
+                    result_path = NULL, started_at = NULL, finished_at = NULL, elapsed = NULL, updated_at = ? \
+                    WHERE {cls._identity} = ?;", (job.status, job.updated_at, job.jobid))
+                return job, True
+            job = cls(job_key, kind, userid, simid)
+            job.jobid = job._insert_row(conn)
+            return job, True
+        with db_scope(cls._database()):
+            return db_write(write)
+
+    @classmethod
+    def set_status(cls, jobid: int, status: JobStatus, **fields):
+        """
+            Updates the status and the given columns of the job in one statement
+        """
+        fields = { 'status': status.value, 'updated_at': int(time.time()), **fields }
+        sql = f"UPDATE {cls._table} SET {','.join([col + ' = ?' for col in fields])} WHERE {cls._identity} = ?;"
+        with db_scope(cls._database()):
+            db_query_execute(sql, tuple(fields.values()) + (jobid, ))
+
+    @classmethod
+    def set_progress(cls, jobid: int, progress: float, message: str):
+        sql = f"UPDATE {cls._table} SET progress = ?, message = ?, updated_at = ? \
+            WHERE {cls._identity} = ? AND status = ?;"
+        with db_scope(cls._database()):
+            db_query_execute(sql, (progress, message, int(time.time()), jobid, JobStatus.RUNNING.value))
+
+    @classmethod
+    def interrupt_active(cls) -> int:
+        """
+            Marks the queued / running jobs left behind by a previous process as failed,
+            returns how many there were
+        """
+        sql = f"UPDATE {cls._table} SET status = ?, error = ?, updated_at = ? \
+            WHERE status IN ({','.join(['?'] * len(cls.ACTIVE_STATUSES))});"
+        params = (JobStatus.FAILED.value, "Interrupted by a restart of the app", int(time.time()), *cls.ACTIVE_STATUSES)
+        with db_scope(cls._database()):
+            return db_write(lambda conn: conn.execute(sql, params).rowcount)
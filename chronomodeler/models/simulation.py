@@ -3,7 +3,8 @@ import time
 
 from .base import BaseModel
 from .experiment import Experiment
-from ..dbutils import db_query_execute, db_query_fetch
+from ..dbutils import db_query_execute, db_query_fetch, db_scope
+from ..constants import SHARDING_ENABLED
 
 class Simulation(BaseModel):
     
@@ -14,6 +15,9 @@ class Simulation(BaseModel):
     ]
     _identity = "simid"
     _searchcols = ["sim_name"]
+    _fts_table = "simulations_fts"
+    _cacheable = True
+    _cache_dependents = ["experiments"]
 
 
     def __init__(
@@ -50,34 +54,90 @@ class Simulation(BaseModel):
     @classmethod
     def count(cls, userid):
         sql = f"SELECT COUNT(1) AS totalcount FROM {cls._table} WHERE userid = ?;"
-        res = db_query_fetch(sql, (userid, ))
+        with db_scope(cls._database()):
+            res = db_query_fetch(sql, (userid, ))
         if res is None or len(res) == 0:
             return 0
         else:
             return int(res[0].get('totalcount', 0))
 
-    def get_initial_experiment(self):
-        sql = f"SELECT {','.join(Experiment._columns)} FROM {Experiment._table} \
-            WHERE simid = {self.simid} AND initial = 1;"
-        rows = db_query_fetch(sql, ())
+    def _experiments_scope(self):
+        # the experiments live in the shard of the user when sharding is enabled
+        return db_scope(Experiment._database(userid=self.userid))
+
+    @classmethod
+    def delete(cls, id):
+        if SHARDING_ENABLED:
+            # no foreign key cascade across database files, delete the experiments of the shard first
+            sim = cls.get(id, columns=["userid"])
+            if sim is not None:
+                with db_scope(Experiment._database(userid=sim.userid)):
+                    db_query_execute(f"DELETE FROM {Experiment._table} WHERE simid = ?;", (id, ))
+        super().delete(id)
+
+    def get_initial_experiment(self, columns: Union[List[str], None] = None):
+        if columns is not None:
+            return self._fetch_initial_experiment(columns)
+        return Experiment._cached_lookup("initial", self.simid, self._fetch_initial_experiment)
+
+    def _fetch_initial_experiment(self, columns: Union[List[str], None] = None):
+        sql = f"SELECT {','.join(Experiment._projection(columns))} FROM {Experiment._table} \
+            WHERE simid = ? AND initial = 1;"
+        with self._experiments_scope():
+            rows = db_query_fetch(sql, (self.simid, ))
         if rows is None or len(rows) == 0:
             return None
         else:
-            return Experiment(**rows[0])
+            return Experiment._from_row(rows[0])
         
-    def get_nth_experiment(self, n: int = 1):
-        sql = f"SELECT {','.join(Experiment._columns)} FROM {Experiment._table} \
-            WHERE simid = {self.simid} ORDER BY {Experiment._identity} ASC \
-            LIMIT 1 OFFSET {n-1};"
-        rows = db_query_fetch(sql, ())
+    def get_nth_experiment(self, n: int = 1, columns: Union[List[str], None] = None):
+        if columns is not None:
+            return self._fetch_nth_experiment(n, columns)
+        return Experiment._cached_lookup("ordinal", (self.simid, n), lambda: self._fetch_nth_experiment(n))
+
+    def _fetch_nth_experiment(self, n: int, columns: Union[List[str], None] = None):
+        sql = f"SELECT {','.join(Experiment._projection(columns))} FROM {Experiment._table} \
+            WHERE simid = ? AND ordinal = ?;"
+        with self._experiments_scope():
+            rows = db_query_fetch(sql, (self.simid, n))
         if rows is None or len(rows) == 0:
             return None
         else:
-            return Experiment(**rows[0])
+            return Experiment._from_row(rows[0])
+
+    def get_experiments_by_ordinals(self, ordinals: List[int], columns: Union[List[str], None] = None) -> Dict[int, Experiment]:
+        """
+            Fetches all the experiments with the given ordinals in a single query,
+            returns a dict from ordinal to experiment (missing ordinals are left out)
+        """
+        ordinals = list(set([int(n) for n in ordinals]))
+        if len(ordinals) == 0:
+            return {}
+        collist = Experiment._projection(columns)
+        collist += [] if "ordinal" in collist else ["ordinal"]
+        sql = f"SELECT {','.join(collist)} FROM {Experiment._table} \
+            WHERE simid = ? AND ordinal IN ({','.join(['?'] * len(ordinals))});"
+        with self._experiments_scope():
+            rows = db_query_fetch(sql, tuple([self.simid] + ordinals))
+        return { row['ordinal']: Experiment._from_row(row) for row in rows }
+
+    def get_experiments(self, columns: Union[List[str], None] = None, initial: bool = False) -> Dict[int, Experiment]:
+        """
+            All the experiments of the simulation (without the initial one unless asked for),
+            returns a dict from ordinal to experiment in ordinal order
+        """
+        collist = Experiment._projection(columns)
+        collist += [] if "ordinal" in collist else ["ordinal"]
+        sql = f"SELECT {','.join(collist)} FROM {Experiment._table} \
+            WHERE simid = ? {'' if initial else 'AND initial = 0'} ORDER BY ordinal;"
+        with self._experiments_scope():
+            rows = db_query_fetch(sql, (self.simid, ))
+        return { row['ordinal']: Experiment._from_row(row) for row in rows }
 
     def get_experiment_count(self):
-        sql = f"SELECT COUNT(1) AS totalcount FROM {Experiment._table} WHERE simid = {self.simid} AND initial = 0;"
-        res = db_query_fetch(sql, ())
+        sql = f"SELECT COUNT(1) AS totalcount FROM {Experiment._table} WHERE simid = ? AND initial = 0;"
+        with self._experiments_scope():
+            res = db_query_fetch(sql, (self.simid, ))
         if res is None or len(res) == 0:
             return 0
         else:
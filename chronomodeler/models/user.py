@@ -4,6 +4,7 @@ import time
 from .base import BaseModel
 from .enums import UserAuthLevel
 from ..dbutils import db_query_execute, db_query_fetch
+from ..constants import SHARDING_ENABLED
 
 
 class User(BaseModel):
@@ -13,6 +14,8 @@ class User(BaseModel):
         "userid", "username", "password_hash", "created_at", "updated_at", "authlevel"
     ]
     _identity = "userid"
+    _cacheable = True
+    _cache_dependents = ["simulations", "experiments"]
 
     def __init__(
         self, 
@@ -46,9 +49,12 @@ class User(BaseModel):
 
     @classmethod
     def get_user_by_username(cls, username):
-        sql = f"SELECT {','.join(cls._columns)} FROM {cls._table} WHERE username = ?;"
-        res = db_query_fetch(sql, (username, ))
-        if len(res) == 0:
-            return None
-        else:
-            return cls(**res[0])
\ No newline at end of file
+        return cls._cached_lookup("username", username, lambda: cls._fetch_one("username", username))
+
+    @classmethod
+    def delete(cls, id):
+        super().delete(id)
+        if SHARDING_ENABLED:
+            # the experiments and data of the user go away with their shard file
+            from ..sharding import drop_shard
+            drop_shard(id)
@@ -1,9 +1,13 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple, Union
+from functools import lru_cache
+from time import perf_counter
 import pandas as pd
 import numpy as np
 import re
 import datetime as dt
 
+from chronomodeler.constants import TIME_FORMAT_LIST, TIME_FORMAT_SAMPLE_SIZE
+
 def guess_data_frequency(time_col: pd.Series):
     # Calculate the time differences between consecutive timestamps
     time_diff_mode = time_col.diff().dt.days.mode().values[0]
@@ -222,4 +226,106 @@ def create_single_filter(
 def train_test_split(df: pd.DataFrame, filter_dates: List[dt.datetime]):
     split_dates = "-".join([x.strftime('%Y/%m/%d') for x in filter_dates])
     subdf = df.loc[apply_filters(df, [{'Time': {'between': split_dates } }])].dropna().copy(deep = True)
-    return subdf
\ No newline at end of file
+    return subdf
+
+# currency symbols, thousands separators and spaces are dropped, "(12.5)" and "12.5-" are negative
+NUMBER_NOISE_PATTERN = r"[\s,$€£¥₹]"
+PARENTHESES_NEGATIVE_PATTERN = r"^\((.*)\)$|^(.*)-$"
+NOISY_NUMBER_PATTERN = r"[\s$€£¥₹(]|-$"
+
+
+def coerce_numeric_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+        Converts every column to numbers, invalid values becoming NaN. Columns that are already
+        numeric are kept as they are, the cells of all the other columns are cleaned and parsed
+        together in a single vectorized pass (the regular expressions only run on the cells that need them)
+    """
+    text_cols = [col for col in df.columns if not pd.api.types.is_numeric_dtype(df[col]) or pd.api.types.is_bool_dtype(df[col])]
+    if len(text_cols) == 0:
+        return df.copy(deep = False)
+    # all the cells of the text columns, one column after the other
+    cells = pd.Series(df[text_cols].to_numpy(dtype = object).ravel(order = "F")).astype(str)
+    cells = cells.str.replace(",", "", regex = False)
+    noisy = cells.str.contains(NOISY_NUMBER_PATTERN, regex = True)
+    if noisy.any():
+        cleaned = cells[noisy].str.replace(NUMBER_NOISE_PATTERN, "", regex = True)
+        cells[noisy] = cleaned.str.replace(PARENTHESES_NEGATIVE_PATTERN, r"-\1\2", regex = True)
+    try:
+        values = cells.astype("float64")    # much faster than to_numeric when every cell is a number
+    except (ValueError, TypeError):
+        values = pd.to_numeric(cells, errors = "coerce")
+    values = values.to_numpy(dtype = float).reshape(len(text_cols), df.shape[0])
+    out = df.copy(deep = False)
+    for i, col in enumerate(text_cols):
+        out[col] = values[i]
+    return out
+
+
+@lru_cache(maxsize = 256)
+def _infer_time_format(sample: Tuple[str], candidates: Tuple[str]) -> Union[str, None]:
+    best, best_count = None, 0
+    values = pd.Series(sample)
+    for fmt in candidates:
+        count = int(pd.to_datetime(values, format = fmt, errors = "coerce").notna().sum())
+        if count > best_count:
+            best, best_count = fmt, count
+        if count == len(sample):
+            break   # candidates are in order of preference
+    return best
+
+
+def infer_time_format(time_col: pd.Series, candidates: List[str] = TIME_FORMAT_LIST) -> Union[str, None]:
+    """
+        The format (from `candidates`) that parses the most of a sample of the column,
+        cached by the sample so reruns do not try the formats again. None if nothing parses
+    """
+    sample = time_col.dropna().astype(str).str.strip()
+    sample = sample.iloc[np.linspace(0, len(sample) - 1, min(len(sample), TIME_FORMAT_SAMPLE_SIZE)).astype(int)] if len(sample) > 0 else sample
+    return _infer_time_format(tuple(sample.tolist()), tuple(candidates))
+
+
+def parse_time_column(time_col: pd.Series, time_format: Union[str, None] = None) -> pd.Series:
+    """
+        Datetimes of the column with the given format (inferred when None), invalid values becoming NaT.
+        Numbers are read as their digits (2015.0 as "2015"), never as epoch offsets, and a column
+        that no format parses is all NaT
+    """
+    if pd.api.types.is_datetime64_any_dtype(time_col):
+        return time_col
+    text = time_col.astype(str).str.strip().str.replace(r"^(\d+)\.0*$", r"\1", regex = True)
+    if time_format is None:
+        time_format = infer_time_format(text)
+    if time_format is None:
+        return pd.Series(pd.NaT, index = time_col.index, dtype = "datetime64[ns]")
+    return pd.to_datetime(text, format = time_format, errors = "coerce")
+
+
+def preprocess_data(
+        df: pd.DataFrame, 
+        time_col: str, 
+        renames: Union[Dict[str, str], None] = None, 
+        time_format: Union[str, None] = None
+    ) -> Tuple[pd.DataFrame, Dict[str, float]]:
+    """
+        Shared preprocessing of uploaded / fetched data: every column but `time_col` is coerced to numbers
+        and renamed with `renames`, the time column is parsed (with `time_format`, inferred when None),
+        rows without a valid time are dropped and Time / TimeIndex columns are added.
+        Returns the data and the seconds spent in each stage
+    """
+    timings = {}
+    start = perf_counter()
+    value_cols = [col for col in df.columns if col != time_col]
+    numeric = coerce_numeric_columns(df[value_cols])
+    timings['numeric'] = perf_counter() - start
+
+    start = perf_counter()
+    times = parse_time_column(df[time_col], time_format)
+    timings['time'] = perf_counter() - start
+
+    start = perf_counter()
+    valid = times.notna().to_numpy()
+    subdf = numeric.loc[valid].rename(columns = { old: new for old, new in (renames or {}).items() if new }).reset_index(drop = True)
+    subdf['Time'] = times.loc[valid].reset_index(drop = True)
+    subdf['TimeIndex'] = np.arange(subdf.shape[0])
+    timings['assemble'] = perf_counter() - start
+    return subdf, timings
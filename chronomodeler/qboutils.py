@@ -1,53 +1,348 @@
-import requests, json
+import requests, json, random, threading, time, os, hashlib
 import pandas as pd
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from stqdm import stqdm
 
+from chronomodeler.constants import QBO_BASE_URL, QBO_MAX_WORKERS, QBO_RATE_PER_SEC, QBO_RATE_BURST, \
+    QBO_MAX_RETRIES, QBO_BACKOFF_BASE, QBO_BACKOFF_MAX, QBO_REQUEST_TIMEOUT, \
+    QBO_CACHE_DIR, QBO_CACHE_MAX_BYTES, QBO_CACHE_OPEN_DAYS, QBO_CACHE_ONLY, \
+    QBO_SUMMARIZE_COLUMN_BY, QBO_MAX_PERIODS_PER_REQUEST
 
-def extract_rows(item):
-    """
-        Function that converts a QBO API response into a dataframe
-    """
-    extracted_rows = []
-    if 'ColData' in item:
-        amount = item['ColData'][1].get('value') if len(item['ColData']) > 1 else 0
-        extracted_rows.append({
-            "LineItem": item['ColData'][0].get('value'),
-            "Amount": float(amount) if (amount is not None and amount != '') else 0
-        })
-    elif isinstance(item, dict):
-        for _, subitem in item.items():
-            if isinstance(subitem, dict) or isinstance(subitem, list):
-                exrows = extract_rows(subitem)
-                extracted_rows += exrows
-    elif isinstance(item, list):
-        for _, subitem in enumerate(item):
-            if isinstance(subitem, dict) or isinstance(subitem, list):
-                exrows = extract_rows(subitem)
-                extracted_rows += exrows
-    return extracted_rows
-
-
-def get_qbo_report(realm_id, access_token, report_name, start_date: dt.datetime, end_date: dt.datetime):
-    BASE_URL = "https://quickbooks.api.intuit.com"
+SECTION_SEPARATOR = " / "
+
+
+class TokenBucket:
+    """
+        Thread safe token bucket: allows bursts of `capacity` requests and `rate` requests
+        per second on average, `acquire` blocks until a token is available
+    """
+
+    def __init__(self, rate: float = QBO_RATE_PER_SEC, capacity: int = QBO_RATE_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QBOReportCache:
+    """
+        On disk cache of raw report JSON, one file per (realm_id, report_name, start, end, accounting_method, summarize_column_by)
+        of an API base url.
+        Files are written atomically, a hit refreshes the modification time and the least
+        recently used files are evicted once the directory grows beyond `max_bytes`
+    """
+
+    def __init__(self, directory: str = QBO_CACHE_DIR, max_bytes: int = QBO_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None     # scanned on first write
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(
+            realm_id, report_name, start_date: dt.datetime, end_date: dt.datetime,
+            accounting_method: str, summarize_column_by: str = None, base_url: str = QBO_BASE_URL
+        ):
+        return (
+            str(realm_id), report_name, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"),
+            accounting_method, summarize_column_by or "", base_url
+        )
+
+    def _path(self, key):
+        digest = hashlib.sha1("|".join(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry["report"]
+
+    def put(self, key, report):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmppath = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmppath, "w") as f:
+            json.dump({"key": key, "fetched_at": int(time.time()), "report": report}, f)
+        with self.lock:
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmppath, path)
+            if self.total_bytes is not None:
+                self.total_bytes += os.path.getsize(path) - replaced
+            if self.total_bytes is None or self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        self.total_bytes = sum([size for _, size, _ in entries])
+        for _, size, name in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+
+_qbo_cache = None
+
+def get_qbo_cache() -> QBOReportCache:
+    global _qbo_cache
+    if _qbo_cache is None:
+        _qbo_cache = QBOReportCache()
+    return _qbo_cache
+
+
+def is_closed_period(end_date: dt.datetime, open_days: int = QBO_CACHE_OPEN_DAYS) -> bool:
+    """
+        Whether the books of a period ending at `end_date` can be assumed closed,
+        i.e. its reports no longer change
+    """
+    return end_date < dt.datetime.now() - dt.timedelta(days=open_days)
+
+
+def create_qbo_session(pool_size: int = QBO_MAX_WORKERS) -> requests.Session:
+    """
+        A session whose connection pool keeps the TCP / TLS connections alive across requests
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _backoff_seconds(attempt: int, res: requests.Response = None):
+    retry_after = res.headers.get("Retry-After") if res is not None else None
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), QBO_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return min(QBO_BACKOFF_BASE * (2 ** attempt), QBO_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+
+
+def _get_with_retries(session, url: str, headers: dict, params: dict, rate_limiter: TokenBucket = None):
+    """
+        GET with rate limiting, retrying with exponential backoff on throttling (429),
+        server errors (5xx) and connection failures. Other errors are raised immediately
+    """
+    for attempt in range(QBO_MAX_RETRIES + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            res = session.get(url, headers=headers, params=params, timeout=QBO_REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == QBO_MAX_RETRIES:
+                raise
+            time.sleep(_backoff_seconds(attempt))
+            continue
+        if (res.status_code == 429 or res.status_code >= 500) and attempt < QBO_MAX_RETRIES:
+            time.sleep(_backoff_seconds(attempt, res))
+            continue
+        res.raise_for_status()
+        return res
+
+
+def _parse_amount(coldata: list, index: int):
+    amount = coldata[index].get('value') if len(coldata) > index else None
+    return float(amount) if (amount is not None and amount != '') else 0.0
+
+
+def iter_rows(resobj, columns: dict = None):
+    """
+        Walks a QBO report with an explicit stack (no recursion limit on deeply nested reports)
+        and yields a (LineItem, Amount, Section, Time) tuple for every row in document order.
+        Section is the path of the enclosing section headers joined by SECTION_SEPARATOR.
+        `columns` maps the ColData index of every period column to its period, each row then
+        yields one tuple per period with the period as Time, otherwise the amount is the
+        second column and Time is None
+    """
+    stack = [(resobj, '')]
+    pop, push = stack.pop, stack.append
+    while stack:
+        item, section = pop()
+        if isinstance(item, dict):
+            coldata = item.get('ColData')
+            if coldata is not None:
+                lineitem = coldata[0].get('value') if len(coldata) > 0 else None
+                if columns is None:
+                    yield lineitem, _parse_amount(coldata, 1), section, None
+                else:
+                    for index, period in columns.items():
+                        yield lineitem, _parse_amount(coldata, index), section, period
+                continue
+            # the rows and summary of a section are nested under its header name
+            header = item.get('Header')
+            subsection = section
+            if isinstance(header, dict) and len(header.get('ColData', [])) > 0:
+                name = header['ColData'][0].get('value') or ''
+                subsection = section + SECTION_SEPARATOR + name if section else name
+            for key, value in reversed(item.items()):   # reversed so that the first child is visited first
+                if isinstance(value, (dict, list)):
+                    push((value, section if key == 'Header' else subsection))
+        elif isinstance(item, list):
+            for value in reversed(item):
+                if isinstance(value, (dict, list)):
+                    push((value, section))
+
+
+def extract_rows(resobj, columns: dict = None) -> dict:
+    """
+        Function that converts a QBO API response into columnar arrays
+        of LineItem, Amount, Section (and Time when `columns` is given, see `iter_rows`)
+    """
+    lineitems, amounts, sections, periods = [], [], [], []
+    for lineitem, amount, section, period in iter_rows(resobj, columns):
+        lineitems.append(lineitem)
+        amounts.append(amount)
+        sections.append(section)
+        periods.append(period)
+    data = { "LineItem": lineitems, "Amount": amounts, "Section": sections }
+    if columns is not None:
+        data["Time"] = periods
+    return data
+
+
+def qualify_colliding_lineitems(df: pd.DataFrame) -> pd.DataFrame:
+    """
+        Renames the line items whose name appears under more than one parent (report type and section path)
+        of the fetched reports to "ReportType / Section / LineItem", e.g. the "Net Income" closing the
+        Profit and Loss and the one of the Equity section of the Balance Sheet, so the pivot keeps them
+        apart instead of averaging them. Names found under a single parent are left as they are
+    """
+    parts = [col for col in ['ReportType', 'Section'] if col in df.columns]
+    if len(parts) == 0:
+        return df
+    keys = df[parts].fillna('').astype(str)
+    parents = keys[parts[0]].str.cat(keys[parts[1:]], sep=SECTION_SEPARATOR) if len(parts) > 1 else keys[parts[0]]
+    colliding = (parents.groupby(df['LineItem']).transform('nunique') > 1).to_numpy()
+    if not colliding.any():
+        return df
+    df = df.copy()
+    df.loc[colliding, 'LineItem'] = [
+        SECTION_SEPARATOR.join([str(part) for part in row if part])
+        for row in df.loc[colliding, parts + ['LineItem']].itertuples(index=False)
+    ]
+    return df
+
+
+def extract_period_columns(resobj) -> dict:
+    """
+        Maps the ColData index of every period column of a summarized report to the end date
+        of its period (read from the column metadata), the total column has no period and is left out
+    """
+    columns = {}
+    for index, column in enumerate(resobj.get('Columns', {}).get('Column', [])):
+        metadata = { meta.get('Name'): meta.get('Value') for meta in column.get('MetaData', []) }
+        if column.get('ColType') == 'Money' and metadata.get('EndDate'):
+            columns[index] = dt.datetime.strptime(metadata['EndDate'], "%Y-%m-%d")
+    return columns
+
+
+def get_qbo_report(
+        realm_id, 
+        access_token, 
+        report_name, 
+        start_date: dt.datetime, 
+        end_date: dt.datetime,
+        session: requests.Session = None,
+        rate_limiter: TokenBucket = None,
+        cache: QBOReportCache = None,
+        cache_only: bool = False,
+        accounting_method: str = "Accrual",
+        summarize_column_by: str = None,
+        base_url: str = QBO_BASE_URL
+    ):
+    """
+        Fetches one report as a dataframe of LineItem and Amount. With `summarize_column_by`
+        (Month, Quarter, Year) the report has one column per period between the dates and
+        the dataframe gets the end date of each period as Time.
+        With a `cache`, closed periods are served from disk and every fetched report is stored;
+        with `cache_only` the API is never called and a report missing from the cache raises a LookupError
+    """
     assert start_date < end_date
     assert report_name in ["ProfitAndLoss", "BalanceSheet"]
+    key = QBOReportCache.key(realm_id, report_name, start_date, end_date, accounting_method, summarize_column_by, base_url)
+    resobj = None
+    if cache is not None and (cache_only or is_closed_period(end_date)):
+        resobj = cache.get(key)
+    if resobj is None:
+        if cache_only:
+            raise LookupError(f"{report_name} report from {key[2]} to {key[3]} of realm {realm_id} is not cached")
+        resobj = _fetch_qbo_report_json(
+            realm_id, access_token, report_name, start_date, end_date, 
+            session, rate_limiter, accounting_method, summarize_column_by, base_url
+        )
+        if cache is not None:
+            cache.put(key, resobj)
+    columns = extract_period_columns(resobj) if summarize_column_by is not None else None
+    df = pd.DataFrame(extract_rows(resobj, columns))
+    return df
+
+
+def _fetch_qbo_report_json(
+        realm_id, 
+        access_token, 
+        report_name, 
+        start_date: dt.datetime, 
+        end_date: dt.datetime,
+        session: requests.Session = None,
+        rate_limiter: TokenBucket = None,
+        accounting_method: str = "Accrual",
+        summarize_column_by: str = None,
+        base_url: str = QBO_BASE_URL
+    ):
     payload = {
-        "accounting_method": "Accrual",
+        "accounting_method": accounting_method,
         "start_date": start_date.strftime("%Y-%m-%d"),
         "end_date": end_date.strftime("%Y-%m-%d"),
     }
+    if summarize_column_by is not None:
+        payload["summarize_column_by"] = summarize_column_by
     headers = {
         "Accept": "application/json",
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
-    url = f"{BASE_URL}/v3/company/{realm_id}/reports/{report_name}"
-    res = requests.get(url, headers=headers, params=payload)
-    resobj = json.loads(res.text)
-    rows = extract_rows(resobj)
-    df = pd.DataFrame(rows)
-    return df
+    url = f"{base_url}/v3/company/{realm_id}/reports/{report_name}"
+    res = _get_with_retries(session if session is not None else requests, url, headers, payload, rate_limiter)
+    return json.loads(res.text)
 
 
 def create_calendar_seq(start_year: int, end_year: int, data_freq = "Yearly"):
@@ -68,29 +363,65 @@ def create_calendar_seq(start_year: int, end_year: int, data_freq = "Yearly"):
     return dates
 
 
-def fetch_all_qbo_data(realm_id, access_token, start_year: int, end_year: int, data_freq = "Yearly"):
+def fetch_all_qbo_data(
+        realm_id, 
+        access_token, 
+        start_year: int, 
+        end_year: int, 
+        data_freq = "Yearly",
+        use_cache: bool = True,
+        cache_only: bool = QBO_CACHE_ONLY,
+        base_url: str = QBO_BASE_URL
+    ):
     """
-        Run the progress and collect all qbo data
+        Run the progress and collect all qbo data. Each report is pulled with one column per period,
+        closed periods in requests of up to QBO_MAX_PERIODS_PER_REQUEST periods that come from
+        the on disk report cache unless `use_cache` is False, and the open periods in one more request
     """
     report_list = ["ProfitAndLoss", "BalanceSheet"]
     datelist = create_calendar_seq(start_year, end_year, data_freq) + [dt.datetime(end_year + 1, 1, 1)]
+    periods = [(datelist[i], datelist[i+1] - dt.timedelta(days = 1)) for i in range(len(datelist) - 1)]
+
+    # closed periods never change, keep their requests stable so they stay cached
+    closed = [p for p in periods if is_closed_period(p[1])]
+    chunks = [closed[i:i + QBO_MAX_PERIODS_PER_REQUEST] for i in range(0, len(closed), QBO_MAX_PERIODS_PER_REQUEST)]
+    if len(closed) < len(periods):
+        chunks.append(periods[len(closed):])
 
     # make a combination of all parameters
     paramlist = []
     for r in report_list:
-        for i in range(len(datelist) - 1):
-            paramlist.append((r, datelist[i], datelist[i+1] - dt.timedelta(days = 1) ))
-
-    # finally run the loop
-    dflist = []
-    for i in stqdm(range(len(paramlist))):
-        report_name, start, end = paramlist[i]
-        df = get_qbo_report(realm_id, access_token, report_name, start, end)
-        df['Time'] = end  # accounting is consolidated as of end time
-        df['ReportType'] = report_name
-        dflist.append(df)
+        for chunk in chunks:
+            paramlist.append((r, chunk[0][0], chunk[-1][1]))
+    summarize_column_by = QBO_SUMMARIZE_COLUMN_BY[data_freq]
+
+    # fetch concurrently over one keep-alive session, within the QBO rate limits
+    session = create_qbo_session()
+    rate_limiter = TokenBucket()
+    cache = get_qbo_cache() if use_cache or cache_only else None
+    dflist = [None] * len(paramlist)
+    with ThreadPoolExecutor(max_workers=QBO_MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(
+                get_qbo_report, realm_id, access_token, report_name, start, end,
+                session, rate_limiter, cache, cache_only, "Accrual", summarize_column_by, base_url
+            ): i
+            for i, (report_name, start, end) in enumerate(paramlist)
+        }
+        try:
+            for future in stqdm(as_completed(futures), total=len(futures)):
+                i = futures[future]
+                df = future.result()    # accounting is consolidated as of the end of each period
+                df['ReportType'] = paramlist[i][0]
+                dflist[i] = df
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            session.close()
     
-    df = pd.concat(dflist)
+    df = qualify_colliding_lineitems(pd.concat(dflist, ignore_index=True))
 
     df2 = pd.pivot_table(df, values = 'Amount', columns = 'LineItem', index = 'Time', fill_value = 0.0).reset_index()
     return df2
@@ -0,0 +1,178 @@
+# ============================================
+#       Re-running the experiments of a simulation after its data changed,
+#       in dependency order, with the independent experiments run in parallel
+# ============================================
+
+from typing import Callable, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import perf_counter
+import pandas as pd
+
+from chronomodeler.constants import RERUN_WORKERS
+from chronomodeler.dbutils import db_scope, current_db
+from chronomodeler.models import Simulation, Experiment
+from chronomodeler.apimethods import get_simulation_data_initial, get_simulation_experiments_data, insert_data_to_experiment
+from chronomodeler.expconfig import (
+    ExperimentConfig, run_experiment, get_upstream_ordinals, run_params_dates, experiment_input_hash
+)
+
+
+def experiment_dependencies(experiments: Dict[int, Experiment]) -> Dict[int, List[int]]:
+    """
+        The dependency DAG of the experiments of a simulation, from ordinal to the ordinals
+        of the experiments whose output it uses through "Experiment Output" variables
+    """
+    return {
+        ordinal: sorted(set([
+            upstream for upstream in get_upstream_ordinals(ExperimentConfig(config = expp.config).get_variables_list())
+            if upstream in experiments
+        ]))
+        for ordinal, expp in experiments.items()
+    }
+
+
+def dependency_layers(dependencies: Dict[int, List[int]]) -> Tuple[List[List[int]], List[int]]:
+    """
+        Splits the DAG into layers (Kahn's algorithm), every experiment comes in the layer after
+        the last of its upstream experiments, so the experiments of a layer are independent of each other.
+        Also returns the experiments left out because they are on or behind a dependency cycle
+    """
+    remaining = { node: set(upstream) for node, upstream in dependencies.items() }
+    layers = []
+    while True:
+        layer = sorted([node for node, upstream in remaining.items() if len(upstream) == 0])
+        if len(layer) == 0:
+            break
+        layers.append(layer)
+        for node in layer:
+            del remaining[node]
+        for upstream in remaining.values():
+            upstream.difference_update(layer)
+    return layers, sorted(remaining.keys())
+
+
+def on_dependency_cycle(node: int, dependencies: Dict[int, List[int]]) -> bool:
+    """
+        Whether the experiment depends on its own output, directly or through other experiments
+    """
+    stack = list(dependencies.get(node, []))
+    seen = set()
+    while stack:
+        upstream = stack.pop()
+        if upstream == node:
+            return True
+        if upstream not in seen:
+            seen.add(upstream)
+            stack.extend(dependencies.get(upstream, []))
+    return False
+
+
+def rerun_experiment(
+        sim: Simulation,
+        userid: int,
+        expp: Experiment,
+        df: pd.DataFrame,
+        force: bool = False,
+        stop: Event = None
+    ) -> Tuple[str, str]:
+    """
+        Runs the experiment again with its stored run parameters on the current data, unless
+        its inputs are unchanged since the last run (or `force`). The result replaces the data
+        of the experiment, unless `stop` was set meanwhile (raising InterruptedError).
+        Returns the status ('rerun', 'unchanged' or 'skipped') and a message
+    """
+    if expp.run_params is None:
+        return 'skipped', "No run parameters recorded, save the experiment once from the Experiments page"
+    expconf = ExperimentConfig(config = expp.config)
+    upstream_ordinals = get_upstream_ordinals(expconf.get_variables_list())
+    upstream_data = get_simulation_experiments_data(sim, userid, upstream_ordinals)
+    input_hash = experiment_input_hash(expconf, expp.run_params, df, upstream_data)
+    if not force and input_hash == expp.input_hash:
+        return 'unchanged', ""
+
+    train_dates, test_dates, pred_dates = run_params_dates(expp.run_params)
+    result, shape, metrics = run_experiment(
+        expconf, df, train_dates, test_dates, pred_dates, sim, upstream_data=upstream_data
+    )
+    if stop is not None and stop.is_set():
+        raise InterruptedError(f"Re-run of experiment #{expp.ordinal} was stopped")
+    insert_data_to_experiment(
+        df = result.drop(labels=['Human Time'], axis = 1),
+        expp = expp,
+        sim = sim,
+        userid = userid,
+        bases = list(sim.get_experiments_by_ordinals(upstream_ordinals).values())
+    )
+    # recorded after the data, so a failed write leaves the experiment to be run again
+    expp.results = metrics
+    expp.input_hash = input_hash
+    expp.update()
+    return 'rerun', f"Trained on {shape[0]} observations and {shape[1]} features"
+
+
+def _rerun_in_scope(database: str, *args) -> Tuple[str, str, float]:
+    start = perf_counter()
+    with db_scope(database):
+        status, message = rerun_experiment(*args)
+    return status, message, perf_counter() - start
+
+
+def rerun_experiments(
+        sim: Simulation,
+        userid: int,
+        force: bool = False,
+        progress: Callable[[float, str], None] = None,
+        max_workers: int = RERUN_WORKERS
+    ) -> List[Dict]:
+    """
+        Re-runs the experiments of the simulation on its current initial data, layer by layer
+        of their dependency DAG, the experiments of a layer in parallel on `max_workers` threads.
+        Only the experiments whose inputs changed are run (all of them with `force`), the ones
+        downstream of a failed experiment are skipped. Returns one report row per experiment
+    """
+    if progress is None:
+        progress = lambda fraction, message: None
+    experiments = sim.get_experiments()
+    dependencies = experiment_dependencies(experiments)
+    layers, cyclic = dependency_layers(dependencies)
+    df = get_simulation_data_initial(sim, userid)
+
+    def report_row(ordinal: int, status: str, message: str, seconds: float = 0.0):
+        return { 'ordinal': ordinal, 'exp_name': experiments[ordinal].exp_name, 'status': status, 'message': message, 'seconds': seconds }
+
+    report = {}
+    for ordinal in cyclic:
+        if on_dependency_cycle(ordinal, dependencies):
+            report[ordinal] = report_row(ordinal, 'skipped', "On a dependency cycle")
+        else:
+            blocked = [n for n in dependencies[ordinal] if n in cyclic]
+            report[ordinal] = report_row(ordinal, 'skipped', f"Upstream experiment #{blocked[0]} is on or behind a dependency cycle")
+    database = current_db()
+    stop = Event()
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chronomodeler-rerun") as executor:
+        for i, layer in enumerate(layers):
+            futures = {}
+            for ordinal in layer:
+                blocked = [n for n in dependencies[ordinal] if report[n]['status'] in ('failed', 'skipped')]
+                if len(blocked) > 0:
+                    report[ordinal] = report_row(ordinal, 'skipped', f"Upstream experiment #{blocked[0]} did not run")
+                else:
+                    futures[ordinal] = executor.submit(_rerun_in_scope, database, sim, userid, experiments[ordinal], df, force, stop)
+            try:
+                for ordinal in layer:
+                    if ordinal in futures:
+                        try:
+                            report[ordinal] = report_row(ordinal, *futures[ordinal].result())
+                        except Exception as e:
+                            report[ordinal] = report_row(ordinal, 'failed', f"{type(e).__name__}: {e}")
+                    done += 1
+                    progress(done / max(len(experiments), 1), f"Layer {i + 1} of {len(layers)}: experiment #{ordinal} {report[ordinal]['status']}")
+            except BaseException:
+                # e.g. the job was cancelled: nothing more is started, and the running experiments do not write
+                stop.set()
+                for future in futures.values():
+                    future.cancel()
+                raise
+    return [report[ordinal] for ordinal in sorted(report.keys())]
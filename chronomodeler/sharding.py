@@ -0,0 +1,158 @@
+# ============================================
+#       Optional per user sharding: the experiments and simulation data tables
+#       of every user live in their own SQLite file, users and simulations stay in
+#       the main database. Enabled by CHRONOMODELER_SHARDING=1
+# ============================================
+
+import os, shutil, sqlite3, threading
+from contextlib import contextmanager
+
+from chronomodeler.constants import SQLITE_DB, SHARDING_ENABLED, SHARD_DIR, SHARD_ID_BITS, DATA_BACKEND, COLUMNAR_DATA_DIR
+from chronomodeler.dbutils import db_scope, db_transaction, db_query_fetch, get_db_conn, close_db_conn, quote_identifier
+
+
+_ready_shards = set()
+_ready_lock = threading.Lock()
+
+
+def shard_path(userid: int) -> str:
+    return os.path.join(SHARD_DIR, f"user_{int(userid)}.sqlite")
+
+
+def userid_for_expid(expid: int) -> int:
+    # experiment ids of a shard start at userid << SHARD_ID_BITS
+    return int(expid) >> SHARD_ID_BITS
+
+
+def userid_for_simid(simid: int) -> int:
+    from chronomodeler.models import Simulation
+    sim = Simulation.get(simid)
+    if sim is None:
+        raise ValueError(f"No simulation {simid}")
+    return sim.userid
+
+
+def shard_database(userid: int) -> str:
+    """
+        The database file of the user, created and migrated on first use
+    """
+    path = shard_path(userid)
+    if path not in _ready_shards:
+        with _ready_lock:
+            if path not in _ready_shards:
+                from chronomodeler.migrations import run_shard_migrations
+                os.makedirs(SHARD_DIR, exist_ok=True)
+                with db_scope(path):
+                    run_shard_migrations(userid)
+                _ready_shards.add(path)
+    return path
+
+
+@contextmanager
+def user_scope(userid: int):
+    """
+        Routes the db_* calls of the block to the shard of the user (to the main database when sharding is off)
+    """
+    with db_scope(shard_database(userid) if SHARDING_ENABLED else SQLITE_DB):
+        yield
+
+
+def drop_shard(userid: int):
+    """
+        Deletes all the experiments and simulation data of the user at once, by removing the shard file
+    """
+    path = shard_path(userid)
+    with _ready_lock:
+        _ready_shards.discard(path)
+    with db_scope(path):
+        close_db_conn()
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def backup_shard(userid: int, destination: str):
+    """
+        Consistent copy of the user's shard (taken with the SQLite online backup API, writers are not blocked)
+    """
+    with user_scope(userid):
+        target = sqlite3.connect(destination)
+        try:
+            get_db_conn().backup(target)
+        finally:
+            target.close()
+
+
+def migrate_to_shards(progress = print):
+    """
+        Moves the experiments, their delta metadata and the simulation data tables of every user
+        from the main database to the user's shard. Experiment ids get the user's offset
+        (userid << SHARD_ID_BITS), so they are rewritten in the data tables as well.
+        A user is skipped if their shard already holds experiments
+    """
+    from chronomodeler.models import User, Simulation, Experiment
+    from chronomodeler.apimethods import _data_table_name
+    from chronomodeler.storage import PARTITION_DELTA_TABLE
+
+    if not SHARDING_ENABLED:
+        raise RuntimeError("Sharding is not enabled, set CHRONOMODELER_SHARDING=1 first")
+    for user in User.iter_all():
+        offset = int(user.userid) << SHARD_ID_BITS
+        with user_scope(user.userid):
+            if db_query_fetch(f"SELECT COUNT(1) AS n FROM main.{Experiment._table};", ())[0]['n'] > 0:
+                progress(f"Skipping {user.username}, the shard already holds experiments")
+                continue
+            conn = get_db_conn()
+            conn.execute("ATTACH DATABASE ? AS src;", (SQLITE_DB, ))
+            try:
+                with db_transaction():
+                    sims = conn.execute(f"SELECT simid, sim_name FROM src.{Simulation._table} WHERE userid = ?;", (user.userid, )).fetchall()
+                    collist = [col for col in Experiment._columns if col != Experiment._identity]
+                    # unqualified names would fall through to the attached database, so the shard is always main.
+                    conn.execute(f"INSERT INTO main.{Experiment._table}({Experiment._identity}, {','.join(collist)}) \
+                        SELECT e.{Experiment._identity} + ?, {','.join(['e.' + col for col in collist])} FROM src.{Experiment._table} e \
+                        INNER JOIN src.{Simulation._table} s ON s.simid = e.simid WHERE s.userid = ?;", (offset, user.userid))
+                    srctables = set([row[0] for row in conn.execute("SELECT name FROM src.sqlite_master WHERE type = 'table';").fetchall()])
+                    for simid, sim_name in sims:
+                        table_name = _data_table_name(user.username, sim_name)
+                        if table_name in srctables:
+                            ddl = conn.execute("SELECT sql FROM src.sqlite_master WHERE type = 'table' AND name = ?;", (table_name, )).fetchone()[0]
+                            conn.execute(f"DROP TABLE IF EXISTS main.{quote_identifier(table_name)};")
+                            conn.execute(ddl)   # CREATE TABLE without a schema name creates in main
+                            conn.execute(f"INSERT INTO main.{quote_identifier(table_name)} SELECT * FROM src.{quote_identifier(table_name)};")
+                            conn.execute(f"UPDATE main.{quote_identifier(table_name)} SET experiment_id = experiment_id + ?;", (offset, ))
+                            conn.execute(f"CREATE INDEX IF NOT EXISTS main.idx_{table_name}_expid_time ON {table_name}(experiment_id, Time);")
+                        if PARTITION_DELTA_TABLE in srctables:
+                            conn.execute(f"INSERT INTO main.{PARTITION_DELTA_TABLE} \
+                                SELECT table_name, expid + ?, base_expid + ?, columns, inherited_columns, inherited_times \
+                                FROM src.{PARTITION_DELTA_TABLE} WHERE table_name = ?;", (offset, offset, table_name))
+            finally:
+                conn.execute("DETACH DATABASE src;")
+
+        # the copy is committed, now remove the originals from the main database
+        with db_scope(SQLITE_DB), db_transaction() as conn:
+            for simid, sim_name in sims:
+                table_name = _data_table_name(user.username, sim_name)
+                conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)};")
+                conn.execute(f"DELETE FROM {Experiment._table} WHERE simid = ?;", (simid, ))
+                if DATA_BACKEND == "columnar":
+                    _offset_partition_dirs(os.path.join(COLUMNAR_DATA_DIR, table_name), offset)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?;", (PARTITION_DELTA_TABLE, )).fetchone() is not None:
+                conn.executemany(f"DELETE FROM {PARTITION_DELTA_TABLE} WHERE table_name = ?;",
+                    [(_data_table_name(user.username, sim_name), ) for _, sim_name in sims])
+        progress(f"Moved {len(sims)} simulations of {user.username} to {shard_path(user.userid)}")
+    Experiment._invalidate_cache()
+
+
+def _offset_partition_dirs(table_dir: str, offset: int):
+    # column file partitions are directories named by experiment id
+    if not os.path.isdir(table_dir):
+        return
+    for name in os.listdir(table_dir):
+        if name.isdigit() and int(name) < offset:
+            shutil.move(os.path.join(table_dir, name), os.path.join(table_dir, str(int(name) + offset)))
+
+
+if __name__ == '__main__':
+    # python -m chronomodeler.sharding, run once after setting CHRONOMODELER_SHARDING=1
+    migrate_to_shards()
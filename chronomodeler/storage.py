@@ -0,0 +1,481 @@
+# ============================================
+#       Storage backends for the per simulation time series data
+# ============================================
+
+from typing import Dict, List
+import os, json, shutil, uuid
+import pandas as pd
+import numpy as np
+from itertools import repeat
+
+from chronomodeler.constants import DATA_BACKEND, COLUMNAR_DATA_DIR, DATA_INSERT_CHUNK_SIZE, DELTA_PARTITIONS_ENABLED
+from chronomodeler.dbutils import get_db_conn, db_query_execute, db_query_fetch, db_write, quote_identifier
+
+
+def ensure_data_table_indexes(table_name: str):
+    sql = f"CREATE INDEX IF NOT EXISTS idx_{table_name}_expid_time ON {table_name}(experiment_id, Time);"
+    db_query_execute(sql, ())
+
+
+def _sql_column_type(series: pd.Series):
+    kind = series.dtype.kind
+    if kind == 'M':
+        return "INTEGER"    # datetimes are stored as unix epoch seconds
+    elif kind in 'iub':
+        return "INTEGER"
+    elif kind == 'f':
+        return "REAL"
+    else:
+        return "TEXT"
+
+def _sql_column_values(series: pd.Series, start: int, stop: int, epoch_time: bool = True):
+    """
+        Python values of rows [start, stop) of a column, ready to be bound to a query.
+        Only this slice is converted, the dataframe itself is never copied
+    """
+    values = series.to_numpy()[start:stop]
+    if series.dtype.kind == 'M':
+        isnat = np.isnat(values)
+        if epoch_time:
+            converted = values.astype('datetime64[s]').astype('int64').tolist()
+        else:
+            # legacy tables created by pandas store TIMESTAMP text
+            converted = np.char.replace(np.datetime_as_string(values.astype('datetime64[s]')), 'T', ' ').tolist()
+        return [None if nat else val for val, nat in zip(converted, isnat)]
+    return values.tolist()   # NaN is bound as NULL by sqlite
+
+def _get_table_columns(conn, table_name: str):
+    rows = conn.execute(f"PRAGMA table_info({quote_identifier(table_name)});").fetchall()
+    return { row[1]: row[2] for row in rows }   # column name -> declared type
+
+
+class SQLiteDataStore:
+    """
+        One SQLite table per simulation, holding the rows of all its experiments
+        tagged by the experiment_id column
+    """
+
+    name = "sqlite"
+
+    def _create_table(self, conn, table_name: str, df: pd.DataFrame):
+        coldefs = [f"{quote_identifier(col)} {_sql_column_type(df[col])}" for col in df.columns if col != 'experiment_id']
+        conn.execute(f"DROP TABLE IF EXISTS {table_name};")
+        conn.execute(f"CREATE TABLE {table_name} ({', '.join(coldefs + ['experiment_id INTEGER'])});")
+        ensure_data_table_indexes(table_name)
+
+    def write_partition(
+            self,
+            table_name: str,
+            expid: int,
+            df: pd.DataFrame,
+            initial: bool = False,
+            chunksize: int = DATA_INSERT_CHUNK_SIZE,
+            extra_write = None
+        ):
+        """
+            Replaces the rows of the experiment in a single write of the database writer, using executemany in chunks.
+            For the initial experiment the table is (re)created when its columns differ from the dataframe.
+            `extra_write(conn)` (e.g. the delta metadata) is committed atomically with the rows
+        """
+        columns = [col for col in df.columns if col != 'experiment_id']
+        def write(conn):
+            self._write_rows(conn, table_name, expid, df, columns, initial, chunksize)
+            if extra_write is not None:
+                extra_write(conn)
+        db_write(write)
+        return df.shape[0]
+
+    def _write_rows(self, conn, table_name: str, expid: int, df: pd.DataFrame, columns: List[str], initial: bool, chunksize: int):
+        existing = _get_table_columns(conn, table_name)
+        if initial and set(existing.keys()) != set(columns + ['experiment_id']):
+            self._create_table(conn, table_name, df)
+            existing = _get_table_columns(conn, table_name)
+        else:
+            conn.execute(f"DELETE FROM {table_name} WHERE experiment_id = ?;", (expid, ))
+
+        epoch_time = existing.get('Time', 'INTEGER').upper() == 'INTEGER'
+        sql = f"INSERT INTO {table_name}({', '.join([quote_identifier(col) for col in columns] + ['experiment_id'])}) \
+            VALUES ({', '.join(['?'] * (len(columns) + 1))});"
+        for start in range(0, df.shape[0], chunksize):
+            stop = min(start + chunksize, df.shape[0])
+            colvalues = [_sql_column_values(df[col], start, stop, epoch_time) for col in columns]
+            conn.executemany(sql, zip(*colvalues, repeat(expid, stop - start)))
+        return df.shape[0]
+
+    def delete_partition(self, table_name: str, expid: int):
+        sql = f"DELETE FROM {table_name} WHERE experiment_id = ?;"
+        db_query_execute(sql, (expid, ))
+
+    def drop_table(self, table_name: str):
+        sql = f"DROP TABLE IF EXISTS {table_name};"
+        db_query_execute(sql, ())
+
+    def read_partitions(self, table_name: str, expids: List[int], columns: List[str] = None) -> Dict[int, pd.DataFrame]:
+        """
+            Reads the partitions of the experiments, only the given columns (and experiment_id) if any
+        """
+        projection = "*"
+        if columns is not None:
+            existing = _get_table_columns(get_db_conn(), table_name)
+            projection = ', '.join([quote_identifier(col) for col in columns if col in existing and col != 'experiment_id'] + ['experiment_id'])
+        sql = f"SELECT {projection} FROM {table_name} WHERE experiment_id IN ({','.join(['?'] * len(expids))});"
+        df = pd.read_sql(sql, get_db_conn(), params=tuple(expids), index_col=None,
+            parse_dates=['Time'] if columns is None or 'Time' in columns else None)
+        if len(expids) == 1:
+            return { expids[0]: df }
+        groups = { expid: subdf.reset_index(drop = True) for expid, subdf in df.groupby('experiment_id') }
+        return { expid: groups.get(expid, df.iloc[0:0]) for expid in expids }
+
+
+class ColumnarDataStore:
+    """
+        One directory per simulation and one sub directory per experiment partition,
+        holding a .npy file per column and a small manifest.json. Columns are memory mapped
+        on read, so the values never go through Python objects. Partitions are written
+        to a temporary directory and swapped in, so readers never see half written data
+    """
+
+    name = "columnar"
+
+    def __init__(self, root: str = COLUMNAR_DATA_DIR):
+        self.root = root
+
+    def _table_dir(self, table_name: str):
+        return os.path.join(self.root, table_name)
+
+    def _partition_dir(self, table_name: str, expid: int):
+        return os.path.join(self._table_dir(table_name), str(int(expid)))
+
+    def _schema(self, table_name: str):
+        path = os.path.join(self._table_dir(table_name), "schema.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _write_schema(self, table_name: str, columns: List[str]):
+        os.makedirs(self._table_dir(table_name), exist_ok=True)
+        path = os.path.join(self._table_dir(table_name), "schema.json")
+        tmppath = path + f".{uuid.uuid4().hex}.tmp"
+        with open(tmppath, 'w') as f:
+            json.dump({ 'columns': columns }, f)
+        os.replace(tmppath, path)
+
+    @staticmethod
+    def _column_array(series: pd.Series):
+        values = series.to_numpy()
+        if values.dtype.kind == 'O':
+            # fixed width unicode keeps the file memory mappable (object arrays need pickle)
+            values = np.array(['' if v is None else str(v) for v in values])
+        return values
+
+    def write_partition(
+            self,
+            table_name: str,
+            expid: int,
+            df: pd.DataFrame,
+            initial: bool = False,
+            chunksize: int = DATA_INSERT_CHUNK_SIZE,
+            extra_write = None
+        ):
+        columns = [col for col in df.columns if col != 'experiment_id']
+        schema = self._schema(table_name)
+        if initial and (schema is None or set(schema['columns']) != set(columns)):
+            self.drop_table(table_name)
+            self._write_schema(table_name, columns)
+        elif schema is None:
+            raise FileNotFoundError(f"No data table {table_name}, the initial experiment has to be written first")
+
+        final_dir = self._partition_dir(table_name, expid)
+        tmp_dir = final_dir + f".{uuid.uuid4().hex}.tmp"
+        os.makedirs(tmp_dir)
+        manifest = { 'expid': int(expid), 'rows': int(df.shape[0]), 'columns': [] }
+        for i, col in enumerate(columns):
+            filename = f"{i}.npy"
+            values = self._column_array(df[col])
+            np.save(os.path.join(tmp_dir, filename), values, allow_pickle=False)
+            manifest['columns'].append({ 'name': col, 'file': filename, 'dtype': str(values.dtype) })
+        with open(os.path.join(tmp_dir, "manifest.json"), 'w') as f:
+            json.dump(manifest, f)
+
+        # swap the new partition in, the old one (if any) is removed afterwards
+        old_dir = None
+        if os.path.exists(final_dir):
+            old_dir = final_dir + f".{uuid.uuid4().hex}.old"
+            os.replace(final_dir, old_dir)
+        os.replace(tmp_dir, final_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)
+        if extra_write is not None:
+            db_write(extra_write)
+        return df.shape[0]
+
+    def delete_partition(self, table_name: str, expid: int):
+        shutil.rmtree(self._partition_dir(table_name, expid), ignore_errors=True)
+
+    def drop_table(self, table_name: str):
+        shutil.rmtree(self._table_dir(table_name), ignore_errors=True)
+
+    def _read_partition(self, table_name: str, expid: int, columns: List[str] = None):
+        part_dir = self._partition_dir(table_name, expid)
+        manifest_path = os.path.join(part_dir, "manifest.json")
+        if not os.path.exists(manifest_path):
+            schema = self._schema(table_name)
+            return pd.DataFrame(columns=(schema['columns'] if schema is not None else []) + ['experiment_id'])
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        data = {
+            col['name']: np.load(os.path.join(part_dir, col['file']), mmap_mode='r', allow_pickle=False)
+            for col in manifest['columns'] if columns is None or col['name'] in columns
+        }
+        df = pd.DataFrame(data, copy=False)
+        df['experiment_id'] = np.int64(expid)
+        return df
+
+    def read_partitions(self, table_name: str, expids: List[int], columns: List[str] = None) -> Dict[int, pd.DataFrame]:
+        return { expid: self._read_partition(table_name, expid, columns) for expid in expids }
+
+
+_data_stores = {
+    SQLiteDataStore.name: SQLiteDataStore,
+    ColumnarDataStore.name: ColumnarDataStore
+}
+
+def get_data_store(backend: str = DATA_BACKEND):
+    """
+        The storage backend for simulation data, selected per deployment by the
+        CHRONOMODELER_DATA_BACKEND environment variable ("sqlite" by default or "columnar")
+    """
+    if backend not in _data_stores:
+        raise ValueError(f"Invalid data backend {backend}, choose from {', '.join(_data_stores.keys())}")
+    return _data_stores[backend]()
+
+
+def copy_data_tables(source, target, tables: Dict[str, List[int]], progress = print):
+    """
+        Copies the given partitions, a dict of table name -> expids (initial experiment first),
+        from one storage backend to another, e.g. from the existing SQLite tables to column files
+    """
+    for table_name, expids in tables.items():
+        partitions = source.read_partitions(table_name, expids)
+        for i, expid in enumerate(expids):
+            target.write_partition(table_name, expid, partitions[expid], initial=(i == 0))
+        progress(f"Copied {len(expids)} partitions of {table_name}")
+
+
+# ============================================
+#       Delta encoded experiment partitions
+# ============================================
+
+PARTITION_DELTA_TABLE = "partition_deltas"
+
+
+def create_partition_delta_table(conn):
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {PARTITION_DELTA_TABLE} ( \
+        table_name varchar not null, \
+        expid integer not null, \
+        base_expid integer not null, \
+        columns text not null, \
+        inherited_columns text not null, \
+        inherited_times text not null, \
+        PRIMARY KEY (table_name, expid) \
+    );")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{PARTITION_DELTA_TABLE}_base ON {PARTITION_DELTA_TABLE}(table_name, base_expid);")
+
+
+def _time_keys(times: pd.Series):
+    # unix epoch seconds, so that frames read from either backend (any datetime unit) align
+    values = times.to_numpy()
+    if values.dtype.kind != 'M':
+        values = pd.to_datetime(times).to_numpy()
+    return values.astype('datetime64[s]').astype('int64')
+
+
+def encode_delta(df: pd.DataFrame, base: pd.DataFrame):
+    """
+        Compares a partition with its (reconstructed) base, aligned on Time, and returns
+        (stored frame, inherited columns, inherited times): a column is inherited when all its
+        values equal the base, a row when all its remaining values do. Only what differs is stored.
+        Returns None when the frames cannot be aligned (no Time column or duplicate times)
+    """
+    if 'Time' not in df.columns or 'Time' not in base.columns or df.shape[0] == 0:
+        return None
+    keys, base_keys = _time_keys(df['Time']), _time_keys(base['Time'])
+    if len(np.unique(keys)) != len(keys) or len(np.unique(base_keys)) != len(base_keys):
+        return None
+    columns = [col for col in df.columns if col not in ('Time', 'experiment_id')]
+    aligned = base.set_index(base_keys).reindex(keys)
+    present = np.isin(keys, base_keys)
+    equal = {}
+    for col in columns:
+        if col not in aligned.columns:
+            equal[col] = np.zeros(len(keys), dtype=bool)
+            continue
+        a, b = df[col].to_numpy(), aligned[col].to_numpy()
+        try:
+            same = np.asarray(a == b, dtype=bool)
+        except TypeError:
+            same = np.zeros(len(keys), dtype=bool)   # incomparable dtypes
+        if same.shape != present.shape:
+            same = np.zeros(len(keys), dtype=bool)
+        equal[col] = present & (same | (pd.isna(a) & pd.isna(b)))
+    inherited_columns = [col for col in columns if equal[col].all()]
+    stored_columns = [col for col in columns if col not in inherited_columns]
+    inherited_rows = present.copy()
+    for col in stored_columns:
+        inherited_rows &= equal[col]
+    stored = df.loc[~inherited_rows, ['Time'] + stored_columns].reset_index(drop = True)
+    return stored, inherited_columns, keys[inherited_rows].tolist()
+
+
+def apply_delta(stored: pd.DataFrame, base: pd.DataFrame, delta: dict, base_index: pd.Index = None) -> pd.DataFrame:
+    """
+        Rebuilds a partition from its stored delta and its (reconstructed) base,
+        aligning on Time with one vectorized index lookup per frame.
+        `base_index` (the Time keys of the base) can be passed to share it between dependents
+    """
+    expid = delta['expid']
+    columns = json.loads(delta['columns'])
+    inherited_columns = [col for col in json.loads(delta['inherited_columns']) if col in base.columns]
+    inherited_times = np.array(json.loads(delta['inherited_times']), dtype='int64')
+    if base_index is None:
+        base_index = pd.Index(_time_keys(base['Time']))
+    df = stored
+    if len(inherited_times) > 0:
+        positions = base_index.get_indexer(inherited_times)
+        rows = base.iloc[positions[positions >= 0]][[col for col in columns if col in base.columns]]
+        rows = rows.assign(experiment_id = np.int64(expid))
+        df = pd.concat([df, rows], ignore_index=True)
+        df = df.iloc[np.argsort(_time_keys(df['Time']), kind='stable')].reset_index(drop = True)
+    if len(inherited_columns) > 0:
+        # inherited columns matched the base on every row, so every time is found
+        positions = base_index.get_indexer(_time_keys(df['Time']))
+        data = { col: df[col].to_numpy() for col in df.columns }
+        data.update({ col: base[col].to_numpy().take(positions) for col in inherited_columns })
+        df = pd.DataFrame(data, copy=False)   # built in one go, instead of inserting column by column
+    ordered = [col for col in columns if col in df.columns]
+    return df[ordered + [col for col in df.columns if col not in ordered]]
+
+
+def _load_deltas(table_name: str, expids: List[int]) -> Dict[int, dict]:
+    if len(expids) == 0:
+        return {}
+    rows = db_query_fetch(f"SELECT * FROM {PARTITION_DELTA_TABLE} WHERE table_name = ? AND expid IN ({','.join(['?'] * len(expids))});",
+        tuple([table_name] + list(expids)))
+    return { row['expid']: row for row in rows }
+
+
+def read_experiment_partitions(store, table_name: str, expids: List[int]) -> Dict[int, pd.DataFrame]:
+    """
+        Reads partitions through the storage backend and rebuilds the delta encoded ones,
+        loading (and rebuilding) their bases as needed. Bases are read once per call and,
+        unless requested themselves, only with the columns their dependents inherit
+    """
+    result = {}
+    deltas = {}
+    pending, columns = list(dict.fromkeys(expids)), None
+    while len(pending) > 0:
+        result.update(store.read_partitions(table_name, pending, columns))
+        new_deltas = _load_deltas(table_name, pending)
+        deltas.update(new_deltas)
+        pending = list(dict.fromkeys([delta['base_expid'] for delta in new_deltas.values() if delta['base_expid'] not in result]))
+        needed = set(['Time'])
+        for delta in new_deltas.values():
+            needed.update(json.loads(delta['columns']))
+        columns = list(needed)
+
+    base_indexes = {}
+    def rebuild(expid, seen = ()):
+        if expid in deltas and expid not in seen:
+            delta = deltas.pop(expid)
+            base = rebuild(delta['base_expid'], seen + (expid, ))
+            if delta['base_expid'] not in base_indexes:
+                base_indexes[delta['base_expid']] = pd.Index(_time_keys(base['Time']))
+            result[expid] = apply_delta(result[expid], base, delta, base_indexes[delta['base_expid']])
+        return result[expid]
+    return { expid: rebuild(expid) for expid in expids }
+
+
+def _delete_delta(table_name: str, expid: int):
+    def write(conn):
+        conn.execute(f"DELETE FROM {PARTITION_DELTA_TABLE} WHERE table_name = ? AND expid = ?;", (table_name, expid))
+    return write
+
+
+def materialize_dependents(store, table_name: str, expid: int):
+    """
+        Rewrites the partitions encoded against `expid` as full copies,
+        so the base can then be rewritten or deleted
+    """
+    rows = db_query_fetch(f"SELECT expid FROM {PARTITION_DELTA_TABLE} WHERE table_name = ? AND base_expid = ?;", (table_name, expid))
+    dependents = [row['expid'] for row in rows]
+    if len(dependents) == 0:
+        return
+    partitions = read_experiment_partitions(store, table_name, dependents)
+    for dependent in dependents:
+        store.write_partition(table_name, dependent, partitions[dependent], extra_write=_delete_delta(table_name, dependent))
+
+
+def write_experiment_partition(
+        store,
+        table_name: str,
+        expid: int,
+        df: pd.DataFrame,
+        initial: bool = False,
+        base_expids: List[int] = None,
+        chunksize: int = DATA_INSERT_CHUNK_SIZE
+    ) -> dict:
+    """
+        Writes an experiment partition, delta encoded against whichever of `base_expids` leaves the
+        fewest cells to store (a full copy when no base helps). Partitions encoded against this one
+        are materialized first. Returns the rows written and the stored / total cell counts
+    """
+    materialize_dependents(store, table_name, expid)
+    columns = [col for col in df.columns if col != 'experiment_id']
+    total_cells = df.shape[0] * len(columns)
+    best = None
+    candidates = [base for base in dict.fromkeys(base_expids or []) if base != expid]
+    if DELTA_PARTITIONS_ENABLED and not initial and len(candidates) > 0:
+        bases = read_experiment_partitions(store, table_name, candidates)
+        for base_expid in candidates:
+            encoded = encode_delta(df, bases[base_expid])
+            if encoded is None:
+                continue
+            cells = encoded[0].shape[0] * encoded[0].shape[1]
+            if cells < total_cells and (best is None or cells < best[0]):
+                best = (cells, base_expid, encoded)
+
+    if best is None:
+        store.write_partition(table_name, expid, df, initial=initial, chunksize=chunksize, extra_write=_delete_delta(table_name, expid))
+        return { 'rows': df.shape[0], 'stored_cells': total_cells, 'total_cells': total_cells }
+
+    cells, base_expid, (stored, inherited_columns, inherited_times) = best
+    def write_delta(conn):
+        conn.execute(f"INSERT OR REPLACE INTO {PARTITION_DELTA_TABLE} \
+            (table_name, expid, base_expid, columns, inherited_columns, inherited_times) VALUES (?, ?, ?, ?, ?, ?);",
+            (table_name, expid, base_expid, json.dumps(columns), json.dumps(inherited_columns), json.dumps(inherited_times)))
+    store.write_partition(table_name, expid, stored, initial=False, chunksize=chunksize, extra_write=write_delta)
+    return { 'rows': df.shape[0], 'stored_cells': cells, 'total_cells': total_cells }
+
+
+def delete_experiment_partition(store, table_name: str, expid: int):
+    materialize_dependents(store, table_name, expid)
+    store.delete_partition(table_name, expid)
+    db_write(_delete_delta(table_name, expid))
+
+
+def drop_experiment_partitions(store, table_name: str):
+    store.drop_table(table_name)
+    db_query_execute(f"DELETE FROM {PARTITION_DELTA_TABLE} WHERE table_name = ?;", (table_name, ))
+
+
+if __name__ == '__main__':
+    # python -m chronomodeler.storage <source backend> <target backend>
+    import sys
+    from chronomodeler.apimethods import list_simulation_data_partitions, list_simulation_data_tables
+    source_backend, target_backend = sys.argv[1:3] if len(sys.argv) >= 3 else ("sqlite", "columnar")
+    tables = list_simulation_data_partitions()
+    if source_backend == SQLiteDataStore.name:
+        existing = set(list_simulation_data_tables())
+        tables = { table_name: expids for table_name, expids in tables.items() if table_name in existing }
+    copy_data_tables(get_data_store(source_backend), get_data_store(target_backend), tables)
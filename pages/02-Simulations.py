@@ -1,12 +1,12 @@
 import streamlit as st
 from streamlit_searchbox import st_searchbox
-import numpy as np
 import os, json, re
 import pandas as pd
+from time import sleep
 
-from chronomodeler.constants import TIME_FORMAT_LIST
+from chronomodeler.constants import TIME_FORMAT_LIST, QBO_CACHE_ONLY, JOB_POLL_INTERVAL
 from chronomodeler.authentication import requires_auth, get_auth_userid
-from chronomodeler.models import User, UserAuthLevel, Simulation, Experiment
+from chronomodeler.models import User, UserAuthLevel, Simulation, Experiment, JobStatus
 from chronomodeler.apimethods import (
     insert_data_to_experiment, 
     delete_simulation_data_table,
@@ -14,20 +14,36 @@ from chronomodeler.apimethods import (
     delete_data_from_experiment
 )
 from chronomodeler.qboutils import fetch_all_qbo_data
+from chronomodeler.ingest import INGEST_FORMATS, list_sheets, read_upload
+from chronomodeler.preprocessor import preprocess_data
+from chronomodeler.jobs import job_key, dataframe_fingerprint, submit_job, get_job, cancel_job, load_job_result
+from chronomodeler.rerun import rerun_experiments
+
+
+AUTO_TIME_FORMAT = 'Auto Detect'
+
+def show_preprocess_timings(subdf: pd.DataFrame, timings: dict):
+    stages = ', '.join([f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in timings.items()])
+    st.success(f"Preprocessing completed: Final row count {subdf.shape[0]}!")
+    if subdf.shape[0] == 0:
+        st.warning("No row has a valid time, check the time column and the time format")
+    st.caption(f"Preprocessing took {sum(timings.values()) * 1000:.0f} ms ({stages})")
 
 
 def simulationCreateManualDataSection(sim_name, userid):
     # Step 1: Upload File and Parse Excel Sheet
     with st.form(key='input-file'):
         st.subheader('Input File Details')
-        input_f = st.file_uploader('Input File', accept_multiple_files=False)
+        input_f = st.file_uploader('Input File', type=INGEST_FORMATS, accept_multiple_files=False)
+        input_sheet_name = None
         if input_f is not None:
-            xl = pd.ExcelFile(input_f)
-            input_sheet_name = st.selectbox('Input Excel Sheet Name', options=xl.sheet_names)
+            sheet_names = list_sheets(input_f.getvalue(), input_f.name)
+            if len(sheet_names) > 0:
+                input_sheet_name = st.selectbox('Input Excel Sheet Name', options=sheet_names)
         
-        parse_file = st.form_submit_button('Parse Excel Sheet')
+        parse_file = st.form_submit_button('Parse File')
         if parse_file and input_f is not None:
-            df = xl.parse(sheet_name=input_sheet_name)
+            df = read_upload(input_f.getvalue(), input_f.name, input_sheet_name)
             st.success(f"Found {df.shape[0]} rows and {df.shape[1]} columns in the dataset")
             st.session_state['data'] = df
     
@@ -44,11 +60,20 @@ def simulationCreateQBODataSection(sim_name, userid):
     with colqbo_3:
         data_freq = st.radio('Data Frequency', options=['Yearly', 'Monthly'])
     
-    fetch_data = st.button('Fetch QBO Data using API', help='Note that this may incur API cost / charges at your developer account')
+    colqbo_4, colqbo_5 = st.columns(2)
+    with colqbo_4:
+        cache_only = st.checkbox('Use cached reports only (offline)', value=QBO_CACHE_ONLY, help='Reproduce the data from previously fetched reports without calling the API')
+    with colqbo_5:
+        refresh = st.checkbox('Refetch all periods', value=False, help='Ignore the cached reports of closed periods', disabled=cache_only)
+
+    fetch_data = st.button('Fetch QBO Data using API', help='Note that this may incur API cost / charges at your developer account. Reports of closed periods are served from the local cache')
     if fetch_data:
-        if realm_id is not None and access_token is not None and realm_id != '' and access_token != '':
-            df = fetch_all_qbo_data(realm_id, access_token, start_year, end_year, data_freq)  # fetches the raw data
-            st.session_state['qborawdata'] = df
+        if realm_id is not None and realm_id != '' and (cache_only or (access_token is not None and access_token != '')):
+            try:
+                df = fetch_all_qbo_data(realm_id, access_token, start_year, end_year, data_freq, use_cache=not refresh, cache_only=cache_only)  # fetches the raw data
+                st.session_state['qborawdata'] = df
+            except LookupError as e:
+                st.error(str(e))
         else:
             st.error('Invalid realmid or access token')
 
@@ -96,7 +121,6 @@ def simulationCreateSection(userid):
                 col_names = { col: re.sub(r'\n+', ' ', col) for col in collist}
             else:
                 col_names = { col: re.sub(r'\n+', ' ', col) for col in collist if col != 'Time'}
-            old_cols = list(df.columns.values.tolist())
             new_cols = [col_grids[i % 3].text_input(label = col_names[col] ) for i, col in enumerate(col_names)]
 
             # time column selection (only for manual upload)
@@ -105,7 +129,7 @@ def simulationCreateSection(userid):
                 with col1:
                     time_col = st.selectbox(label='Time Column', options=collist)
                 with col2:
-                    time_format = st.selectbox(label='Time Format', options=TIME_FORMAT_LIST)
+                    time_format = st.selectbox(label='Time Format', options=[AUTO_TIME_FORMAT] + TIME_FORMAT_LIST)
             else:
                 time_col = 'Time'
                 time_format = "%Y-%m-%d"
@@ -113,18 +137,12 @@ def simulationCreateSection(userid):
             pre_submitted = st.form_submit_button(label="Preprocess")
             if pre_submitted:
                 if df is not None and sim_name is not None and sim_name != "":
-                    select_collist = []
-                    for i in range(len(old_cols)):
-                        if old_cols[i] != time_col:
-                            new_colname = new_cols[i] if new_cols[i] != "" and new_cols[i] is not None else old_cols[i]
-                            select_collist.append(new_colname)
-                            df[new_colname] = pd.to_numeric(df[old_cols[i]].astype(str).str.replace(',', ''), errors='coerce')
-                
-                    df['Time'] = pd.to_datetime(df[time_col], format=time_format, errors="coerce")
-                    subdf = df.loc[(~df['Time'].isna()), select_collist + ['Time']].reset_index(drop = True).copy(deep = True)
-                    subdf['TimeIndex'] = np.arange(subdf.shape[0])
-
-                    st.success(f"Preprocessing completed: Final row count {subdf.shape[0]}!")
+                    subdf, timings = preprocess_data(
+                        df, time_col,
+                        renames = dict(zip(col_names.keys(), new_cols)),
+                        time_format = None if time_format == AUTO_TIME_FORMAT else time_format
+                    )
+                    show_preprocess_timings(subdf, timings)
                     st.session_state['processed_data'] = subdf
                 else:
                     st.error("Invalid input")
@@ -151,8 +169,34 @@ def simulationCreateSection(userid):
 
 
     
+def show_rerun_job(jobid: int, simid: int):
+    """
+        Progress of the background re-run of the experiments of the simulation, then its report
+    """
+    job = get_job(jobid)
+    if job is None or job.simid != simid:
+        return
+    if job.active:
+        st.progress(min(max(job.progress or 0.0, 0.0), 1.0), text=f"Re-running experiments: {job.message or job.status}")
+        if st.button('Cancel Re-run'):
+            cancel_job(jobid)
+        sleep(JOB_POLL_INTERVAL)
+        st.experimental_rerun()
+    elif job.status == JobStatus.SUCCEEDED.value:
+        report = load_job_result(job)
+        if report is not None:
+            report = pd.DataFrame(report)
+            counts = report['status'].value_counts().to_dict() if report.shape[0] > 0 else {}
+            st.success(f"Experiments re-run in {job.elapsed:.1f} seconds: " + ', '.join([f"{n} {status}" for status, n in counts.items()]))
+            st.dataframe(report)
+    elif job.status == JobStatus.FAILED.value:
+        error_lines = (job.error or 'Unknown error').strip().splitlines()
+        st.error(f"Re-running the experiments failed: {error_lines[-1]}")
+    else:
+        st.warning('Re-running the experiments was cancelled')
+
+
 def simulationEditSection(userid):
-    # TODO: Update data, and then run all the experiments 1 by 1
     selected_sim = st_searchbox(
         search_function=lambda x: [(sim.sim_name, sim) for sim in Simulation.search(x, userid) ],
         label="Select Simulation to Update",
@@ -164,11 +208,11 @@ def simulationEditSection(userid):
 
         # upload new data
         st.subheader('Upload New Data Here')
-        input_f = st.file_uploader('Input File', accept_multiple_files=False)
+        input_f = st.file_uploader('Input File', type=INGEST_FORMATS, accept_multiple_files=False)
         if input_f is not None:
-            xl = pd.ExcelFile(input_f)
-            input_sheet_name = st.selectbox('Input Excel Sheet Name', options=xl.sheet_names)        
-            df = xl.parse(sheet_name=input_sheet_name)
+            sheet_names = list_sheets(input_f.getvalue(), input_f.name)
+            input_sheet_name = st.selectbox('Input Excel Sheet Name', options=sheet_names) if len(sheet_names) > 0 else None
+            df = read_upload(input_f.getvalue(), input_f.name, input_sheet_name)     # parsed once, reruns hit the cache
             st.success(f"Found {df.shape[0]} rows and {df.shape[1]} columns in the dataset")
             
             with st.form('preprocess-data-update'):
@@ -180,7 +224,6 @@ def simulationEditSection(userid):
                 collist = list(df.columns.values.tolist())
                 col_names = { col: re.sub(r'\n+', ' ', col) for col in collist}
 
-                old_cols = list(df.columns.values.tolist())
                 new_cols = [col_grids[i % 3].text_input(label = col_names[col] ) for i, col in enumerate(col_names)]
 
                 # time column selection
@@ -188,23 +231,17 @@ def simulationEditSection(userid):
                 with col1:
                     time_col = st.selectbox(label='Time Column', options=collist)
                 with col2:
-                    time_format = st.selectbox(label='Time Format', options=TIME_FORMAT_LIST)
+                    time_format = st.selectbox(label='Time Format', options=[AUTO_TIME_FORMAT] + TIME_FORMAT_LIST)
 
                 pre_submitted = st.form_submit_button(label="Preprocess")
                 if pre_submitted:
                     if df is not None:
-                        select_collist = []
-                        for i in range(len(old_cols)):
-                            if old_cols[i] != time_col:
-                                new_colname = new_cols[i] if new_cols[i] != "" and new_cols[i] is not None else old_cols[i]
-                                select_collist.append(new_colname)
-                                df[new_colname] = pd.to_numeric(df[old_cols[i]].astype(str).str.replace(',', ''), errors='coerce')
-                    
-                        df['Time'] = pd.to_datetime(df[time_col], format=time_format, errors="coerce")
-                        subdf = df.loc[(~df['Time'].isna()), select_collist + ['Time']].reset_index(drop = True).copy(deep = True)
-                        subdf['TimeIndex'] = np.arange(subdf.shape[0])
-
-                        st.success(f"Preprocessing completed: Final row count {subdf.shape[0]}!")
+                        subdf, timings = preprocess_data(
+                            df, time_col,
+                            renames = dict(zip(col_names.keys(), new_cols)),
+                            time_format = None if time_format == AUTO_TIME_FORMAT else time_format
+                        )
+                        show_preprocess_timings(subdf, timings)
                         st.session_state['processed_data'] = subdf
                     else:
                         st.error("Invalid input")
@@ -212,19 +249,40 @@ def simulationEditSection(userid):
         if st.session_state.get('processed_data') is not None:
             subdf: pd.DataFrame = st.session_state.get('processed_data')
             st.dataframe(subdf)
+            force_rerun = st.checkbox('Re-run unchanged experiments too', value=False)
             rerun_exp_btn = st.button('Save and Rerun Experiments')
             if rerun_exp_btn:
                 old_cols = [col for col in initial_df.columns if col not in ['experiment_id']]
                 new_cols = [col for col in subdf.columns]
-                if set(old_cols) != set(new_cols):
+                missing_cols = [col for col in old_cols if col not in new_cols]
+                extra_cols = [col for col in new_cols if col not in old_cols]
+                if len(missing_cols) > 0:
                     st.error(f"The updated excel does not match the schema of existing simulation data.")
-                    st.error(f"The columns present in new data but not in old data are: {', '.join( set(new_cols).difference(set(old_cols)) )}")
-                    st.error(f"The columns present in old data but not in new data are: {', '.join( set(old_cols).difference(set(new_cols)) )}")
+                    st.error(f"The columns present in old data but not in new data are: {', '.join(missing_cols)}")
                 else:
+                    if len(extra_cols) > 0:
+                        # e.g. line items that appeared in a later QBO fetch, the simulation keeps its columns
+                        st.info(f"The columns not present in old data are left out: {', '.join(extra_cols)}")
+                    subdf = subdf[old_cols]
                     initial_exp = selected_sim.get_initial_experiment()
-                    insert_data_to_experiment(subdf, initial_exp, selected_sim)
+                    insert_data_to_experiment(subdf, initial_exp, selected_sim, selected_sim.userid)
                     st.success('Data Updated Successfully')
-                        
+                    # experiments whose inputs changed are re-run in the background, in dependency order
+                    experiments = selected_sim.get_experiments(columns=["expid", "input_hash", "updated_at"])
+                    key = job_key(
+                        "rerun", selected_sim.simid, dataframe_fingerprint(subdf), force_rerun,
+                        [(ordinal, expp.input_hash, expp.updated_at) for ordinal, expp in experiments.items()]
+                    )
+                    job = submit_job(
+                        "rerun", key,
+                        lambda progress: rerun_experiments(selected_sim, selected_sim.userid, force=force_rerun, progress=progress),
+                        userid=selected_sim.userid, simid=selected_sim.simid
+                    )
+                    st.session_state['rerun_jobid'] = job.jobid
+
+            if st.session_state.get('rerun_jobid') is not None:
+                show_rerun_job(st.session_state['rerun_jobid'], selected_sim.simid)
+
 
 def simulationListSection(userid):
     sim_count = Simulation.count(userid)
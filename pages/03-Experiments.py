@@ -7,13 +7,72 @@ import pandas as pd
 from time import time, sleep
 
 from chronomodeler.authentication import requires_auth, get_auth_userid
-from chronomodeler.models import User, UserAuthLevel, Simulation, Experiment
-from chronomodeler.apimethods import get_simulation_data_initial, insert_data_to_experiment, delete_data_from_experiment
+from chronomodeler.models import User, UserAuthLevel, Simulation, Experiment, JobStatus
+from chronomodeler.apimethods import (
+    get_simulation_data_initial, get_simulation_experiments_data, insert_data_to_experiment, delete_data_from_experiment
+)
 from chronomodeler.blocks import (
     transformation_block, prediction_block, get_indep_block, get_dep_block,
     add_block, subtract_block, mult_block, div_block, merge_block
 )
-from chronomodeler.expconfig import ExperimentConfig, run_experiment
+from chronomodeler.expconfig import (
+    ExperimentConfig, run_experiment, get_upstream_ordinals, experiment_run_params, experiment_input_hash
+)
+from chronomodeler.asyncapi import load_concurrently
+from chronomodeler.jobs import job_key, dataframe_fingerprint, submit_job, find_job, cancel_job, load_job_result
+from chronomodeler.constants import JOB_POLL_INTERVAL
+
+
+def run_experiment_job(expconf: ExperimentConfig, df: pd.DataFrame, train_dates, test_dates, pred_dates, selected_sim: Simulation):
+    """
+        Runs the experiment as a background job (or reattaches to the job that already ran
+        the same config on the same data) and shows its state. Returns the (result, shape, metrics)
+        of the run once it has succeeded, None otherwise (the page reruns itself while the job runs)
+    """
+    upstream = selected_sim.get_experiments_by_ordinals(
+        get_upstream_ordinals(expconf.get_variables_list()), columns=["expid", "updated_at"]
+    )
+    key = job_key(
+        "experiment", selected_sim.simid, expconf.config,
+        [str(d) for d in train_dates], [str(d) for d in test_dates], [str(d) for d in pred_dates],
+        dataframe_fingerprint(df),
+        sorted([(exp.expid, exp.updated_at) for exp in upstream.values()])
+    )
+    job = find_job(key)
+
+    def start():
+        return submit_job(
+            "experiment", key,
+            lambda progress: run_experiment(expconf, df, train_dates, test_dates, pred_dates, selected_sim, progress),
+            userid=selected_sim.userid, simid=selected_sim.simid
+        )
+
+    if job is None:
+        job = start()
+    if job.status == JobStatus.SUCCEEDED.value:
+        run_output = load_job_result(job)
+        if run_output is None:
+            st.experimental_rerun()     # the result went missing, the job is now marked failed
+        st.caption(f"Experiment run finished in {job.elapsed:.1f} seconds")
+        return run_output
+    if job.status in (JobStatus.FAILED.value, JobStatus.CANCELLED.value):
+        if job.status == JobStatus.FAILED.value:
+            error_lines = (job.error or 'Unknown error').strip().splitlines()
+            st.error(f"The experiment run failed: {error_lines[-1]}")
+            with st.expander('Error Details'):
+                st.code(job.error or '')
+        else:
+            st.warning('The experiment run was cancelled')
+        if st.button('Run Experiment Again'):
+            start()
+            st.experimental_rerun()
+        return None
+
+    st.progress(min(max(job.progress or 0.0, 0.0), 1.0), text=f"{job.status.capitalize()}: {job.message or ''}")
+    if st.button('Cancel Run'):
+        cancel_job(job.jobid)
+    sleep(JOB_POLL_INTERVAL)
+    st.experimental_rerun()
 
 
 @requires_auth(auth_level=UserAuthLevel.PRIVATE)
@@ -35,7 +94,12 @@ def experimentPage():
     )
 
     if selected_sim is not None:
-        exp_count = selected_sim.get_experiment_count()
+        # independent loads of the page run concurrently
+        loads = { 'exp_count': selected_sim.get_experiment_count }
+        if exp_action_choice != 'Delete Experiment':
+            loads['df'] = lambda: get_simulation_data_initial(selected_sim, userid)
+        page_data = load_concurrently(**loads)
+        exp_count = page_data['exp_count']
         st.markdown(f"""This simulation has {exp_count} experiments!""")
 
         st.subheader(f"Enter Details for Experiment")
@@ -43,11 +107,12 @@ def experimentPage():
         if exp_action_choice == 'Delete Experiment':
             # load experiment
             selected_expp_delete: Experiment = st_searchbox(
-                search_function=lambda x: [(expp.exp_name, expp) for expp in Experiment.search(x, userid) ],
+                search_function=lambda x: [(f"#{expp.ordinal} {expp.exp_name}", expp) for expp in Experiment.search(x, simid=selected_sim.simid, columns=Experiment.SUMMARY_COLUMNS) ],
                 label="Select Experiment to Delete",
                 key="select-expp-delete"
             )
             if selected_expp_delete is not None:
+                selected_expp_delete = Experiment.get(selected_expp_delete.expid)   # search results only carry the summary
                 # show model config and metrics
                 col111, col112 = st.columns(2)
                 with col111:
@@ -73,7 +138,7 @@ def experimentPage():
             test_dates = st.date_input('Testing Data Range', value=[dt.datetime(2022,1,1), dt.datetime(2022,12,31)])
             pred_dates = st.date_input('Prediction Data Range', value=[dt.datetime(2023,1,1), dt.datetime(2024,12,31)])
 
-            df = get_simulation_data_initial(selected_sim, userid)
+            df = page_data['df']
             collist = df.columns.values.tolist()
             dep_block = get_dep_block(collist)
             indep_block = get_indep_block(collist)
@@ -94,11 +159,12 @@ def experimentPage():
             elif exp_action_choice == "Load Existing Experiment":
                 # load experiment
                 selected_expp: Experiment = st_searchbox(
-                    search_function=lambda x: [(expp.exp_name, expp) for expp in Experiment.search(x, userid) ],
+                    search_function=lambda x: [(f"#{expp.ordinal} {expp.exp_name}", expp) for expp in Experiment.search(x, simid=selected_sim.simid, columns=Experiment.SUMMARY_COLUMNS) ],
                     label="Select Experiment to Load",
                     key="select-expp-load"
                 )
                 if selected_expp is not None:
+                    selected_expp = Experiment.get(selected_expp.expid)   # search results only carry the summary
                     # save the barfi schemas
                     exp_name = selected_expp.exp_name
                     expconf = ExperimentConfig(config = selected_expp.config)
@@ -119,11 +185,10 @@ def experimentPage():
             
             if barfi_result is not None and len(barfi_result) > 0:
                 expconf = ExperimentConfig.from_barfi_blocks(barfi_result)
-                result, shap, metrics = run_experiment(
-                    expconf, df, 
-                    train_dates, test_dates, pred_dates,
-                    selected_sim
-                )
+                run_output = run_experiment_job(expconf, df, train_dates, test_dates, pred_dates, selected_sim)
+                if run_output is None:
+                    st.stop()
+                result, shap, metrics = run_output
                 st.markdown(f"Model trained on {shap[0]} observations and {shap[1]} features")
                 
                 col1, col2 = st.columns(2)
@@ -156,12 +221,20 @@ def experimentPage():
                 # if you are okay with the results, try to save it
                 save_exp_btn = st.button('Save Experiment')
                 if save_exp_btn:
+                    # recorded so that the experiment can be re-run (only when its inputs change) after a data update
+                    upstream_ordinals = get_upstream_ordinals(expconf.get_variables_list())
+                    run_params = experiment_run_params(train_dates, test_dates, pred_dates)
+                    input_hash = experiment_input_hash(
+                        expconf, run_params, df, get_simulation_experiments_data(selected_sim, selected_sim.userid, upstream_ordinals)
+                    )
                     newexp = Experiment(
                         simid = selected_sim.simid,
                         exp_name=exp_name,
                         config=expconf.config,
                         results=metrics,
                         initial=False,
+                        run_params=run_params,
+                        input_hash=input_hash,
                         expid=selected_expp.expid if exp_action_choice == "Load Existing Experiment" else None
                     )
                     if exp_action_choice == "Load Existing Experiment":
@@ -172,7 +245,8 @@ def experimentPage():
                         df = result.drop(labels=['Human Time'], axis = 1),
                         expp=newexp,
                         sim=selected_sim,
-                        userid=selected_sim.userid
+                        userid=selected_sim.userid,
+                        bases=list(selected_sim.get_experiments_by_ordinals(upstream_ordinals).values())
                     )
                     st.success('Experiment Saved Successfully! This page will reload in 5 seconds')
 
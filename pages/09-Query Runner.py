@@ -1,23 +1,110 @@
 import streamlit as st
 import pandas as pd
+import threading, queue, sqlite3
+from time import perf_counter
 
 from chronomodeler.models import UserAuthLevel
-from chronomodeler.dbutils import db_query_fetch, db_query_execute
+from chronomodeler.models.cache import identity_map
+from chronomodeler.datacache import data_cache
+from chronomodeler.dbutils import db_query_iter, db_query_stream, db_query_plan, db_query_execute, db_writer_stats
 from chronomodeler.authentication import requires_auth
+from chronomodeler.constants import QUERY_RUNNER_ROW_CAP, QUERY_RUNNER_CHUNK_SIZE, QUERY_RUNNER_TIMEOUT
+
+
+def stream_query(query: str, row_cap: int, chunk_size: int, timeout: float, on_chunk):
+    """
+        Streams the query result in chunks from a query thread, calling `on_chunk(df, elapsed)`
+        on the script thread after every chunk until `row_cap` rows are kept.
+        The script thread polls while the query runs, so a rerun (e.g. the Cancel button)
+        stops the script here and the cancel event interrupts the query through the progress handler.
+        Returns the kept dataframe, whether it was truncated and the elapsed seconds
+    """
+    cancel = threading.Event()
+    batches = db_query_stream(query, (), batch_size=chunk_size, timeout=timeout, cancel=cancel)
+    status = st.empty()
+    start = perf_counter()
+    frames = []
+    nrows = 0
+    truncated = False
+    try:
+        while nrows < row_cap:
+            try:
+                batch = batches.get(timeout=0.1)
+            except queue.Empty:
+                status.text(f"Running for {perf_counter() - start:.1f}s, {nrows} rows so far...")
+                continue
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            frames.append(pd.DataFrame(batch[:row_cap - nrows]))
+            nrows += min(len(batch), row_cap - nrows)
+            truncated = nrows >= row_cap
+            on_chunk(pd.concat(frames, ignore_index=True), perf_counter() - start)
+    finally:
+        cancel.set()    # the query thread closes its connection itself
+        status.empty()
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame()
+    return df, truncated, perf_counter() - start
+
 
 @requires_auth(auth_level=UserAuthLevel.DEVELOPER)
 def queryRunnerPage():
     query = st.text_area("SQL Query")
-    require_fetch = st.checkbox(label="Require Fetching", value=True)
+    mode = st.radio(
+        label="Mode",
+        options=["Fetch Results", "Execute", "Explain"],
+        horizontal=True
+    )
+    col1, col2 = st.columns(2)
+    with col1:
+        row_cap = int(st.number_input("Row Cap", min_value=1, value=QUERY_RUNNER_ROW_CAP, step=1000))
+    with col2:
+        timeout = float(st.number_input("Timeout (seconds)", min_value=1, value=QUERY_RUNNER_TIMEOUT))
     execute_btn = st.button('Execute')
     if execute_btn and query is not None and query != "":
-        if require_fetch:
-            df = pd.DataFrame(db_query_fetch(query, ()))
-            st.dataframe(df)
-        else:
-            res = db_query_execute(query, ())
-            st.success('Query executed successfully!')
+        st.button('Cancel')    # any rerun stops the running script, which cancels the query
+        try:
+            if mode == "Fetch Results":
+                table = st.empty()
+                caption = st.empty()
+                def on_chunk(df, elapsed):
+                    table.dataframe(df)
+                    caption.caption(f"{df.shape[0]} rows in {elapsed:.3f}s")
+                df, truncated, elapsed = stream_query(query, row_cap, QUERY_RUNNER_CHUNK_SIZE, timeout, on_chunk)
+                if df.shape[0] == 0:
+                    table.dataframe(df)
+                if truncated:
+                    st.warning(f"Result truncated to the first {row_cap} rows")
+            elif mode == "Execute":
+                res = db_query_execute(query, ())
+                identity_map.clear()    # the statement may have written any model row
+                data_cache.clear()      # or any simulation data table
+                st.success('Query executed successfully!')
+            else:
+                st.markdown('**Query Plan**')
+                st.dataframe(pd.DataFrame(db_query_plan(query, ())))
+                # time the full execution on a read-only connection, counting the rows without keeping them
+                nrows = 0
+                start = perf_counter()
+                try:
+                    for batch in db_query_iter(query, (), batch_size=QUERY_RUNNER_CHUNK_SIZE, timeout=timeout, read_only=True):
+                        nrows += len(batch)
+                    st.info(f"Executed in {(perf_counter() - start) * 1000:.1f} ms, returning {nrows} rows")
+                except sqlite3.OperationalError as e:
+                    st.warning(f"Not timed, Explain only runs statements that do not write: {e}")
+        except (TimeoutError, InterruptedError) as e:
+            st.error(str(e))
+
+    with st.expander('Model Cache Statistics'):
+        st.write(identity_map.stats())
+
+    with st.expander('Data Cache Statistics'):
+        st.write(data_cache.stats())
+
+    with st.expander('Database Writer Statistics'):
+        st.write(db_writer_stats())
 
 
 
-queryRunnerPage()
\ No newline at end of file
+queryRunnerPage()
@@ -0,0 +1,87 @@
+import queue
+import sqlite3
+import threading
+
+import pytest
+
+from chronomodeler.dbutils import db_query_iter, db_query_stream, db_scope
+
+
+ROWS = 5000
+BATCH_SIZE = 100
+ROW_CAP = 1234
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "stream.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE numbers (n integer);")
+    conn.executemany("INSERT INTO numbers (n) VALUES (?);", [(i, ) for i in range(ROWS)])
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def thread_errors():
+    errors = []
+    previous = threading.excepthook
+    threading.excepthook = lambda args: errors.append(args.exc_value)
+    yield errors
+    threading.excepthook = previous
+
+
+def stream_threads():
+    return [thread for thread in threading.enumerate() if thread.name == "chronomodeler-query-stream"]
+
+
+def read_until(batches: queue.Queue, row_cap: int):
+    rows = []
+    while len(rows) < row_cap:
+        batch = batches.get(timeout=5)
+        if batch is None:
+            break
+        if isinstance(batch, Exception):
+            raise batch
+        rows += batch[:row_cap - len(rows)]
+    return rows
+
+
+def test_stream_past_row_cap(database, thread_errors):
+    # the reader stops at the row cap from another thread than the query thread
+    for _ in range(3):
+        cancel = threading.Event()
+        with db_scope(database):
+            batches = db_query_stream("SELECT n FROM numbers ORDER BY n;", (), batch_size=BATCH_SIZE, cancel=cancel)
+        rows = read_until(batches, ROW_CAP)
+        cancel.set()
+        assert [row['n'] for row in rows] == list(range(ROW_CAP))
+    for thread in stream_threads():
+        thread.join(timeout=5)
+    assert len(stream_threads()) == 0
+    assert thread_errors == []
+
+
+def test_stream_full_result(database, thread_errors):
+    with db_scope(database):
+        batches = db_query_stream("SELECT n FROM numbers;", (), batch_size=BATCH_SIZE)
+    rows = read_until(batches, ROWS + 1)
+    assert len(rows) == ROWS
+    assert thread_errors == []
+
+
+def test_stream_error_is_queued(database):
+    with db_scope(database):
+        batches = db_query_stream("SELECT missing FROM numbers;", ())
+    with pytest.raises(sqlite3.OperationalError):
+        read_until(batches, 1)
+
+
+def test_read_only_iter_does_not_write(database):
+    with db_scope(database):
+        with pytest.raises(sqlite3.OperationalError):
+            for _ in db_query_iter("DELETE FROM numbers WHERE n < 5;", (), read_only=True):
+                pass
+        rows = [row for batch in db_query_iter("SELECT count(*) AS c FROM numbers;", (), read_only=True) for row in batch]
+    assert rows == [{'c': ROWS}]
@@ -0,0 +1,48 @@
+import sqlite3
+
+import pytest
+
+from chronomodeler.dbutils import db_scope
+from chronomodeler.models import Experiment
+
+
+@pytest.fixture
+def conn(tmp_path):
+    path = str(tmp_path / "models.sqlite")
+    with db_scope(path):
+        Experiment.create_table(foreign_keys=False)
+    conn = sqlite3.connect(path, isolation_level=None)
+    Experiment.create_ordinals_table(conn)
+    yield conn
+    conn.close()
+
+
+def insert_experiments(conn, simid: int, count: int):
+    objs = [Experiment(simid, f"exp {i}", {}, {}) for i in range(count)]
+    Experiment._assign_ordinals(conn, objs)
+    conn.executemany(
+        f"INSERT INTO {Experiment._table} (simid, exp_name, config, results, ordinal, created_at, updated_at) \
+            VALUES (?, ?, '{{}}', '{{}}', ?, 0, 0);",
+        [(obj.simid, obj.exp_name, obj.ordinal) for obj in objs]
+    )
+    return [obj.ordinal for obj in objs]
+
+
+def test_ordinals_are_not_reused(conn):
+    assert insert_experiments(conn, 1, 3) == [1, 2, 3]
+    assert insert_experiments(conn, 2, 1) == [1]
+    # deleting the newest experiment must not hand its ordinal to the next one
+    conn.execute(f"DELETE FROM {Experiment._table} WHERE simid = 1 AND ordinal = 3;")
+    assert insert_experiments(conn, 1, 2) == [4, 5]
+
+
+def test_ordinals_counter_is_seeded(tmp_path):
+    path = str(tmp_path / "seeded.sqlite")
+    with db_scope(path):
+        Experiment.create_table(foreign_keys=False)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute(f"INSERT INTO {Experiment._table} (simid, exp_name, config, results, ordinal, created_at, updated_at) \
+        VALUES (1, 'old', '{{}}', '{{}}', 7, 0, 0);")
+    Experiment.create_ordinals_table(conn)
+    assert insert_experiments(conn, 1, 1) == [8]
+    conn.close()